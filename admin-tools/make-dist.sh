@@ -18,7 +18,13 @@ fi
 cd ..
 source mathics_django/version.py
 echo $__version__
-cp -v ${HOME}/.local/var/mathics/doc_html_data.pcl mathics_django/doc/
+# The doctest store made by "make doctest-data" is shipped as the one in
+# the package; see DOC_SYSTEM_HTML_STORE_PATH in mathics_django/settings.py.
+doctest_html_store_path=$(python -c "from mathics_django.settings import DOCTEST_USER_HTML_STORE_PATH; print(DOCTEST_USER_HTML_STORE_PATH)")
+if ! cp -v "$doctest_html_store_path" mathics_django/doc/doc_html_data.sqlite ; then
+    echo "Run 'make doctest-data' to make $doctest_html_store_path" >&2
+    exit 1
+fi
 pyversion=3.13
 if ! pyenv local $pyversion ; then
     exit $?
@@ -11,5 +11,19 @@ from django.core.asgi import get_asgi_application
 # Set the default settings module for the 'mathics-django' project.
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mathics_django.settings")
 
-# This is the application object used by Daphne
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# This needs Django to have been set up, which get_asgi_application() does.
+from mathics_django.web.websocket import websocket_query_application  # noqa: E402
+
+
+async def application(scope, receive, send):
+    """
+    This is the application object used by Daphne.
+    WebSocket connections carry worksheet queries; everything else is
+    handled by Django.
+    """
+    if scope["type"] == "websocket":
+        await websocket_query_application(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
@@ -1,13 +1,62 @@
 # -*- coding: utf-8 -*-
 """
 Module for handling Mathics-style documentation inside Mathics Django.
-"""
 
-from mathics.core.load_builtin import import_and_load_builtins
+Building the documentation means loading the builtins and going over all
+of their docstrings, which takes seconds. It is built on first use, by
+``get_documentation()``, rather than when this is imported, so that a
+server does not wait for it before serving pages that do not need it.
+``start_documentation_warmup()`` builds it ahead of time instead, in a
+thread of its own; ``documentation_ready`` is set once it is built.
+"""
 
-import_and_load_builtins()
+import threading
+from typing import Optional
 
-# FIXME: should we really do this here?
 from mathics_django.doc.django_doc import DjangoDocumentation
+from mathics_django.load_builtins import ensure_builtins_loaded
+
+_documentation: Optional[DjangoDocumentation] = None
+_documentation_lock = threading.Lock()
+documentation_ready = threading.Event()
+
+
+def get_documentation() -> DjangoDocumentation:
+    """
+    Return the process-wide DjangoDocumentation, building it on first use.
+    """
+    global _documentation
+    if _documentation is None:
+        with _documentation_lock:
+            if _documentation is None:
+                ensure_builtins_loaded()
+                _documentation = DjangoDocumentation()
+                documentation_ready.set()
+    return _documentation
+
+
+def get_documentation_if_ready() -> Optional[DjangoDocumentation]:
+    """
+    Return the DjangoDocumentation if it has been built, or None.
+    """
+    return _documentation
+
+
+def start_documentation_warmup():
+    """
+    Build the documentation in a thread of its own, unless it is built.
+    """
+    if not documentation_ready.is_set():
+        threading.Thread(
+            target=get_documentation,
+            name="Documentation warm-up",
+            daemon=True,
+        ).start()
+
 
-documentation = DjangoDocumentation()
+def __getattr__(name: str):
+    # ``from mathics_django.doc import documentation`` still works, and
+    # builds the documentation if needed.
+    if name == "documentation":
+        return get_documentation()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -4,7 +4,9 @@ This code is the Django-specific part of the homegrown sphinx documentation.
 FIXME: Ditch this and hook into sphinx
 """
 
-import pickle
+import os.path as osp
+from copy import copy
+from typing import Optional, Tuple
 
 from django.utils.safestring import mark_safe
 from mathics import settings
@@ -18,21 +20,76 @@ from mathics.doc.common_doc import (
     DocText,
     Documentation,
     DocumentationEntry,
-    get_results_by_test,
     sorted_chapters,
 )
+from mathics.eval.pymathics import pymathics_modules
 
+from mathics_django.doc.doc_data import DocTestData
+from mathics_django.doc.search_index import PartSearchIndex, ranked_search
 from mathics_django.doc.utils import escape_html
-from mathics_django.settings import get_doctest_html_data_path
+from mathics_django.settings import (
+    DOC_SYSTEM_HTML_STORE_PATH,
+    DOCTEST_USER_HTML_STORE_PATH,
+)
+
+
+def report_old_pickles():
+    """
+    Say so if, instead of a store, there is the pickle that older
+    versions kept the doctest outputs in. Pickles are no longer read.
+    """
+    for store_path in (DOCTEST_USER_HTML_STORE_PATH, DOC_SYSTEM_HTML_STORE_PATH):
+        pickle_path = osp.splitext(store_path)[0] + ".pcl"
+        if osp.exists(pickle_path) and not osp.exists(store_path):
+            print(
+                f"Ignoring {pickle_path}, made by an older version; "
+                f"run docpipeline.py --output to make {store_path}"
+            )
+
+
+def load_doc_data() -> Tuple[DocTestData, str, Optional[str]]:
+    """
+    Return the doctest outputs shown in the documentation, the store
+    they were read from, and the hash of its content.
+
+    The store in the user space is read if there is one and it can be,
+    and the one distributed with the package otherwise; a stale or broken
+    store of the user's does not hide the outputs of the package.
+    """
+    report_old_pickles()
+    store_paths = [DOC_SYSTEM_HTML_STORE_PATH]
+    if osp.isfile(DOCTEST_USER_HTML_STORE_PATH):
+        store_paths.insert(0, DOCTEST_USER_HTML_STORE_PATH)
+    for doctest_html_store_path in store_paths:
+        try:
+            doc_data = DocTestData.open(doctest_html_store_path)
+        except IOError as exc:
+            print(f"Trouble reading Doc file {doctest_html_store_path}: {exc}")
+            continue
+        return doc_data, doctest_html_store_path, doc_data.content_hash
+    return DocTestData.from_dict({}), doctest_html_store_path, None
+
 
 # FIXME: remove globalness
-doctest_html_data_path = get_doctest_html_data_path(should_be_readable=True)
-try:
-    with open(doctest_html_data_path, "rb") as doctest_html_data_file:
-        doc_data = pickle.load(doctest_html_data_file)
-except IOError:
-    print(f"Trouble reading Doc file {doctest_html_data_path}")
-    doc_data = {}
+# doc_data_stamp tells which doc_data was read, for caches of what is made
+# from it.
+doc_data, doctest_html_store_path, doc_data_stamp = load_doc_data()
+
+
+def find_prev_next(collection: list, element) -> tuple:
+    """
+    Return the elements before and after ``element`` in ``collection``,
+    or None where there is none.
+    """
+    index = collection.index(element)
+    prev = collection[index - 1] if index > 0 else None
+    next = collection[index + 1] if index < len(collection) - 1 else None
+    return prev, next
+
+
+def set_prev_next(collection: list):
+    for element in collection:
+        element.prev_next = find_prev_next(collection, element)
 
 
 class DjangoDocElement:
@@ -59,11 +116,11 @@ class DjangoDocElement:
         return []
 
     def get_prev_next(self):
-        collection = self.get_collection()
-        index = collection.index(self)
-        prev = collection[index - 1] if index > 0 else None
-        next = collection[index + 1] if index < len(collection) - 1 else None
-        return prev, next
+        # Set by DjangoDocumentation.update_navigation().
+        prev_next = getattr(self, "prev_next", None)
+        if prev_next is None:
+            prev_next = find_prev_next(self.get_collection(), self)
+        return prev_next
 
     def get_title_html(self):
         """Get the title of the element."""
@@ -76,6 +133,9 @@ class DjangoDocumentation(Documentation, DjangoDocElement):
         super(DjangoDocumentation, self).__init__()
         self.doc_dir = settings.DOC_DIR
 
+        # The Mathics3 modules documented; see
+        # add_loaded_modules_documentation() in mathics_django.web.controllers.doc.
+        self.pymathics_modules = copy(pymathics_modules)
         self.load_documentation_sources()
         self.doctest_latex_pcl_path = settings.DOCTEST_LATEX_DATA_PCL
         self.pymathics_doc_loaded = False
@@ -83,6 +143,11 @@ class DjangoDocumentation(Documentation, DjangoDocElement):
             should_be_readable=True
         )
         self.title = "Overview"
+        self.search_indexes = {}
+        set_prev_next(self.parts)
+        for part in self.parts:
+            self.update_search_index(part)
+            self.update_navigation(part)
 
     def _set_classes(self):
         self.doc_class = DjangoDoc
@@ -99,65 +164,41 @@ class DjangoDocumentation(Documentation, DjangoDocElement):
         """Return the URI of the documentation root."""
         return "/"
 
-    def search(self, query):
-        """Handles interactive search in browser."""
-
-        query = query.strip()
-        query_parts = [q.strip().lower() for q in query.split()]
-
-        def matches(text):
-            text = text.lower()
-            return all(q in text for q in query_parts)
-
-        def name_compare_goodness(result_data):
-            exact, item = result_data
-            name = item.title
-            if exact:
-                return -4 if name == query else -3
-
-            if name.startswith(query):
-                return -2
-            if query in name:
-                return -1
-            lower_name = name.lower()
-            if lower_name.startswith(query):
-                return 0
-            if lower_name in query:
-                return 1
-            return 2
-
-        def search_sections(section, result):
-            for subsection in section.subsections:
-                if matches(subsection.title):
-                    result.append((subsection.title == query, subsection))
-                elif query == subsection.operator:
-                    result.append((True, subsection))
-
-        result = []
-        for part in self.parts:
-            if matches(part.title):
-                result.append((False, part))
-            for chapter in sorted_chapters(part.chapters):
-                if matches(chapter.title):
-                    result.append((False, chapter))
-                for section in chapter.sections:
-                    if matches(section.title):
-                        if not isinstance(section, DjangoDocGuideSection):
-                            result.append((section.title == query, section))
-                    elif query == section.operator:
-                        result.append((True, section))
-                        continue
-                    search_sections(section, result)
-                for section in chapter.guide_sections:
-                    if matches(section.title):
-                        result.append((section.title == query, section))
-                    elif query == section.operator:
-                        result.append((True, section))
-                        continue
-                    search_sections(section, result)
-
-        sorted_results = sorted(result, key=name_compare_goodness)
-        return sorted_results
+    def get_search_index(self, part) -> PartSearchIndex:
+        search_index = self.search_indexes.get(part.slug)
+        if search_index is None:
+            search_index = self.update_search_index(part)
+        return search_index
+
+    def update_search_index(self, part) -> PartSearchIndex:
+        """
+        Index ``part`` for search again, as when chapters have been added
+        to it.
+        """
+        search_index = PartSearchIndex(part, self.guide_section_class)
+        self.search_indexes[part.slug] = search_index
+        return search_index
+
+    def update_navigation(self, part):
+        """
+        Work out again which elements come before and after each element
+        in ``part``, as when chapters have been added to it. Pages link to
+        these.
+        """
+        set_prev_next(part.chapters)
+        for chapter in part.chapters:
+            all_sections = chapter.all_sections
+            set_prev_next(all_sections)
+            for section in all_sections:
+                set_prev_next(section.subsections)
+
+    def search(self, query: str, limit: Optional[int] = None) -> list:
+        """
+        Handles interactive search in browser. Returns ``(exact, item)``
+        pairs, best first, at most ``limit`` of them if given.
+        """
+        indexes = [self.get_search_index(part) for part in self.parts]
+        return ranked_search(indexes, query, limit)
 
 
 class DjangoDoc(DocumentationEntry):
@@ -255,12 +296,10 @@ class DjangoDocSection(DocSection, DjangoDocElement):
         indices = set()
         for test in self.doc.items:
             indices.update(test.test_indices())
-        result = {}
-        for index in indices:
-            result[index] = doc_data.get(
-                (self.chapter.part.title, self.chapter.title, self.title, index)
-            )
-        return result
+        found = doc_data.get_many(
+            (self.chapter.part.title, self.chapter.title, self.title), indices
+        )
+        return {index: found.get(index) for index in indices}
 
     def get_uri(self) -> str:
         """Return the URI of this section."""
@@ -306,12 +345,10 @@ class DjangoDocSubsection(DocSubsection, DjangoDocElement):
         indices = set()
         for test in self.doc.items:
             indices.update(test.test_indices())
-        result = {}
-        for index in indices:
-            result[index] = doc_data.get(
-                (self.chapter.part.title, self.chapter.title, self.title, index)
-            )
-        return result
+        found = doc_data.get_many(
+            (self.chapter.part.title, self.chapter.title, self.title), indices
+        )
+        return {index: found.get(index) for index in indices}
 
     def get_uri(self) -> str:
         """Return the URI of this subsection."""
@@ -344,7 +381,7 @@ class DjangoDocTest(DocTest):
         # But if it is None then test number don't line up and that is a different
         # bug that we address here.
         if output_for_key is None:
-            output_for_key = get_results_by_test(self.test, self.key, doc_data)
+            output_for_key = doc_data.get_results_by_test(self.test, self.key)
             results = output_for_key.get("results", [])
             result += '<ul class="out">'
             for r in results:
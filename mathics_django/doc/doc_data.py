@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Doctest outputs shown in the documentation, kept in an SQLite file.
+
+The outputs for the whole manual used to be read from a pickle into one
+dictionary by each server process. In an SQLite file, each entry is a
+row keyed by the key of its test, so pages read just the entries they
+show. The file is opened read-only and memory-mapped, so that server
+processes share its pages through the OS page cache rather than each
+holding its own copy.
+
+The key of a test is a tuple of the part, chapter, section and, where
+there are any, guide section and subsection titles, ending in the number
+of the test. A row holds the titles as a JSON list, the number, and the
+output as JSON. Unlike a pickle, reading a store cannot run code, so a
+store in a directory that others can write to is safe to read.
+
+A store starts with a header, the ``meta`` table. It says which format
+the store is in and which Mathics3 version made the outputs, so that
+stores made for another version are not read. It also has a hash of the
+content, which tells stores apart without reading them: caches of what
+is made from a store are keyed on it. It is not checked against the
+content when a store is opened, which would mean reading all of it.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import os.path as osp
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from mathics import __version__ as mathics_version
+
+# Changes whenever stores are written differently.
+DOCTEST_STORE_FORMAT = "1"
+
+# How much of a store is memory-mapped; more than stores grow to.
+MMAP_SIZE = 1 << 30
+
+CREATE_TABLES = """
+CREATE TABLE meta (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE doctests (
+    prefix TEXT NOT NULL,
+    test_index INTEGER NOT NULL,
+    query TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (prefix, test_index)
+) WITHOUT ROWID;
+"""
+
+
+def split_key(key: tuple) -> Tuple[str, int]:
+    """
+    Return the prefix column and the test number for the key of a test.
+    """
+    return json.dumps(list(key[:-1])), key[-1]
+
+
+def insert_doctest_data(
+    connection: sqlite3.Connection, output_data: Dict, mathics_version: str
+):
+    rows = sorted(
+        (*split_key(key), value.get("query"), json.dumps(value))
+        for key, value in output_data.items()
+    )
+    content_hash = hashlib.sha256()
+    for prefix, test_index, _, data in rows:
+        content_hash.update(f"{json.dumps([prefix, test_index, data])}\n".encode())
+
+    connection.executescript(CREATE_TABLES)
+    connection.executemany("INSERT INTO doctests VALUES (?, ?, ?, ?)", rows)
+    connection.executemany(
+        "INSERT INTO meta VALUES (?, ?)",
+        [
+            ("format", DOCTEST_STORE_FORMAT),
+            ("mathics_version", mathics_version),
+            ("content_hash", content_hash.hexdigest()),
+        ],
+    )
+    connection.commit()
+
+
+def write_doctest_store(
+    output_data: Dict, path: str, mathics_version: str = mathics_version
+):
+    """
+    Write ``output_data``, the doctest outputs gathered by a
+    DocTestPipeline, to a new store at ``path``.
+
+    The store is written next to ``path`` and then moved there, so that
+    processes that have the old one open go on reading it.
+    """
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    if osp.exists(temporary_path):
+        os.unlink(temporary_path)
+    connection = sqlite3.connect(temporary_path)
+    try:
+        insert_doctest_data(connection, output_data, mathics_version)
+    finally:
+        connection.close()
+    os.replace(temporary_path, path)
+
+
+class DocTestData:
+    """
+    Read access to the doctest outputs in a store, by the key of a test.
+
+    Use ``DocTestData.open()`` for a store written by
+    ``write_doctest_store()``, and ``DocTestData.from_dict()`` for
+    outputs read in some other way.
+    """
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+        # The connection is shared by the threads of a server.
+        self.lock = threading.Lock()
+        self.meta = dict(self.query("SELECT name, value FROM meta", ()))
+        # Tells stores apart, for caches of what is made from them. This
+        # is a stamp, not an integrity check: it is not verified.
+        self.content_hash = self.meta.get("content_hash")
+
+    @classmethod
+    def open(cls, path: str) -> "DocTestData":
+        """
+        Open the store at ``path``. IOError is raised if it cannot be
+        read, or was not made for this Mathics3 version.
+        """
+        if not os.access(path, os.R_OK):
+            raise IOError(f"cannot read {path}")
+        # The store is replaced rather than changed, so it can be opened
+        # as immutable and read without locking.
+        connection = sqlite3.connect(
+            f"file:{path}?mode=ro&immutable=1", uri=True, check_same_thread=False
+        )
+        try:
+            connection.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+            doc_data = cls(connection)
+        except sqlite3.DatabaseError as exc:
+            connection.close()
+            raise IOError(f"{path} is not a doctest store: {exc}")
+
+        meta = doc_data.meta
+        if meta.get("format") != DOCTEST_STORE_FORMAT:
+            problem = f"is in format {meta.get('format')}"
+        elif meta.get("mathics_version") != mathics_version:
+            problem = f"was made by Mathics3 {meta.get('mathics_version')}"
+        else:
+            return doc_data
+        connection.close()
+        raise IOError(f"{path} {problem}; run docpipeline.py --output to make it again")
+
+    @classmethod
+    def from_dict(cls, output_data: Dict) -> "DocTestData":
+        connection = sqlite3.connect(":memory:", check_same_thread=False)
+        insert_doctest_data(connection, output_data, mathics_version)
+        return cls(connection)
+
+    def query(self, sql: str, parameters: Iterable) -> List[tuple]:
+        with self.lock:
+            return self.connection.execute(sql, tuple(parameters)).fetchall()
+
+    def __len__(self) -> int:
+        return self.query("SELECT count(*) FROM doctests", ())[0][0]
+
+    def get(self, key: Optional[tuple], default=None):
+        """
+        Return the output of the test with key ``key``, or ``default``.
+        """
+        if not key:
+            return default
+        rows = self.query(
+            "SELECT data FROM doctests WHERE prefix = ? AND test_index = ?",
+            split_key(key),
+        )
+        return json.loads(rows[0][0]) if rows else default
+
+    def get_many(self, prefix: tuple, indices: Iterable[int]) -> Dict[int, dict]:
+        """
+        Return the outputs of the tests numbered ``indices`` under the
+        titles ``prefix``, by test number. Tests without an output are
+        left out.
+        """
+        indices = list(indices)
+        if not indices:
+            return {}
+        placeholders = ", ".join("?" * len(indices))
+        rows = self.query(
+            "SELECT test_index, data FROM doctests "
+            f"WHERE prefix = ? AND test_index IN ({placeholders})",
+            (json.dumps(list(prefix)), *indices),
+        )
+        return {index: json.loads(data) for index, data in rows}
+
+    def get_results_by_test(self, test_expr: str, key: tuple) -> dict:
+        """
+        Return the output of the test of ``test_expr`` under the titles of
+        ``key``, whatever its number, or {} if there is not exactly one.
+        This finds outputs when tests have been numbered differently
+        since they were made, as
+        ``mathics.doc.common_doc.get_results_by_test()`` does.
+        """
+        prefix, _ = split_key(key)
+        rows = self.query(
+            "SELECT data FROM doctests WHERE prefix = ? AND query = ?",
+            (prefix, test_expr),
+        )
+        if len(rows) > 1:
+            logging.warning(f"Warning, multiple results appear under {key[:-1]}.")
+            return {}
+        return json.loads(rows[0][0]) if rows else {}
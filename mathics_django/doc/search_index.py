@@ -0,0 +1,412 @@
+# -*- coding: utf-8 -*-
+"""
+An index of the titles and operators of the documentation, so that
+DjangoDocumentation.search() does not have to go over every part,
+chapter, section and subsection for each query.
+
+A query word matches a title when it is a substring of the title, in
+any case. The index therefore keeps, for each part, the entries whose
+titles contain each string of up to NGRAM_LENGTH characters. The entries
+whose titles contain all the n-grams of all the query words are the only
+ones that can match, and only those are checked.
+
+Matches are ranked with BM25 over the words of the titles and texts of
+the entries. When no title has the query words in it, as when one is
+misspelled, the words of titles close to the query words, and the texts
+with those words, are searched instead; see ranked_search().
+
+Parts are indexed separately, so that when chapters are added to one,
+as when a Mathics3 module is loaded, only that part is indexed again.
+"""
+
+import heapq
+import math
+import re
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from mathics.doc.common_doc import sorted_chapters
+
+NGRAM_LENGTH = 3
+
+# BM25 parameters, with their usual values.
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# How many times a word of a title counts, next to one of the text.
+TITLE_WORD_WEIGHT = 3
+
+# A word of a title is taken for a misspelled query word if they have at
+# least this share of their trigrams in common, or few enough edits
+# between them; see similarity().
+MIN_TRIGRAM_SIMILARITY = 0.5
+
+WORD = re.compile(r"[^\W_]+")
+MARKUP = re.compile(r"<[^>]*>")
+
+
+def title_ngrams(title: str) -> Set[str]:
+    """Return the strings of 1 to NGRAM_LENGTH characters in ``title``."""
+    return {
+        title[start : start + length]
+        for length in range(1, NGRAM_LENGTH + 1)
+        for start in range(len(title) - length + 1)
+    }
+
+
+def word_ngrams(word: str) -> Set[str]:
+    """
+    Return the n-grams that a title must have for ``word`` to be in it.
+    """
+    if len(word) <= NGRAM_LENGTH:
+        return {word}
+    return {
+        word[start : start + NGRAM_LENGTH]
+        for start in range(len(word) - NGRAM_LENGTH + 1)
+    }
+
+
+def text_words(text: str) -> List[str]:
+    """Return the lower-case words of ``text``, leaving out markup."""
+    return WORD.findall(MARKUP.sub(" ", text).lower())
+
+
+def word_trigrams(word: str) -> Set[str]:
+    padded = f" {word} "
+    return {padded[start : start + 3] for start in range(len(padded) - 2)}
+
+
+def edit_distance(first: str, second: str) -> int:
+    """
+    Return the number of insertions, deletions, substitutions and swaps
+    of adjacent characters it takes to turn ``first`` into ``second``.
+    """
+    previous = None
+    row = list(range(len(second) + 1))
+    for i, first_char in enumerate(first, 1):
+        before, previous, row = previous, row, [i] + [0] * len(second)
+        for j, second_char in enumerate(second, 1):
+            row[j] = min(
+                previous[j] + 1,
+                row[j - 1] + 1,
+                previous[j - 1] + (first_char != second_char),
+            )
+            if (
+                before is not None
+                and j > 1
+                and first_char == second[j - 2]
+                and first[i - 2] == second_char
+            ):
+                row[j] = min(row[j], before[j - 2] + 1)
+    return row[-1]
+
+
+def similarity(word: str, title_word: str) -> float:
+    """
+    Return how close ``title_word`` is to the query ``word``, from 0 for
+    not at all to 1 for the same.
+    """
+    trigrams, title_trigrams = word_trigrams(word), word_trigrams(title_word)
+    shared = 2 * len(trigrams & title_trigrams) / (len(trigrams) + len(title_trigrams))
+    if shared >= MIN_TRIGRAM_SIMILARITY:
+        return shared
+    # Trigrams miss that short words with a typo in them are alike.
+    allowed_edits = 1 if len(word) <= 5 else 2
+    if abs(len(word) - len(title_word)) > allowed_edits:
+        return 0.0
+    edits = edit_distance(word, title_word)
+    if edits <= allowed_edits and edits < len(word):
+        return 1 - edits / max(len(word), len(title_word))
+    return 0.0
+
+
+class SearchIndexEntry:
+    """
+    An element of the documentation as search sees it.
+
+    ``listed`` tells if the element is a result when its title matches;
+    the subsections of guide sections are, but not the guide section
+    when found among the sections of a chapter. ``exact_title`` tells if
+    a title that is the query makes the result exact. The subsections of
+    ``parent`` are left out when the parent is found by its operator.
+    """
+
+    __slots__ = (
+        "item",
+        "title",
+        "operator",
+        "listed",
+        "exact_title",
+        "parent",
+        "title_words",
+    )
+
+    def __init__(
+        self,
+        item,
+        operator: Optional[str] = None,
+        listed: bool = True,
+        exact_title: bool = True,
+        parent: Optional["SearchIndexEntry"] = None,
+    ):
+        self.item = item
+        self.title = item.title.lower()
+        self.operator = operator
+        self.listed = listed
+        self.exact_title = exact_title
+        self.parent = parent
+        self.title_words = set(text_words(item.title))
+        if operator is not None:
+            self.title_words.add(operator)
+
+    def matches(self, words: List[str]) -> bool:
+        return all(word in self.title for word in words)
+
+    def hides_subsections(self, query: str, words: List[str]) -> bool:
+        return self.operator == query and not self.matches(words)
+
+
+class PartSearchIndex:
+    """
+    The search index of one part of the documentation. Entries are kept
+    in the order search has always listed them in.
+    """
+
+    def __init__(self, part, guide_section_class: type):
+        self.entries: List[SearchIndexEntry] = []
+        self.ngrams: Dict[str, Set[int]] = defaultdict(set)
+        self.operators: Dict[str, List[int]] = defaultdict(list)
+        # For BM25: how many times each word is in each entry, and the
+        # number of words of each entry.
+        self.word_counts: Dict[str, Dict[int, int]] = defaultdict(dict)
+        self.lengths: List[int] = []
+        self.total_length = 0
+        # For misspelled query words: the entries with each word in their
+        # titles, and the title words with each trigram.
+        self.title_words: Dict[str, Set[int]] = defaultdict(set)
+        self.title_word_trigrams: Dict[str, Set[str]] = defaultdict(set)
+
+        self.add(SearchIndexEntry(part, exact_title=False))
+        for chapter in sorted_chapters(part.chapters):
+            self.add(SearchIndexEntry(chapter, exact_title=False))
+            for section in chapter.sections:
+                self.add_section(
+                    section, listed=not isinstance(section, guide_section_class)
+                )
+            for section in chapter.guide_sections:
+                self.add_section(section, listed=True)
+
+    def add(self, entry: SearchIndexEntry) -> SearchIndexEntry:
+        position = len(self.entries)
+        self.entries.append(entry)
+        for ngram in title_ngrams(entry.title):
+            self.ngrams[ngram].add(position)
+        if entry.operator is not None:
+            self.operators[entry.operator].append(position)
+
+        doc = getattr(entry.item, "doc", None)
+        words = text_words(getattr(doc, "rawdoc", "") or "")
+        words.extend(list(entry.title_words) * TITLE_WORD_WEIGHT)
+        for word in words:
+            counts = self.word_counts[word]
+            counts[position] = counts.get(position, 0) + 1
+        self.lengths.append(len(words))
+        self.total_length += len(words)
+
+        for word in entry.title_words:
+            self.title_words[word].add(position)
+            for trigram in word_trigrams(word):
+                self.title_word_trigrams[trigram].add(word)
+        return entry
+
+    def add_section(self, section, listed: bool):
+        parent = self.add(
+            SearchIndexEntry(section, operator=section.operator, listed=listed)
+        )
+        for subsection in section.subsections:
+            self.add(
+                SearchIndexEntry(
+                    subsection, operator=subsection.operator, parent=parent
+                )
+            )
+
+    def title_candidates(self, words: List[str]) -> Iterable[int]:
+        """
+        Return the positions of the entries whose titles may have all of
+        ``words`` in them.
+        """
+        if not words:
+            return range(len(self.entries))
+        ngrams = set().union(*(word_ngrams(word) for word in words))
+        postings = sorted((self.ngrams.get(ngram, set()) for ngram in ngrams), key=len)
+        return postings[0].intersection(*postings[1:])
+
+    def similar_title_words(self, word: str) -> Dict[str, float]:
+        """
+        Return the words of titles close to ``word``, with their
+        similarity() to it.
+        """
+        candidates = set().union(
+            *(
+                self.title_word_trigrams.get(trigram, ())
+                for trigram in word_trigrams(word)
+            )
+        )
+        similar = {}
+        for candidate in candidates:
+            score = similarity(word, candidate)
+            if score > 0:
+                similar[candidate] = score
+        return similar
+
+    def search(
+        self, query: str, words: List[str], result: List[Tuple[bool, SearchIndexEntry]]
+    ):
+        """
+        Append to ``result`` the ``(exact, entry)`` pairs of the entries
+        matching ``query``, split into lower-case ``words``.
+        """
+        positions = set(self.title_candidates(words))
+        positions.update(self.operators.get(query, ()))
+        for position in sorted(positions):
+            entry = self.entries[position]
+            parent = entry.parent
+            if parent is not None and parent.hides_subsections(query, words):
+                continue
+            if entry.matches(words):
+                if entry.listed:
+                    exact = entry.exact_title and entry.item.title == query
+                    result.append((exact, entry))
+            elif entry.operator == query:
+                result.append((True, entry))
+
+
+def bm25_scores(
+    indexes: List[PartSearchIndex], words: Dict[str, float]
+) -> Dict[SearchIndexEntry, float]:
+    """
+    Return the BM25 score of each entry of ``indexes`` with any of
+    ``words`` in it; each word counts as much as its given weight.
+    """
+    count = sum(len(index.entries) for index in indexes)
+    if not count:
+        return {}
+    average_length = sum(index.total_length for index in indexes) / count
+    scores: Dict[SearchIndexEntry, float] = defaultdict(float)
+    for word, weight in words.items():
+        word_counts = [index.word_counts.get(word, {}) for index in indexes]
+        frequency = sum(len(counts) for counts in word_counts)
+        if not frequency:
+            continue
+        idf = math.log(1 + (count - frequency + 0.5) / (frequency + 0.5))
+        for index, counts in zip(indexes, word_counts):
+            for position, times in counts.items():
+                length_norm = (
+                    1 - BM25_B + BM25_B * index.lengths[position] / average_length
+                )
+                scores[index.entries[position]] += (
+                    weight
+                    * idf
+                    * times
+                    * (BM25_K1 + 1)
+                    / (times + BM25_K1 * length_norm)
+                )
+    return scores
+
+
+def misspelled_search(
+    indexes: List[PartSearchIndex], words: List[str]
+) -> List[Tuple[float, float, SearchIndexEntry]]:
+    """
+    Return the entries with words close to ``words`` in their titles or
+    texts, as ``(title score, text score, entry)`` triples. The title
+    score adds up, for each query word, the similarity of the closest
+    title word.
+    """
+    similar_words: Dict[str, float] = {}
+    title_scores: Dict[SearchIndexEntry, float] = defaultdict(float)
+    for word in words:
+        best_scores: Dict[SearchIndexEntry, float] = {}
+        for index in indexes:
+            for title_word, score in index.similar_title_words(word).items():
+                similar_words[title_word] = max(similar_words.get(title_word, 0), score)
+                for position in index.title_words[title_word]:
+                    entry = index.entries[position]
+                    best_scores[entry] = max(best_scores.get(entry, 0), score)
+        for entry, score in best_scores.items():
+            title_scores[entry] += score
+
+    text_scores = bm25_scores(indexes, similar_words)
+    found = []
+    items = set()
+    # Entries are gone over in order, so that equal scores keep it.
+    for index in indexes:
+        for entry in index.entries:
+            if not entry.listed or id(entry.item) in items:
+                continue
+            if entry in title_scores or entry in text_scores:
+                items.add(id(entry.item))
+                found.append(
+                    (title_scores.get(entry, 0), text_scores.get(entry, 0), entry)
+                )
+    return found
+
+
+def ranked_search(
+    indexes: List[PartSearchIndex], query: str, limit: Optional[int] = None
+) -> List[Tuple[bool, object]]:
+    """
+    Return the ``(exact, item)`` pairs of the documentation elements found
+    for ``query`` in ``indexes``, the indexes of the parts, best first.
+    At most ``limit`` are returned if it is given.
+
+    Elements whose titles have all the query words, or whose operator is
+    the query, come first, by how well their titles match and then by
+    BM25 score. If there are none, elements with words close to the
+    query words in their titles or texts are given instead.
+    """
+    query = query.strip()
+    words = [word.lower() for word in query.split()]
+
+    def name_compare_goodness(exact: bool, name: str) -> int:
+        if exact:
+            return -4 if name == query else -3
+
+        if name.startswith(query):
+            return -2
+        if query in name:
+            return -1
+        lower_name = name.lower()
+        if lower_name.startswith(query):
+            return 0
+        if lower_name in query:
+            return 1
+        return 2
+
+    def top(results: Iterable, key) -> list:
+        if limit is None:
+            return sorted(results, key=key)
+        return heapq.nsmallest(limit, results, key=key)
+
+    result: List[Tuple[bool, SearchIndexEntry]] = []
+    for index in indexes:
+        index.search(query, words, result)
+    if result:
+        scores = bm25_scores(indexes, {word: 1.0 for word in words})
+        ranked = top(
+            result,
+            key=lambda found: (
+                name_compare_goodness(found[0], found[1].item.title),
+                -scores.get(found[1], 0),
+            ),
+        )
+        return [(exact, entry.item) for exact, entry in ranked]
+
+    if not words:
+        return []
+    # Words of titles make better guesses than words of texts.
+    ranked = top(
+        misspelled_search(indexes, words),
+        key=lambda found: (-found[0], -found[1]),
+    )
+    return [(False, entry.item) for _, _, entry in ranked]
@@ -8,29 +8,50 @@ as a pipeline:
 1. Extracts tests and runs them from static mdoc files and docstrings from
    Mathics built-in functions
 2. Creates/updates internal documentation data
+
+With ``--jobs N``, the chapters of the documentation, or those given
+with ``--chapters``, are tested in N worker processes, each with its own
+definitions. The chapters are taken in the order of the documentation,
+and the data written is the same as that of a serial run taking them in
+that order, with the same PYTHONHASHSEED; some outputs depend on how
+strings hash. As in a serial run, there is no data for the sections from
+the first one that fails on.
 """
-import pickle
+import multiprocessing
+import os.path as osp
 import sys
+import tempfile
+import time
+from argparse import ArgumentParser
 from datetime import datetime
+from functools import partial
+from typing import Dict, List, Optional, Set, Tuple
 
-from mathics.core.load_builtin import import_and_load_builtins
-from mathics.doc.utils import open_ensure_dir
+from mathics.doc.utils import slugify
 from mathics.docpipeline import (
+    MAX_TESTS,
     DocTestPipeline,
     build_arg_parser,
+    create_output,
+    section_tests_iterator,
+    show_report,
     test_all,
     test_chapters,
+    test_section_in_chapter,
     test_sections,
     write_doctest_data,
 )
 from mathics.timing import show_lru_cache_statistics
 
-from mathics_django.settings import get_doctest_html_data_path
+from mathics_django.doc.doc_data import write_doctest_store
+from mathics_django.load_builtins import ensure_builtins_loaded
+from mathics_django.settings import get_doctest_html_store_path
 
 
 def save_doctest_data(output_data):
     """
-    Save doctest tests and test results to a Python PCL file.
+    Save doctest tests and test results to the store read by the
+    documentation; see mathics_django.doc.doc_data.
 
     ``output_data`` is a dictionary of test results. The key is a tuple
     of:
@@ -42,25 +63,203 @@ def save_doctest_data(output_data):
     * test number
     and the value is a dictionary of a Result.getdata() dictionary.
     """
-    doctest_html_data_path = get_doctest_html_data_path(
+    doctest_html_store_path = get_doctest_html_store_path(
         should_be_readable=False, create_parent=True
     )
-    print(f"Writing internal document data to {doctest_html_data_path}")
-    with open_ensure_dir(doctest_html_data_path, "wb") as output_file:
-        pickle.dump(output_data, output_file, 4)
+    print(f"Writing internal document data to {doctest_html_store_path}")
+    write_doctest_store(output_data, doctest_html_store_path)
+
+
+# The DocTestPipeline of a --jobs worker process; see init_worker().
+worker_pipeline: Optional[DocTestPipeline] = None
+
+
+def get_jobs() -> int:
+    """
+    Take ``--jobs N`` out of the command line, which is otherwise parsed
+    by Mathics3, and return N.
+    """
+    parser = ArgumentParser(add_help=False, allow_abbrev=False)
+    parser.add_argument("--jobs", "-j", type=int, default=1)
+    jobs_args, sys.argv[1:] = parser.parse_known_args()
+    return max(jobs_args.jobs, 1)
+
+
+def init_worker(args):
+    """
+    Set up a --jobs worker process, with a DocTestPipeline, and so
+    definitions, of its own.
+    """
+    global worker_pipeline
+    if worker_pipeline is None:
+        # Started with "spawn", so nothing was inherited.
+        ensure_builtins_loaded()
+        args.logfilename = None
+        worker_pipeline = DocTestPipeline(args, output_format="xml")
+    # Only the main process writes to the log file.
+    worker_pipeline.logfile = None
+
+
+def test_chapter(
+    position: Tuple[int, int], excludes: Set[str], with_output: bool
+) -> dict:
+    """
+    Run, in a --jobs worker, the tests of the chapter at ``position``, a
+    part and chapter index in the documentation, leaving out the sections
+    in ``excludes``. With ``with_output``, the output of the tests of the
+    sections before the first that fails is made for the documentation;
+    as in a serial run, sections after it are tested with --keep-going,
+    but get no output.
+    """
+    test_pipeline = worker_pipeline
+    test_status = test_pipeline.status
+    keep_going = test_pipeline.parameters.keep_going
+    part_index, chapter_index = position
+    part = test_pipeline.documentation.parts[part_index]
+    chapter = part.chapters[chapter_index]
+
+    start_time = time.perf_counter()
+    total, failed = test_status.total, test_status.failed
+    failed_sections = set(test_status.failed_sections)
+    test_pipeline.output_data = {}
+    # Results do not depend on which chapters the worker tested before.
+    test_pipeline.reset_user_definitions()
+    for section in chapter.all_sections:
+        if section.title in excludes:
+            continue
+        test_section_in_chapter(test_pipeline, section, exclude_sections=excludes)
+        chapter_failed = test_status.failed > failed
+        if chapter_failed and not keep_going:
+            break
+        if with_output and not chapter_failed:
+            create_output(
+                test_pipeline,
+                section_tests_iterator(
+                    section, test_pipeline, exclude_sections=excludes
+                ),
+            )
+
+    return {
+        "position": position,
+        "title": f"{part.title} / {chapter.title}",
+        "output_data": test_pipeline.output_data,
+        "total": test_status.total - total,
+        "failed": test_status.failed - failed,
+        "failed_sections": test_status.failed_sections - failed_sections,
+        "elapsed": time.perf_counter() - start_time,
+    }
+
+
+def get_chapter_positions(
+    test_pipeline: DocTestPipeline, include_chapters: Optional[Set[str]]
+) -> List[Tuple[int, int]]:
+    """
+    Return the part and chapter index of each chapter to test, in the
+    order of the documentation: all of them, or those whose title is in
+    ``include_chapters``.
+    """
+    include_slugs = (
+        None
+        if include_chapters is None
+        else {slugify(title) for title in include_chapters}
+    )
+    return [
+        (part_index, chapter_index)
+        for part_index, part in enumerate(test_pipeline.documentation.parts)
+        for chapter_index, chapter in enumerate(part.chapters)
+        if include_slugs is None or chapter.slug in include_slugs
+    ]
+
+
+def test_chapters_in_parallel(
+    test_pipeline: DocTestPipeline,
+    args,
+    jobs: int,
+    include_chapters: Optional[Set[str]],
+    excludes: Set[str],
+    with_output: bool,
+):
+    """
+    Run the tests of the chapters in ``jobs`` worker processes, adding
+    up their counts in the status of ``test_pipeline``. The output of
+    the tests, if made, is gathered in its ``output_data``, in the order
+    of the documentation. As in a serial run, there is none for the
+    sections from the first that fails on, in that order, so that it is
+    the same whatever ``jobs`` is.
+    """
+    test_status = test_pipeline.status
+    positions = get_chapter_positions(test_pipeline, include_chapters)
+    print(f"Testing {len(positions)} chapters in {jobs} processes")
+
+    results: Dict[Tuple[int, int], dict] = {}
+    # Forked workers start with a copy of test_pipeline, which saves each
+    # of them loading the builtins and building the documentation again.
+    # Elsewhere, they build their own.
+    global worker_pipeline
+    worker_pipeline = test_pipeline
+    context = multiprocessing.get_context(
+        "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+    )
+    with context.Pool(jobs, initializer=init_worker, initargs=(args,)) as pool:
+        for result in pool.imap_unordered(
+            partial(test_chapter, excludes=excludes, with_output=with_output),
+            positions,
+        ):
+            results[result["position"]] = result
+            test_status.total += result["total"]
+            test_status.failed += result["failed"]
+            test_status.failed_sections.update(result["failed_sections"])
+            # The time of each chapter is shown, even with --quiet.
+            print(
+                f"[{len(results)}/{len(positions)}] {result['title']}: "
+                f"{result['total']} tests, {result['failed']} failed, "
+                f"{result['elapsed']:.2f}s"
+            )
+            if result["failed"] and not test_pipeline.parameters.keep_going:
+                # Leaving the block stops the other workers.
+                break
+
+    output_data: Dict[tuple, dict] = {}
+    for position in positions:
+        if position not in results:
+            continue
+        output_data.update(results[position]["output_data"])
+        if results[position]["failed"]:
+            # Workers only know the failures of their own chapter.
+            break
+    test_pipeline.output_data = output_data
+    show_report(test_pipeline)
 
 
 def main():
+    jobs = get_jobs()
     args = build_arg_parser()
+    if jobs > 1 and (
+        args.sections or args.doc_only or args.skip or args.count != MAX_TESTS
+    ):
+        sys.exit("--jobs can't be used with --sections, --doc-only, --skip or --count")
+
+    # Mathics3 saves the data, when the tests allow it, as a pickle at
+    # data_path. That is only kept until it is saved to the store, which
+    # is what the documentation reads.
+    data_dir = tempfile.TemporaryDirectory() if args.output and jobs == 1 else None
     data_path = (
-        get_doctest_html_data_path(should_be_readable=False, create_parent=True)
-        if args.output
-        else None
+        osp.join(data_dir.name, "doc_html_data.pcl") if data_dir is not None else None
     )
     test_pipeline = DocTestPipeline(args, output_format="xml", data_path=data_path)
     test_status = test_pipeline.status
+    start_time = None
 
-    if args.sections:
+    if jobs > 1:
+        include_chapters = set(args.chapters.split(",")) if args.chapters else None
+        excludes = set(args.exclude.split(","))
+        start_time = datetime.now()
+        test_chapters_in_parallel(
+            test_pipeline, args, jobs, include_chapters, excludes, args.output
+        )
+        if args.output and (test_status.failed == 0 or args.keep_going):
+            save_doctest_data(test_pipeline.output_data)
+    elif args.sections:
         include_sections = set(args.sections.split(","))
         exclude_subsections = set(args.exclude.split(","))
         start_time = datetime.now()
@@ -81,6 +280,11 @@ def main():
     if test_status.total > 0 and start_time is not None:
         print("Test evaluation took ", datetime.now() - start_time)
 
+    if data_dir is not None:
+        if osp.exists(data_path):
+            save_doctest_data(test_pipeline.output_data)
+        data_dir.cleanup()
+
     if test_pipeline.logfile:
         test_pipeline.logfile.close()
     if args.show_statistics:
@@ -94,5 +298,5 @@ def main():
 
 
 if __name__ == "__main__":
-    import_and_load_builtins()
+    ensure_builtins_loaded()
     main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Renders every documentation page, in both the standalone and the ajax
+form, into a tree of static files, so that they are served without
+being rendered for each request. See DOC_STATIC_DIR in
+mathics_django.settings.
+
+The pages of Mathics3 modules are left out, since which modules are
+loaded changes while the server runs.
+
+Run this again after upgrading Mathics3 or Mathics3 Django, or after
+creating doctest data with docpipeline.py. Until then, the documentation
+views render pages again instead of using the tree.
+"""
+
+import argparse
+import os
+import os.path as osp
+import shutil
+import sys
+from datetime import datetime
+
+
+def get_pages(documentation, skip_part_slug: str) -> list:
+    """
+    Return the slugs of each documentation page, from the overview, with
+    none, down to subsections.
+    """
+    pages = [[]]
+    for part in documentation.parts:
+        if part.slug == skip_part_slug:
+            continue
+        pages.append([part.slug])
+        for chapter in part.chapters:
+            pages.append([part.slug, chapter.slug])
+            for section in chapter.all_sections:
+                pages.append([part.slug, chapter.slug, section.slug])
+                for subsection in section.subsections:
+                    pages.append(
+                        [part.slug, chapter.slug, section.slug, subsection.slug]
+                    )
+    # Guide sections can be listed twice.
+    unique_pages = {tuple(page): page for page in pages}
+    return list(unique_pages.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument(
+        "--output",
+        "-o",
+        help="directory to write the pages to, instead of DOC_STATIC_DIR",
+    )
+    args = parser.parse_args()
+    if args.output:
+        os.environ["MATHICS3_DJANGO_DOC_STATIC_DIR"] = osp.abspath(args.output)
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mathics_django.settings")
+
+    import django
+
+    django.setup()
+
+    from django.conf import settings
+    from django.test import RequestFactory
+
+    from mathics_django.doc import documentation
+    from mathics_django.web.controllers.doc import (
+        MATHICS3_MODULES_SLUG,
+        STATIC_DOC_VERSION_FILE,
+        doc,
+        doc_chapter,
+        doc_part,
+        doc_section,
+        doc_subsection,
+        get_doc_cache_version,
+        static_doc_path,
+    )
+
+    # Views by the number of slugs they take; the undecorated ones, so
+    # that pages are rendered rather than taken from a cache or the tree.
+    views = [
+        view.__wrapped__
+        for view in (doc, doc_part, doc_chapter, doc_section, doc_subsection)
+    ]
+
+    output_dir = settings.DOC_STATIC_DIR
+    version_path = osp.join(output_dir, STATIC_DOC_VERSION_FILE)
+    print(f"Writing documentation pages to {output_dir}")
+    # Without its version, the tree is not used while it is being built.
+    if osp.exists(version_path):
+        os.unlink(version_path)
+    for ajax in (False, True):
+        pages_dir = osp.dirname(static_doc_path([], ajax))
+        shutil.rmtree(pages_dir, ignore_errors=True)
+
+    start_time = datetime.now()
+    request_factory = RequestFactory()
+    pages = get_pages(documentation, MATHICS3_MODULES_SLUG)
+    failed = 0
+    for page in pages:
+        for ajax in (False, True):
+            uri = "/".join(["ajax/doc" if ajax else "doc", *page]) + "/"
+            try:
+                response = views[len(page)](
+                    request_factory.get(f"{settings.BASE_URL}/{uri}"),
+                    *page,
+                    ajax=ajax,
+                )
+            except Exception as exc:
+                print(f"Failed to render {uri}: {exc}")
+                failed += 1
+                continue
+            path = static_doc_path(page, ajax)
+            os.makedirs(osp.dirname(path), exist_ok=True)
+            with open(path, "wb") as page_file:
+                page_file.write(response.content)
+
+    with open(version_path, "w") as version_file:
+        version_file.write(get_doc_cache_version() + "\n")
+
+    print(
+        f"{2 * len(pages) - failed} pages written in {datetime.now() - start_time}"
+        + (f"; {failed} failed" if failed else "")
+    )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+Loading the Mathics3 builtins once per process.
+
+``import_and_load_builtins()`` returns straight away once it has started
+loading, even while another thread is still at it. Threads that need the
+builtins, such as the one building the documentation and the one
+building the session template definitions, go through
+``ensure_builtins_loaded()`` instead, which waits for the loading to be
+done.
+"""
+
+import threading
+
+from mathics.core.load_builtin import import_and_load_builtins
+
+_builtins_loaded = False
+_builtins_lock = threading.Lock()
+
+
+def ensure_builtins_loaded():
+    """
+    Load the Mathics3 builtins unless they are loaded, returning once
+    they are, whichever thread loads them.
+    """
+    global _builtins_loaded
+    if not _builtins_loaded:
+        with _builtins_lock:
+            if not _builtins_loaded:
+                import_and_load_builtins()
+                _builtins_loaded = True
@@ -65,6 +65,111 @@ LOG_QUERIES = False
 # * results
 LOG_ON_CONSOLE = get_bool_from_environment("MATHICS3_DJANGO_LOG_ON_CONSOLE", "false")
 
+# Limits on the number of per-session Mathics3 evaluations kept in memory.
+# MAX_SESSIONS is the largest number of sessions kept at once; the
+# least-recently used session is dropped when it is exceeded.
+# SESSION_IDLE_TIMEOUT is the number of seconds a session can go unused
+# before it is dropped.
+# MEMORY_HIGH_WATER_MB is a process size in megabytes; above that
+# sessions are dropped oldest first.
+# For all of these, 0 means no limit.
+MAX_SESSIONS = int(os.environ.get("MATHICS3_DJANGO_MAX_SESSIONS", "100"))
+SESSION_IDLE_TIMEOUT = float(
+    os.environ.get("MATHICS3_DJANGO_SESSION_IDLE_TIMEOUT", "3600")
+)
+MEMORY_HIGH_WATER_MB = int(os.environ.get("MATHICS3_DJANGO_MEMORY_HIGH_WATER_MB", "0"))
+
+# Where worksheet cells are evaluated:
+# "inline" evaluates in the thread of the web server handling the request;
+# "process" evaluates in a pool of EVALUATION_WORKERS worker processes,
+# each owning the evaluations of the sessions assigned to it.
+# See mathics_django.web.backends.
+EVALUATION_BACKEND = os.environ.get("MATHICS3_DJANGO_EVALUATION_BACKEND", "inline")
+EVALUATION_WORKERS = int(
+    os.environ.get("MATHICS3_DJANGO_EVALUATION_WORKERS", str(os.cpu_count() or 1))
+)
+
+# When queries are handled asynchronously, under ASGI, they are evaluated
+# in a pool of QUERY_THREADS threads, so that the server can go on with
+# other requests meanwhile. When MAX_PENDING_QUERIES queries are already
+# running or waiting for a thread, further ones get a "busy" reply;
+# 0 means no limit.
+# A query only has a thread once its session's turn has come, and with
+# the "process" backend a worker evaluates for several sessions at once,
+# so the default does not depend on EVALUATION_WORKERS; it is that of
+# Python's ThreadPoolExecutor.
+QUERY_THREADS = int(
+    os.environ.get(
+        "MATHICS3_DJANGO_QUERY_THREADS", str(min(32, (os.cpu_count() or 1) + 4))
+    )
+)
+MAX_PENDING_QUERIES = int(os.environ.get("MATHICS3_DJANGO_MAX_PENDING_QUERIES", "0"))
+
+# The requests of a session are evaluated one at a time, in the order they
+# arrive. SESSION_QUEUE_DEPTH is how many of them may be running or
+# waiting; further ones get a "busy" reply. 0 means no limit.
+SESSION_QUEUE_DEPTH = int(os.environ.get("MATHICS3_DJANGO_SESSION_QUEUE_DEPTH", "4"))
+
+# QUERY_TIMEOUT is the number of seconds a worksheet cell may run before
+# it is aborted; 0 means no limit.
+# With the "process" evaluation backend, a worker whose query is still
+# running ABORT_GRACE seconds after being timed out or aborted is killed
+# and restarted.
+QUERY_TIMEOUT = float(os.environ.get("MATHICS3_DJANGO_QUERY_TIMEOUT", "0"))
+ABORT_GRACE = float(os.environ.get("MATHICS3_DJANGO_ABORT_GRACE", "5"))
+
+# The number of formatted results, MathML and so on, kept in each process
+# so that formatting the same expression again is skipped; 0 turns this off.
+FORMAT_CACHE_SIZE = int(os.environ.get("MATHICS3_DJANGO_FORMAT_CACHE_SIZE", "1000"))
+
+# A result with more than OUTPUT_PREVIEW_LEAVES atoms, or whose formatted
+# output is longer than OUTPUT_PREVIEW_BYTES, is shown as a preview
+# leaving elements out, like Short[]; the rest is fetched on demand.
+# 0 means no limit.
+OUTPUT_PREVIEW_LEAVES = int(
+    os.environ.get("MATHICS3_DJANGO_OUTPUT_PREVIEW_LEAVES", "2000")
+)
+OUTPUT_PREVIEW_BYTES = int(
+    os.environ.get("MATHICS3_DJANGO_OUTPUT_PREVIEW_BYTES", "1000000")
+)
+
+# Pictures of Graphics and scenes of Graphics3D results bigger than
+# GRAPHICS_INLINE_BYTES are saved under MEDIA_ROOT and fetched by the
+# browser apart from the query response; 0 sends them all inline.
+# Beyond GRAPHICS_CACHE_MB megabytes of them, the least recently used
+# ones are removed; 0 means no limit.
+# See mathics_django.web.graphics_cache.
+GRAPHICS_INLINE_BYTES = int(
+    os.environ.get("MATHICS3_DJANGO_GRAPHICS_INLINE_BYTES", "16384")
+)
+GRAPHICS_CACHE_MB = int(os.environ.get("MATHICS3_DJANGO_GRAPHICS_CACHE_MB", "512"))
+
+# Rendered documentation pages are kept in the "doc" cache until the
+# documentation changes. They are kept in memory, or in files under
+# DOC_CACHE_DIR, if that is set, so that they are shared by processes and
+# outlive restarts. See mathics_django.web.controllers.doc.
+DOC_CACHE_DIR = os.environ.get("MATHICS3_DJANGO_DOC_CACHE_DIR", "")
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "doc": {
+        "BACKEND": (
+            "django.core.cache.backends.filebased.FileBasedCache"
+            if DOC_CACHE_DIR
+            else "django.core.cache.backends.locmem.LocMemCache"
+        ),
+        "LOCATION": DOC_CACHE_DIR or "mathics3-doc",
+        "TIMEOUT": None,
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    },
+}
+
+# The documentation is built on first use, which takes seconds. With
+# DOC_WARMUP, it is built ahead of that, in the background. See
+# mathics_django.doc.
+DOC_WARMUP = get_bool_from_environment("MATHICS3_DJANGO_DOC_WARMUP", "true")
+
 MATHICS3_DJANGO_DB = os.environ.get("MATHICS3_DJANGO_DB", "mathics3.sqlite")
 MATHICS3_DJANGO_DB_PATH = os.environ.get(
     "MATHICS3_DJANGO_DB_PATH", DATA_DIR + MATHICS3_DJANGO_DB
@@ -79,43 +184,61 @@ MATHICS3_BACKEND_THREEJS_JSON_PATH = os.path.join(
 
 REQUIRE_LOGIN = False
 
-# Location of internal document data. Currently this is in Python
-# Pickle form, but storing this in JSON if possible would be
-# preferable and faster
+
+def get_store_path_from_environment(env_var: str, old_env_var: str, default_value: str):
+    """
+    Read the path of a doctest store from environment variable
+    ``env_var``. Before the outputs were kept in a store, they were
+    kept in a pickle, whose path was set with ``old_env_var``; if only
+    that is set, the store is the ".sqlite" file next to that pickle.
+    """
+    if env_var in os.environ:
+        return os.environ[env_var]
+    if old_env_var in os.environ:
+        return osp.splitext(os.environ[old_env_var])[0] + ".sqlite"
+    return default_value
+
+
+# Location of internal document data: the doctest outputs shown in the
+# documentation, in an SQLite store; see mathics_django.doc.doc_data.
 
 # We need two versions, one in the user space which is updated with
 # local packages installed and is user writable.
-DOCTEST_USER_HTML_DATA_PATH = os.environ.get(
-    "DOCTEST_USER_HTML_DATA_PATH", osp.join(DATA_DIR, "doc_html_data.pcl")
+DOCTEST_USER_HTML_STORE_PATH = get_store_path_from_environment(
+    "DOCTEST_USER_HTML_STORE_PATH",
+    "DOCTEST_USER_HTML_DATA_PATH",
+    osp.join(DATA_DIR, "doc_html_data.sqlite"),
 )
 
 # We need another version as a fallback, and that is distributed with the
 # package. It is not user writable and not in the user space.
-DOC_SYSTEM_HTML_DATA_PATH = os.environ.get(
-    "DOC_SYSTEM_HTML_DATA_PATH", osp.join(ROOT_DIR, "doc", "doc_html_data.pcl")
+DOC_SYSTEM_HTML_STORE_PATH = get_store_path_from_environment(
+    "DOC_SYSTEM_HTML_STORE_PATH",
+    "DOC_SYSTEM_HTML_DATA_PATH",
+    osp.join(ROOT_DIR, "doc", "doc_html_data.sqlite"),
 )
 
 
-def get_doctest_html_data_path(should_be_readable=False, create_parent=False) -> str:
-    """Returns a string path where we can find Python Pickle data for HTML
+def get_doctest_html_store_path(should_be_readable=False, create_parent=False) -> str:
+    """Returns a string path where we can find the doctest store for HTML
     processing.
 
     If `should_be_readable` is True, the we will check to see whether this file is
-    readable (which also means it exists). If not, we'll return the `DOC_SYSTEM_DATA_PATH`.
+    readable (which also means it exists). If not, we'll return the
+    `DOC_SYSTEM_HTML_STORE_PATH`.
     """
-    doc_user_html_data_path = Path(DOCTEST_USER_HTML_DATA_PATH)
-    base_config_dir = doc_user_html_data_path.parent
-    if not base_config_dir.is_dir() and create_parent:
-        Path("base_config_dir").mkdir(parents=True, exist_ok=True)
+    doc_user_html_store_path = Path(DOCTEST_USER_HTML_STORE_PATH)
+    if create_parent:
+        doc_user_html_store_path.parent.mkdir(parents=True, exist_ok=True)
 
     if should_be_readable:
         return (
-            DOCTEST_USER_HTML_DATA_PATH
-            if doc_user_html_data_path.is_file()
-            else DOC_SYSTEM_HTML_DATA_PATH
+            DOCTEST_USER_HTML_STORE_PATH
+            if doc_user_html_store_path.is_file()
+            else DOC_SYSTEM_HTML_STORE_PATH
         )
     else:
-        return DOCTEST_USER_HTML_DATA_PATH
+        return DOCTEST_USER_HTML_STORE_PATH
 
 
 #########################################################
@@ -164,7 +287,15 @@ LANGUAGE_CODE = "en-us"
 # )
 
 # --- Media Files (Generated Mathics3 assets) ---
-MEDIA_ROOT = osp.join(ROOT_DIR, "media")
+MEDIA_ROOT = os.environ.get("MATHICS3_DJANGO_MEDIA_ROOT", osp.join(ROOT_DIR, "media"))
+
+# Documentation pages pre-rendered by mathics_django/docstatic.py. The
+# documentation views serve a page from here instead of rendering it, as
+# long as the tree was built for the current documentation. The tree is
+# not served as static files, which would skip that check.
+DOC_STATIC_DIR = os.environ.get(
+    "MATHICS3_DJANGO_DOC_STATIC_DIR", osp.join(MEDIA_ROOT, "doc")
+)
 
 MIDDLEWARE = [
     "django.middleware.common.CommonMiddleware",
@@ -1,5 +1,11 @@
 # pages/tests.py
-from django.test import SimpleTestCase
+import asyncio
+import json
+import os
+import threading
+import time
+
+from django.test import SimpleTestCase, override_settings
 
 
 class HomePageTests(SimpleTestCase):
@@ -10,3 +16,1165 @@ class HomePageTests(SimpleTestCase):
     def test_home_page_does_not_contain_incorrect_html(self):
         response = self.client.get("/")
         self.assertNotContains(response, "Hi there! I should not be on the page.")
+
+
+# Sessions are kept in the cache, so that these need no database.
+@override_settings(SESSION_ENGINE="django.contrib.sessions.backends.cache")
+class AboutPageTests(SimpleTestCase):
+    def test_system_info_is_read_once(self):
+        from unittest import mock
+
+        from mathics_django.web import evaluation
+        from mathics_django.web.controllers import about
+
+        with (
+            mock.patch.object(about, "mathics_system_info_data", {}),
+            mock.patch.object(
+                evaluation, "mathics_system_info", wraps=evaluation.mathics_system_info
+            ) as mathics_system_info,
+        ):
+            for _ in range(2):
+                response = self.client.get("/about")
+                self.assertEqual(response.status_code, 200)
+            self.assertEqual(mathics_system_info.call_count, 1)
+            self.assertContains(response, about.mathics_system_info_data["$UserName"])
+
+
+class SessionEvaluationPoolTests(SimpleTestCase):
+    def make_pool(self, **kwargs):
+        from mathics_django.web.evaluation_pool import SessionEvaluationPool
+
+        return SessionEvaluationPool(lambda session_key: object(), **kwargs)
+
+    def test_hits_and_misses(self):
+        pool = self.make_pool(max_size=2)
+        first = pool.get("a")
+        self.assertIs(pool.get("a"), first)
+        self.assertIsNone(pool.get("b", create=False))
+        stats = pool.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+    def test_least_recently_used_is_evicted(self):
+        pool = self.make_pool(max_size=2)
+        pool.get("a")
+        pool.get("b")
+        pool.get("a")
+        pool.get("c")
+        self.assertIn("a", pool)
+        self.assertNotIn("b", pool)
+        self.assertEqual(pool.stats()["evictions"], 1)
+
+    def test_idle_sessions_expire(self):
+        pool = self.make_pool(idle_timeout=0.01)
+        pool.get("a")
+        time.sleep(0.02)
+        self.assertEqual(pool.expire_idle(), 1)
+        self.assertEqual(len(pool), 0)
+
+
+class SessionQueuesTests(SimpleTestCase):
+    def test_turns_are_taken_in_arrival_order(self):
+        from mathics_django.web.session_queue import SessionQueues
+
+        queues = SessionQueues()
+        order = []
+
+        def request(number):
+            with queues.turn("a"):
+                order.append(number)
+
+        with queues.turn("a"):
+            threads = []
+            for number in range(3):
+                thread = threading.Thread(target=request, args=(number,))
+                thread.start()
+                threads.append(thread)
+                while queues.depth("a") < number + 2:
+                    time.sleep(0.001)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, [0, 1, 2])
+        self.assertEqual(queues.depth("a"), 0)
+
+    def test_full_queue_is_busy(self):
+        from mathics_django.web.session_queue import SessionBusy, SessionQueues
+
+        queues = SessionQueues(max_depth=1)
+        with queues.turn("a"):
+            with self.assertRaises(SessionBusy):
+                with queues.turn("a"):
+                    pass
+            with queues.turn("b"):
+                pass
+
+    def test_cancelled_wait_gives_up_its_place(self):
+        from mathics_django.web.session_queue import SessionQueues
+
+        queues = SessionQueues()
+
+        async def scenario():
+            first = queues.enter("a")
+            await first.wait_async()
+            waiting = asyncio.ensure_future(queues.enter("a").wait_async())
+            await asyncio.sleep(0)
+            waiting.cancel()
+            third = queues.enter("a")
+            first.release()
+            await asyncio.wait_for(third.wait_async(), 1)
+            third.release()
+
+        asyncio.run(scenario())
+        self.assertEqual(queues.depth("a"), 0)
+
+    def test_waiting_for_turn_holds_no_thread(self):
+        from mathics_django.web.backends import InlineEvaluationBackend
+        from mathics_django.web.query_executor import QueryExecutor
+
+        backend = InlineEvaluationBackend(max_sessions=4)
+        executor = QueryExecutor(threads=2)
+
+        async def query(session_key, input):
+            turn = await backend.wait_for_turn(session_key)
+            return await executor.run(
+                lambda: list(backend.iter_query(session_key, input, turn=turn))
+            )
+
+        async def scenario():
+            slow = asyncio.ensure_future(query("a", "Pause[1]; 1"))
+            # Waits for the turn of "a", but not in the second thread.
+            queued = asyncio.ensure_future(query("a", "2"))
+            await asyncio.sleep(0.2)
+            start = time.monotonic()
+            await query("b", "3")
+            elapsed = time.monotonic() - start
+            await asyncio.gather(slow, queued)
+            return elapsed
+
+        self.assertLess(asyncio.run(scenario()), 0.5)
+
+
+class SessionDefinitionsTests(SimpleTestCase):
+    def test_clones_do_not_share_user_definitions(self):
+        from mathics_django.web.evaluation import new_session_evaluation
+
+        first = new_session_evaluation("first")
+        second = new_session_evaluation("second")
+        first.parse_evaluate("Unprotect[Sin]; Sin[1] = 7")
+        self.assertEqual(first.parse_evaluate("Sin[1]").last_eval.value, 7)
+        self.assertNotEqual(
+            second.parse_evaluate("Sin[1]").last_eval.get_head_name(), "System`Integer"
+        )
+
+
+class QueryTimeoutTests(SimpleTestCase):
+    def test_timed_out_query_is_aborted(self):
+        from mathics_django.web.evaluation import evaluate_query, new_session_evaluation
+
+        evaluation = new_session_evaluation("timeout")
+        results = list(evaluate_query(evaluation, "While[True]; 1\n2", timeout=0.5))
+        self.assertEqual([data["result"] for data in results], ["$Aborted"])
+        results = list(evaluate_query(evaluation, "3"))
+        self.assertEqual(len(results), 1)
+        self.assertNotEqual(results[0]["result"], "$Aborted")
+
+    def test_abort_without_query_in_progress(self):
+        from mathics_django.web.backends import InlineEvaluationBackend
+
+        backend = InlineEvaluationBackend(max_sessions=2)
+        backend.query("a", "1")
+        self.assertFalse(backend.abort("a"))
+        self.assertNotIn("a", backend.aborted_sessions)
+        (data,) = backend.query("a", "2")
+        self.assertNotEqual(data["result"], "$Aborted")
+
+
+class ProcessEvaluationBackendTests(SimpleTestCase):
+    def make_backend(self, max_sessions):
+        from mathics_django.web.backends import ProcessEvaluationBackend
+
+        backend = ProcessEvaluationBackend(workers=1, max_sessions=max_sessions)
+        self.addCleanup(backend.shutdown)
+        return backend
+
+    def test_evicted_sessions_are_forgotten(self):
+        backend = self.make_backend(max_sessions=1)
+        backend.query("a", "1")
+        self.assertTrue(backend.has_session("a"))
+        backend.query("b", "2")
+        # The worker says it dropped "a" after answering the query of "b".
+        deadline = time.monotonic() + 5
+        while backend.has_session("a") and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(backend.has_session("a"))
+        self.assertTrue(backend.has_session("b"))
+
+    def test_system_info_is_read_by_a_worker(self):
+        from mathics_django.web.evaluation import get_system_info
+
+        backend = self.make_backend(max_sessions=1)
+        system_info = backend.get_system_info()
+        self.assertEqual(system_info["$UserName"], get_system_info()["$UserName"])
+        # $ProcessID is that of the parent process, here this one.
+        self.assertEqual(system_info["$ProcessID"], os.getpid())
+
+    def test_sessions_of_one_worker_run_alongside(self):
+        backend = self.make_backend(max_sessions=2)
+        backend.query("b", "1")
+        (worker,) = backend.workers
+        slow_results = []
+        slow = threading.Thread(
+            target=lambda: slow_results.extend(backend.query("a", "Pause[3]; 1"))
+        )
+        slow.start()
+        while not worker.pending:
+            time.sleep(0.01)
+        start = time.monotonic()
+        (data,) = backend.query("b", "1 + 1")
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertIn("<mn>2</mn>", data["result"])
+        self.assertTrue(slow.is_alive())
+        slow.join()
+        self.assertIn("<mn>1</mn>", slow_results[-1]["result"])
+
+    def test_abort_before_worker_is_ready(self):
+        backend = self.make_backend(max_sessions=2)
+        (worker,) = backend.workers
+        results = []
+        query = threading.Thread(
+            target=lambda: results.extend(backend.query("a", "While[True]; 1"))
+        )
+        query.start()
+        # The worker takes seconds to load, so the query waits for it.
+        while not worker.pending:
+            time.sleep(0.01)
+        self.assertTrue(backend.abort("a"))
+        query.join()
+        self.assertEqual([data["result"] for data in results], ["$Aborted"])
+
+
+def wait_until(condition, timeout=10) -> bool:
+    """Wait until ``condition()`` is true; return False if it never was."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+# Sessions are kept in the cache, so that these need no database.
+@override_settings(SESSION_ENGINE="django.contrib.sessions.backends.cache")
+class QueryViewTests(SimpleTestCase):
+    def use_query_executor(self, **kwargs):
+        from unittest import mock
+
+        from mathics_django.web.query_executor import QueryExecutor
+
+        executor = QueryExecutor(**kwargs)
+        patcher = mock.patch(
+            "mathics_django.web.views.get_query_executor", return_value=executor
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return executor
+
+    def post(self, path, data, client=None):
+        response = (client or self.client).post(path, data)
+        if response.streaming:
+            lines = b"".join(response.streaming_content).splitlines()
+            return response.status_code, [json.loads(line) for line in lines]
+        return response.status_code, json.loads(response.content)
+
+    def test_busy_once_max_pending_is_reached(self):
+        from django.test import Client
+
+        executor = self.use_query_executor(threads=1, max_pending=1)
+        slow = threading.Thread(
+            target=self.post, args=("/ajax/query/", {"query": "Pause[1]"}, Client())
+        )
+        slow.start()
+        self.assertTrue(wait_until(lambda: executor.pending))
+        status, response = self.post("/ajax/query/", {"query": "1 + 1"})
+        self.assertEqual(status, 503)
+        (data,) = response["results"]
+        self.assertEqual(data["out"][0]["prefix"], "General::busy")
+        slow.join()
+        status, response = self.post("/ajax/query/", {"query": "1 + 1"})
+        self.assertEqual(status, 200)
+        self.assertIn("<mn>2</mn>", response["results"][0]["result"])
+
+    def test_streamed_results_are_admitted_too(self):
+        from django.test import Client
+
+        # The test client is a WSGI client: results are streamed from the
+        # thread reading the response, not from the executor's.
+        executor = self.use_query_executor(threads=1, max_pending=1)
+        stream = {"query": "Pause[1]; 1\n2", "stream": "1"}
+        slow_results = []
+        slow = threading.Thread(
+            target=lambda: slow_results.extend(
+                self.post("/ajax/query/", stream, Client())[1]
+            )
+        )
+        slow.start()
+        self.assertTrue(wait_until(lambda: executor.pending))
+        status, items = self.post("/ajax/query/", {"query": "3", "stream": "1"})
+        self.assertEqual(status, 503)
+        self.assertEqual([data["out"][0]["tag"] for data in items], ["busy"])
+        slow.join()
+        self.assertEqual(len(slow_results), 2)
+        self.assertEqual(executor.pending, 0)
+
+        status, items = self.post("/ajax/query/", {"query": "3", "stream": "1"})
+        self.assertEqual(status, 200)
+        self.assertIn("<mn>3</mn>", items[0]["result"])
+        self.assertEqual(executor.pending, 0)
+
+    def test_batch_results_are_in_cell_order(self):
+        cells = json.dumps(
+            [
+                {"id": 3, "query": "a = 5"},
+                {"id": "two", "query": "1 +* "},
+                {"id": 1, "query": "a + 1"},
+            ]
+        )
+        status, response = self.post("/ajax/query/batch/", {"cells": cells})
+        self.assertEqual(status, 200)
+        results = response["results"]
+        self.assertEqual([cell["id"] for cell in results], [3, "two", 1])
+        # The cell that fails does not stop the ones after it.
+        self.assertEqual(results[1]["results"][0]["form"], "Syntax Error")
+        self.assertIn("<mn>6</mn>", results[2]["results"][0]["result"])
+
+        status, items = self.post("/ajax/query/batch/", {"cells": cells, "stream": "1"})
+        self.assertEqual(status, 200)
+        self.assertEqual([item["id"] for item in items], [3, "two", 1])
+
+    def test_batch_is_busy_for_each_cell(self):
+        executor = self.use_query_executor(threads=1, max_pending=1)
+        # Stands for a query running or waiting for a thread.
+        executor.reserve()
+        cells = json.dumps([{"id": 1, "query": "1"}, {"id": 2, "query": "2"}])
+        status, response = self.post("/ajax/query/batch/", {"cells": cells})
+        self.assertEqual(status, 503)
+        self.assertEqual(
+            [
+                (cell["id"], [data["out"][0]["tag"] for data in cell["results"]])
+                for cell in response["results"]
+            ],
+            [(1, ["busy"]), (2, ["busy"])],
+        )
+
+    def test_aborted_cell_skips_the_rest(self):
+        from mathics_django.web.backends import InlineEvaluationBackend
+
+        backend = InlineEvaluationBackend(max_sessions=2)
+        cells = [(1, "x = 1"), (2, "While[True]"), (3, "x + 1")]
+        results = []
+        batch = threading.Thread(
+            target=lambda: results.extend(backend.iter_cells("a", cells))
+        )
+        batch.start()
+        self.assertTrue(wait_until(lambda: "a" in backend.running))
+        time.sleep(0.2)
+        self.assertTrue(backend.abort("a"))
+        batch.join()
+        self.assertEqual(
+            [(cell_id, data["result"]) for cell_id, data in results][1:],
+            [(2, "$Aborted")],
+        )
+
+
+@override_settings(
+    SESSION_ENGINE="django.contrib.sessions.backends.cache",
+    ALLOWED_HOSTS=["localhost"],
+    CSRF_TRUSTED_ORIGINS=["https://*.example.org"],
+)
+class WebSocketHandshakeTests(SimpleTestCase):
+    def handshake(self, origin=None) -> str:
+        """
+        Open and close a connection to the ASGI application, and return
+        the type of its reply to the handshake.
+        """
+        from mathics_django.asgi import application
+
+        headers = [(b"host", b"localhost:8000")]
+        if origin is not None:
+            headers.append((b"origin", origin.encode()))
+        scope = {"type": "websocket", "path": "/ws/query/", "headers": headers}
+        events = [{"type": "websocket.connect"}, {"type": "websocket.disconnect"}]
+        replies = []
+
+        async def receive():
+            return events.pop(0)
+
+        async def send(message):
+            replies.append(message)
+
+        asyncio.run(application(scope, receive, send))
+        return replies[0]["type"]
+
+    def test_origins_of_other_sites_are_rejected(self):
+        self.assertEqual(self.handshake("http://localhost:8000"), "websocket.accept")
+        self.assertEqual(self.handshake("https://app.example.org"), "websocket.accept")
+        self.assertEqual(self.handshake(), "websocket.accept")
+        for origin in ("https://evil.example.com", "http://app.example.org", "null"):
+            self.assertEqual(self.handshake(origin), "websocket.close", origin)
+
+
+class DocumentationSearchTests(SimpleTestCase):
+    def test_titles_and_operators_are_found(self):
+        from mathics_django.doc import documentation
+
+        def search(query):
+            return [(exact, item.title) for exact, item in documentation.search(query)]
+
+        self.assertEqual(
+            search("Integrate"), [(True, "Integrate"), (False, "NIntegrate")]
+        )
+        self.assertEqual(search("@@"), [(True, "Apply")])
+        self.assertIn((False, "Graphics3D"), search("graphics 3d"))
+        self.assertEqual(search("qqqqqq"), [])
+
+    def test_misspelled_query_is_ranked(self):
+        response = self.client.get(
+            "/ajax/doc/search/", {"query": "Integrete", "limit": 3, "format": "json"}
+        )
+        self.assertEqual(response.status_code, 200)
+        results = response.json()["results"]
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0]["title"], "Integrate")
+        self.assertFalse(results[0]["exact"])
+
+        response = self.client.get("/ajax/doc/search/", {"query": "x", "limit": 0})
+        self.assertEqual(response.status_code, 400)
+
+
+class DocumentationNavigationTests(SimpleTestCase):
+    def test_next_links_go_through_subsections(self):
+        from mathics_django.doc import documentation
+
+        section = documentation.search("Integrate")[0][1].section
+        subsections = [section.subsections[0]]
+        while subsections[-1].get_next() is not None:
+            subsections.append(subsections[-1].get_next())
+        self.assertEqual(subsections, section.subsections)
+        self.assertIsNone(subsections[0].get_prev())
+        self.assertIs(subsections[1].get_prev(), subsections[0])
+
+
+# Run in a process of its own, where the builtins are not loaded yet.
+WARMUP_AND_QUERY_SCRIPT = """
+import time
+
+import django
+
+django.setup()
+
+from mathics.core.definitions import Definitions
+
+from mathics_django.doc import documentation_ready, start_documentation_warmup
+from mathics_django.web.evaluation import evaluate_query, new_session_evaluation
+from mathics_django.web.session_definitions import get_template_definitions
+
+start_documentation_warmup()
+# Ask while the documentation is loading the builtins.
+time.sleep(0.3)
+evaluation = new_session_evaluation("first")
+print([data["result"] for data in evaluate_query(evaluation, "Plus[1, 2]")])
+documentation_ready.wait()
+builtin = get_template_definitions().builtin
+print(set(Definitions(add_builtin=True).builtin) <= set(builtin))
+"""
+
+
+class BuiltinsLoadingTests(SimpleTestCase):
+    def test_warmup_and_first_query_at_once(self):
+        import subprocess
+        import sys
+
+        result = subprocess.run(
+            [sys.executable, "-c", WARMUP_AND_QUERY_SCRIPT],
+            capture_output=True,
+            text=True,
+            env=dict(os.environ, DJANGO_SETTINGS_MODULE="mathics_django.settings"),
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        first_result, builtins_loaded = result.stdout.strip().rsplit("\n", 1)
+        self.assertIn("<mn>3</mn>", first_result)
+        self.assertEqual(builtins_loaded, "True")
+
+
+class DocTestDataTests(SimpleTestCase):
+    def test_outputs_are_read_by_key(self):
+        import os.path as osp
+        from tempfile import TemporaryDirectory
+
+        from mathics_django.doc.doc_data import DocTestData, write_doctest_store
+
+        output_data = {
+            ("Manual", "Lists", "Take", 1): {"query": "x", "results": [1]},
+            ("Manual", "Lists", "Take", 2): {"query": "y", "results": [2]},
+            ("Manual", "Lists", "Drop", 1): {"query": "y", "results": [3]},
+        }
+        with TemporaryDirectory() as directory:
+            path = osp.join(directory, "doc_html_data.sqlite")
+            write_doctest_store(output_data, path)
+            doc_data = DocTestData.open(path)
+            self.assertEqual(len(doc_data), 3)
+            self.assertEqual(
+                doc_data.get(("Manual", "Lists", "Take", 2)),
+                {"query": "y", "results": [2]},
+            )
+            self.assertIsNone(doc_data.get(("Manual", "Lists", "Take", 3)))
+            self.assertEqual(
+                doc_data.get_many(("Manual", "Lists", "Take"), [1, 3]),
+                {1: {"query": "x", "results": [1]}},
+            )
+            # Found by its query when numbered differently.
+            self.assertEqual(
+                doc_data.get_results_by_test("y", ("Manual", "Lists", "Drop", 5)),
+                {"query": "y", "results": [3]},
+            )
+            doc_data.connection.close()
+
+            # Stores made by other Mathics3 versions are not read.
+            write_doctest_store(output_data, path, mathics_version="0.0")
+            with self.assertRaises(IOError):
+                DocTestData.open(path)
+
+    def test_stale_user_store_falls_back_to_system_store(self):
+        import os.path as osp
+        import tempfile
+        from unittest import mock
+
+        from mathics_django.doc import django_doc
+        from mathics_django.doc.doc_data import write_doctest_store
+
+        output_data = {("Manual", "Lists", "Take", 1): {"query": "x", "results": []}}
+        with tempfile.TemporaryDirectory() as directory:
+            user_path = osp.join(directory, "user.sqlite")
+            system_path = osp.join(directory, "system.sqlite")
+            write_doctest_store(output_data, user_path, mathics_version="0.0")
+            write_doctest_store(output_data, system_path)
+            with mock.patch.multiple(
+                django_doc,
+                DOCTEST_USER_HTML_STORE_PATH=user_path,
+                DOC_SYSTEM_HTML_STORE_PATH=system_path,
+            ):
+                doc_data, path, stamp = django_doc.load_doc_data()
+                self.assertEqual(path, system_path)
+                self.assertEqual(len(doc_data), 1)
+                self.assertIsNotNone(stamp)
+                doc_data.connection.close()
+
+                os.unlink(system_path)
+                doc_data, _, stamp = django_doc.load_doc_data()
+                self.assertEqual((len(doc_data), stamp), (0, None))
+
+    def test_old_environment_variables_are_read(self):
+        from unittest import mock
+
+        from mathics_django.settings import get_store_path_from_environment
+
+        old = {"DOC_SYSTEM_HTML_DATA_PATH": "/srv/doc/doc_html_data.pcl"}
+        with mock.patch.dict(os.environ, old):
+            self.assertEqual(
+                get_store_path_from_environment(
+                    "DOC_SYSTEM_HTML_STORE_PATH", "DOC_SYSTEM_HTML_DATA_PATH", "x"
+                ),
+                "/srv/doc/doc_html_data.sqlite",
+            )
+            with mock.patch.dict(os.environ, {"DOC_SYSTEM_HTML_STORE_PATH": "/s"}):
+                self.assertEqual(
+                    get_store_path_from_environment(
+                        "DOC_SYSTEM_HTML_STORE_PATH", "DOC_SYSTEM_HTML_DATA_PATH", "x"
+                    ),
+                    "/s",
+                )
+
+
+class DocPipelineTests(SimpleTestCase):
+    CHAPTERS = (
+        "Physical and Chemical data,Solving Recurrence Equations,"
+        "Sparse Array Functions"
+    )
+
+    # A section of a Mathics3 module whose one test passes if "result" is
+    # right; see write_modules().
+    SECTION_SOURCE = '''
+"""
+{title}
+
+A section of a module made by the tests.
+"""
+
+from mathics.core.builtin import Builtin
+
+
+class {symbol}(Builtin):
+    """
+    <dl>
+      <dt>'{symbol}'[]
+      <dd>gives nothing.
+    </dl>
+
+    >> 1 + 1
+     = {result}
+    """
+
+    summary_text = "give nothing"
+'''
+
+    MODULE_SOURCE = '''
+"""
+{title}
+
+A module made by the tests.
+"""
+
+{imports}
+
+pymathics_version_data = {{
+    "author": "Mathics3 Django tests",
+    "version": "1.0",
+    "name": "{name}",
+    "requires": [],
+}}
+
+__all__ = {names}
+'''
+
+    def write_modules(self, directory: str, modules: dict):
+        """
+        Write the Mathics3 modules ``modules``, ``{name: (title,
+        sections)}``, with sections ``(title, symbol, result)``, in the
+        "pymathics" namespace under ``directory``.
+        """
+        for name, (title, sections) in modules.items():
+            package = os.path.join(directory, "pymathics", name)
+            os.makedirs(package)
+            imports = []
+            for number, (section_title, symbol, result) in enumerate(sections):
+                with open(os.path.join(package, f"s{number}.py"), "w") as file:
+                    file.write(
+                        self.SECTION_SOURCE.format(
+                            title=section_title, symbol=symbol, result=result
+                        )
+                    )
+                imports.append(f"from pymathics.{name}.s{number} import {symbol}")
+            with open(os.path.join(package, "__init__.py"), "w") as file:
+                file.write(
+                    self.MODULE_SOURCE.format(
+                        title=title,
+                        imports="\n".join(imports),
+                        name=name,
+                        names=[symbol for _, symbol, _ in sections]
+                        + ["pymathics_version_data"],
+                    )
+                )
+
+    def run_docpipeline(
+        self, store_path: str, chapters: str, *options: str, **environment: str
+    ):
+        import subprocess
+        import sys
+
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        return subprocess.run(
+            [sys.executable, os.path.join("mathics_django", "docpipeline.py")]
+            + ["--output", "--chapters", chapters, *options],
+            cwd=root,
+            # Some outputs, such as that of RSolve[] here, depend on how
+            # strings hash, in serial runs too.
+            env=dict(
+                os.environ,
+                DOCTEST_USER_HTML_STORE_PATH=store_path,
+                PYTHONHASHSEED="0",
+                **environment,
+            ),
+            capture_output=True,
+            text=True,
+            timeout=600,
+        )
+
+    def read_store(self, path: str):
+        from mathics_django.doc.doc_data import DocTestData
+
+        doc_data = DocTestData.open(path)
+        rows = doc_data.query("SELECT * FROM doctests ORDER BY 1, 2", ())
+        doc_data.connection.close()
+        return doc_data.content_hash, rows
+
+    def test_parallel_run_matches_serial_run(self):
+        import tempfile
+
+        stores = []
+        with tempfile.TemporaryDirectory() as directory:
+            for options in [(), ("--jobs", "2")]:
+                path = os.path.join(directory, f"store{len(stores)}.sqlite")
+                process = self.run_docpipeline(path, self.CHAPTERS, *options)
+                self.assertEqual(process.returncode, 0, process.stdout + process.stderr)
+                self.assertTrue(process.stdout.rstrip().endswith("OK"))
+                stores.append(self.read_store(path))
+
+        (serial_hash, serial_rows), (parallel_hash, parallel_rows) = stores
+        self.assertEqual(len(serial_rows), 18)
+        self.assertEqual(parallel_rows, serial_rows)
+        self.assertEqual(parallel_hash, serial_hash)
+
+    def test_no_data_from_the_first_failure_on(self):
+        import tempfile
+
+        stores = []
+        with tempfile.TemporaryDirectory() as directory:
+            # Sections and chapters are in the order of their titles.
+            self.write_modules(
+                directory,
+                {
+                    "doc_failing": (
+                        "Doc Failing Module",
+                        [
+                            ("Alpha Things", "DocFailingA", 2),
+                            ("Beta Things", "DocFailingB", 3),
+                            ("Gamma Things", "DocFailingC", 2),
+                        ],
+                    ),
+                    "doc_later": (
+                        "Doc Later Module",
+                        [("Later Things", "DocLaterThing", 2)],
+                    ),
+                },
+            )
+            load = ("--load-module", "pymathics.doc_failing,pymathics.doc_later")
+            # A serial run takes the chapters given in no particular
+            # order, so it is only given the failing one.
+            for chapters, options in [
+                ("Doc Failing Module", ()),
+                ("Doc Failing Module,Doc Later Module", ("--jobs", "2")),
+            ]:
+                path = os.path.join(directory, f"store{len(stores)}.sqlite")
+                process = self.run_docpipeline(
+                    path,
+                    chapters,
+                    "--keep-going",
+                    *load,
+                    *options,
+                    PYTHONPATH=directory,
+                )
+                self.assertEqual(process.returncode, 1, process.stdout + process.stderr)
+                stores.append(self.read_store(path))
+
+        (serial_hash, serial_rows), (parallel_hash, parallel_rows) = stores
+        self.assertEqual(
+            [json.loads(row[0])[-1] for row in serial_rows], ["DocFailingA"]
+        )
+        self.assertEqual(parallel_rows, serial_rows)
+        self.assertEqual(parallel_hash, serial_hash)
+
+
+class DocumentationCacheTests(SimpleTestCase):
+    def test_pages_are_rendered_once(self):
+        from unittest import mock
+
+        from mathics_django.web.controllers import doc
+
+        doc.doc_cache.clear()
+        with mock.patch.object(doc, "render_doc", wraps=doc.render_doc) as render:
+            for url in ["/doc/manual/", "/ajax/doc/manual/"]:
+                first = self.client.get(url)
+                second = self.client.get(url)
+                self.assertEqual(second.status_code, 200)
+                self.assertEqual(second.content, first.content)
+                self.assertEqual(second["Content-Type"], first["Content-Type"])
+        self.assertEqual(render.call_count, 2)
+
+    def test_stale_or_partial_static_tree_is_not_used(self):
+        import os.path as osp
+        from tempfile import TemporaryDirectory
+
+        from django.test import override_settings
+
+        from mathics_django.web.controllers import doc
+
+        with (
+            TemporaryDirectory() as directory,
+            override_settings(DOC_STATIC_DIR=directory),
+        ):
+            for ajax in (False, True):
+                path = doc.static_doc_path(["manual"], ajax)
+                os.makedirs(osp.dirname(path))
+                with open(path, "w") as page_file:
+                    page_file.write("static page")
+            version_path = osp.join(directory, doc.STATIC_DOC_VERSION_FILE)
+
+            # Partly built: there is no version yet.
+            for version in (None, "stale", doc.get_doc_cache_version()):
+                if version is not None:
+                    with open(version_path, "w") as version_file:
+                        version_file.write(version + "\n")
+                for url in ["/doc/manual/", "/ajax/doc/manual/"]:
+                    doc.doc_cache.clear()
+                    response = self.client.get(url)
+                    self.assertEqual(response.status_code, 200)
+                    self.assertEqual(
+                        response.content == b"static page",
+                        version == doc.get_doc_cache_version(),
+                    )
+                    if url.startswith("/ajax/"):
+                        self.assertEqual(
+                            response["Content-Type"], doc.JSON_CONTENT_TYPE
+                        )
+        doc.doc_cache.clear()
+
+
+# This adds to the documentation for good, so it must come after
+# EscapeHtmlTests, which checks the documentation as it is built.
+class ModuleDocumentationTests(SimpleTestCase):
+    # Mathics3 modules are documented if they are in the "pymathics"
+    # namespace, with their builtins in submodules.
+    MODULE_FILES = {
+        "__init__.py": '''
+"""
+Doc Test Module
+
+A module for checking that loaded modules are documented.
+"""
+
+from pymathics.doc_test.things import DocTestModuleThing
+
+pymathics_version_data = {
+    "author": "Mathics3 Django tests",
+    "version": "1.0",
+    "name": "doc_test",
+    "requires": [],
+}
+
+__all__ = ["DocTestModuleThing", "pymathics_version_data"]
+''',
+        "things.py": '''
+"""
+Things
+
+Symbols that do nothing.
+"""
+
+from mathics.core.builtin import Builtin
+
+
+class DocTestModuleThing(Builtin):
+    """
+    <dl>
+      <dt>'DocTestModuleThing'[]
+      <dd>does nothing.
+    </dl>
+    """
+
+    summary_text = "do nothing"
+''',
+    }
+
+    def test_loaded_module_is_documented(self):
+        import sys
+        import tempfile
+
+        from mathics_django.doc import get_documentation
+        from mathics_django.web.controllers import doc
+        from mathics_django.web.evaluation import evaluate_query, new_session_evaluation
+
+        documentation = get_documentation()
+        version = doc.get_doc_cache_version()
+
+        # The documentation is added in a thread of its own.
+        def found():
+            return [
+                item.title for _, item in documentation.search("DocTestModuleThing")
+            ]
+
+        with tempfile.TemporaryDirectory() as directory:
+            package = os.path.join(directory, "pymathics", "doc_test")
+            os.makedirs(package)
+            for name, source in self.MODULE_FILES.items():
+                with open(os.path.join(package, name), "w") as file:
+                    file.write(source)
+            sys.path.insert(0, directory)
+            self.addCleanup(sys.path.remove, directory)
+            evaluation = new_session_evaluation("module")
+            (data,) = evaluate_query(evaluation, 'LoadModule["pymathics.doc_test"]')
+            self.assertIn("pymathics.doc_test", data["result"])
+            # Its documentation is read from these files.
+            self.assertTrue(wait_until(found))
+        self.assertIn("DocTestModuleThing", found())
+        self.assertNotEqual(doc.get_doc_cache_version(), version)
+
+        response = self.client.get(f"/ajax/doc/{doc.MATHICS3_MODULES_SLUG}/")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"Doc Test Module", response.content)
+        response = self.client.get(
+            "/ajax/doc/search/", {"query": "DocTestModuleThing", "format": "json"}
+        )
+        self.assertIn(
+            "DocTestModuleThing",
+            [result["title"] for result in json.loads(response.content)["results"]],
+        )
+
+    def test_module_loaded_in_worker_is_documented(self):
+        import sys
+        import tempfile
+
+        from mathics_django.doc import get_documentation
+        from mathics_django.web.backends import ProcessEvaluationBackend
+
+        documentation = get_documentation()
+
+        def found():
+            return [
+                item.title for _, item in documentation.search("DocWorkerModuleThing")
+            ]
+
+        with tempfile.TemporaryDirectory() as directory:
+            package = os.path.join(directory, "pymathics", "doc_worker_test")
+            os.makedirs(package)
+            for name, source in self.MODULE_FILES.items():
+                with open(os.path.join(package, name), "w") as file:
+                    file.write(
+                        source.replace("doc_test", "doc_worker_test")
+                        .replace("DocTestModuleThing", "DocWorkerModuleThing")
+                        .replace("Doc Test Module", "Doc Worker Test Module")
+                    )
+            # Worker processes start with the sys.path of this one.
+            sys.path.insert(0, directory)
+            self.addCleanup(sys.path.remove, directory)
+            backend = ProcessEvaluationBackend(workers=1, max_sessions=1)
+            self.addCleanup(backend.shutdown)
+            (data,) = backend.query("a", 'LoadModule["pymathics.doc_worker_test"]')
+            self.assertIn("pymathics.doc_worker_test", data["result"])
+            self.assertTrue(wait_until(found))
+        self.assertIn("DocWorkerModuleThing", found())
+
+
+class EscapeHtmlTests(SimpleTestCase):
+    # The SHA-256 digest of the HTML made by escape_html() for the whole
+    # documentation of this Mathics3 version, before it was optimized.
+    GOLDEN_MATHICS_VERSION = "10.0.1"
+    GOLDEN_DIGEST = "bd7d0397c06da143e28ee687c948f973525d0379b8d5c37e0ba582c89da0421b"
+
+    def test_documentation_html_is_unchanged(self):
+        import hashlib
+
+        from mathics import __version__ as mathics_version
+
+        from mathics_django.doc import documentation
+        from mathics_django.doc.utils import escape_html
+
+        if mathics_version != self.GOLDEN_MATHICS_VERSION:
+            self.skipTest(
+                f"golden output is for Mathics3 {self.GOLDEN_MATHICS_VERSION}"
+            )
+
+        elements = []
+        for part in documentation.parts:
+            elements.append(part)
+            for chapter in part.chapters:
+                elements.append(chapter)
+                for section in chapter.all_sections:
+                    elements.append(section)
+                    elements.extend(section.subsections)
+
+        digest = hashlib.sha256()
+        for element in elements:
+            digest.update(escape_html(element.title, single_line=True).encode())
+            doc = getattr(element, "doc", None)
+            if doc is None:
+                continue
+            digest.update(escape_html(doc.rawdoc).encode())
+            for item in doc.items:
+                for test in getattr(item, "tests", ()):
+                    digest.update(escape_html(test.test, True).encode())
+        self.assertEqual(digest.hexdigest(), self.GOLDEN_DIGEST)
+
+
+class FormattedOutputCacheTests(SimpleTestCase):
+    def test_format_rules_are_not_shared(self):
+        from mathics_django.web.evaluation import evaluate_query, new_session_evaluation
+        from mathics_django.web.format import format_cache
+
+        first = new_session_evaluation("first")
+        second = new_session_evaluation("second")
+        hits = format_cache.stats()["hits"]
+        plain = [data["result"] for data in evaluate_query(first, "g[1]")]
+        self.assertEqual(
+            [data["result"] for data in evaluate_query(second, "g[1]")], plain
+        )
+        self.assertEqual(format_cache.stats()["hits"], hits + 1)
+
+        list(evaluate_query(first, "Format[g[x_]] := h[x]"))
+        formatted = [data["result"] for data in evaluate_query(first, "g[1]")]
+        self.assertNotEqual(formatted, plain)
+        self.assertIn("h", formatted[0])
+        self.assertEqual(
+            [data["result"] for data in evaluate_query(second, "g[1]")], plain
+        )
+
+    def test_set_options_of_a_form(self):
+        from mathics_django.web.evaluation import evaluate_query, new_session_evaluation
+
+        evaluation = new_session_evaluation("options")
+        # The options of builtins are shared between sessions.
+        self.addCleanup(
+            lambda: list(
+                evaluate_query(
+                    evaluation, "SetOptions[NumberForm, DigitBlock -> Infinity]"
+                )
+            )
+        )
+        query = "NumberForm[1234567.123]"
+        (plain,) = evaluate_query(evaluation, query)
+        list(evaluate_query(evaluation, "SetOptions[NumberForm, DigitBlock -> 3]"))
+        (blocked,) = evaluate_query(evaluation, query)
+        self.assertNotEqual(blocked["result"], plain["result"])
+
+    def test_messages_from_format_rules_are_kept(self):
+        from mathics_django.web.evaluation import evaluate_query, new_session_evaluation
+
+        evaluation = new_session_evaluation("messages")
+        list(
+            evaluate_query(
+                evaluation,
+                'f::oops = "bad `1`"; Format[f[x_]] := (Message[f::oops, x]; x)',
+            )
+        )
+        for _ in range(2):
+            (data,) = evaluate_query(evaluation, "f[2]")
+            self.assertEqual([out["text"] for out in data["out"]], ["bad 2"])
+
+
+class SettingsSnapshotTests(SimpleTestCase):
+    def test_assigned_setting_is_read_again(self):
+        from mathics_django.web.evaluation import (
+            evaluate_query,
+            get_user_settings,
+            new_session_evaluation,
+        )
+
+        evaluation = new_session_evaluation("settings")
+        settings = get_user_settings(evaluation)
+        self.assertIs(settings["Settings`$RenderTeXForm"]["value"], True)
+        list(evaluate_query(evaluation, "x = 1"))
+        self.assertIs(get_user_settings(evaluation), settings)
+
+        list(evaluate_query(evaluation, "Settings`$RenderTeXForm = False"))
+        settings = get_user_settings(evaluation)
+        self.assertIs(settings["Settings`$RenderTeXForm"]["value"], False)
+
+
+class OutputPreviewTests(SimpleTestCase):
+    def test_big_result_is_shown_in_parts(self):
+        from mathics_django import settings
+        from mathics_django.web.evaluation import (
+            evaluate_query,
+            more_output,
+            new_session_evaluation,
+        )
+
+        evaluation = new_session_evaluation("preview")
+        total = settings.OUTPUT_PREVIEW_LEAVES + 10
+        (data,) = evaluate_query(evaluation, f"Range[{total}]")
+        more = data["more"]
+        self.assertEqual(more["offset"], settings.OUTPUT_PREVIEW_LEAVES)
+        self.assertIn("&lt;&lt;10&gt;&gt;", data["result"])
+
+        rest = more_output(evaluation, more["handle"], more["offset"])
+        self.assertIsNone(rest["more"])
+        self.assertIn(f"<mn>{total}</mn>", rest["result"])
+
+
+class GraphicsCacheTests(SimpleTestCase):
+    def test_big_pictures_are_moved_to_files(self):
+        import base64
+        import tempfile
+        from unittest import mock
+
+        from mathics_django.web import graphics_cache
+
+        svg = b"<svg>" + b" " * 100 + b"</svg>"
+        small = '<mglyph src="data:image/svg+xml;base64,PHN2Zz48L3N2Zz4="/>'
+        big = (
+            '<mglyph src="data:image/svg+xml;base64,'
+            + base64.b64encode(svg).decode("ascii")
+            + '"/>'
+        )
+        with (
+            tempfile.TemporaryDirectory() as directory,
+            mock.patch.multiple(graphics_cache, GRAPHICS_DIRECTORY=directory),
+            mock.patch.object(graphics_cache.settings, "GRAPHICS_INLINE_BYTES", 64),
+        ):
+            output = graphics_cache.move_graphics_out_of_band(small + big)
+            self.assertTrue(output.startswith(small))
+            (name,) = os.listdir(directory)
+            self.assertIn(graphics_cache.graphics_url(name), output)
+            with open(os.path.join(directory, name), "rb") as file:
+                self.assertEqual(file.read(), svg)
+
+    def test_scene_file_is_plain_json(self):
+        import tempfile
+        from unittest import mock
+
+        from mathics_django.web import graphics_cache
+
+        scene = {"elements": [], "tooltip_text": 'it\'s <big> & "round"'}
+        data = json.dumps(scene).replace("&", "&amp;").replace("'", "&#39;")
+        with (
+            tempfile.TemporaryDirectory() as directory,
+            mock.patch.multiple(graphics_cache, GRAPHICS_DIRECTORY=directory),
+            mock.patch.object(graphics_cache.settings, "GRAPHICS_INLINE_BYTES", 16),
+        ):
+            graphics_cache.move_graphics_out_of_band(f"<graphics3d data='{data}'/>")
+            (name,) = os.listdir(directory)
+            with open(os.path.join(directory, name)) as file:
+                self.assertEqual(json.load(file), scene)
+
+    def test_output_with_pruned_files_is_formatted_again(self):
+        import tempfile
+        from unittest import mock
+
+        from mathics_django.web import graphics_cache
+        from mathics_django.web.evaluation import evaluate_query, new_session_evaluation
+
+        evaluation = new_session_evaluation("pruned")
+        query = "Graphics[Table[Point[{i, i^2}], {i, 50}]]"
+        with (
+            tempfile.TemporaryDirectory() as directory,
+            mock.patch.multiple(graphics_cache, GRAPHICS_DIRECTORY=directory),
+            mock.patch.object(graphics_cache.settings, "GRAPHICS_INLINE_BYTES", 64),
+        ):
+            (first,) = evaluate_query(evaluation, query)
+            (name,) = os.listdir(directory)
+            self.assertTrue(graphics_cache.graphics_files_present(first["result"]))
+            os.unlink(os.path.join(directory, name))
+            self.assertFalse(graphics_cache.graphics_files_present(first["result"]))
+
+            (second,) = evaluate_query(evaluation, query)
+            self.assertEqual(second["result"], first["result"])
+            self.assertEqual(os.listdir(directory), [name])
+
+    def test_packed_scene_keeps_points(self):
+        import base64
+        from array import array
+
+        from mathics_django.web.graphics_cache import pack_graphics3d
+
+        triangle = {"type": "polygon", "color": [1, 1, 1], "opacity": 1}
+        scaled = {"type": "line", "coords": [[[0, 0, 0], [1, 1, 1]]]}
+        scene = {
+            "elements": [
+                dict(triangle, coords=[[[0, 0, 0], None]] * 3),
+                dict(triangle, coords=[[[0.5, 1, 2], None]] * 3),
+                scaled,
+            ]
+        }
+        packed = pack_graphics3d(scene)
+        self.assertEqual(packed["elements"][0]["coords"], [3, 3])
+        self.assertEqual(packed["elements"][1], scaled)
+        floats = array("f", base64.b64decode(packed["packed"]["floats"]))
+        self.assertEqual(list(floats[-3:]), [0.5, 1, 2])
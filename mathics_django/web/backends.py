@@ -0,0 +1,900 @@
+# -*- coding: utf-8 -*-
+"""
+Evaluation backends: where the Mathics3 code of a worksheet cell is run.
+
+``InlineEvaluationBackend`` evaluates in the web server process itself,
+in the thread handling the request. This is simple and is the default.
+
+``ProcessEvaluationBackend`` keeps each session's Evaluation in one of a
+bounded number of worker processes. Requests are sent to the worker
+that owns the session, so a CPU-heavy cell only ties up its worker,
+evaluation can use all cores, and a crash in one worker only loses the
+sessions that live in it.
+
+Both give back the same ``Result.get_data()`` dictionaries, either all at
+once with ``query()`` or one at a time, as each expression of the cell
+is evaluated, with ``iter_query()``. ``iter_query()`` can also pass on
+each Print[] output and message as soon as it is produced.
+The backend in use is selected with MATHICS3_DJANGO_EVALUATION_BACKEND.
+
+A query that runs longer than QUERY_TIMEOUT, or that is aborted, is
+first asked to stop, which makes it give $Aborted. The process backend
+additionally kills and restarts the worker if the query is still
+running ABORT_GRACE seconds after that.
+"""
+
+import math
+import multiprocessing
+import queue
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+from mathics.core.evaluation import Message, Result
+from mathics.eval.pymathics import pymathics_modules
+
+from mathics_django import settings
+from mathics_django.web.evaluation import (
+    abort_evaluation,
+    add_loaded_modules,
+    evaluate_query,
+    get_system_info,
+    get_user_settings,
+    more_output,
+    new_session_evaluation,
+    on_modules_loaded,
+    session_busy_result,
+)
+from mathics_django.web.evaluation_pool import SessionEvaluationPool
+from mathics_django.web.format import format_cache
+from mathics_django.web.session_definitions import get_template_definitions
+from mathics_django.web.session_queue import SessionBusy, SessionQueues, SessionTurn
+
+
+class EvaluationError(Exception):
+    """
+    Raised in the web server process when evaluation in a worker failed
+    with a Python exception. The message is the worker's traceback.
+    """
+
+
+class WorkerDied(Exception):
+    """
+    Raised when an evaluation worker process ended while handling a
+    request. ``results`` has whatever the worker sent before that.
+    """
+
+    def __init__(self, results: list):
+        super().__init__("Evaluation worker process ended unexpectedly")
+        self.results = results
+
+
+class WorkerKilled(WorkerDied):
+    """
+    Raised when an evaluation worker process was killed because a request
+    did not stop in time after a timeout or an abort.
+    """
+
+
+def new_session_pool(
+    max_sessions: int, on_evict: Optional[Callable[[str], None]] = None
+) -> SessionEvaluationPool:
+    return SessionEvaluationPool(
+        new_session_evaluation,
+        max_size=max_sessions,
+        idle_timeout=settings.SESSION_IDLE_TIMEOUT,
+        memory_high_water=settings.MEMORY_HIGH_WATER_MB * 1024 * 1024,
+        on_evict=on_evict,
+    )
+
+
+def evaluation_stats(pool: SessionEvaluationPool) -> Dict[str, int]:
+    """
+    Return the statistics of ``pool`` and, prefixed with "format_cache_",
+    those of the formatted output cache of this process.
+    """
+    stats = pool.stats()
+    for name, value in format_cache.stats().items():
+        stats["format_cache_" + name] = value
+    return stats
+
+
+class EvaluationBackend:
+    """
+    What the evaluation backends have in common.
+
+    The queries and other requests of a session are handled one at a
+    time, in the order they arrive; at most SESSION_QUEUE_DEPTH of them
+    may be running or waiting. A query beyond that gives a "busy"
+    result. Aborting does not wait its turn. Asynchronous callers wait
+    for the turn of a query with ``wait_for_turn()`` before giving it a
+    thread to run in.
+
+    Subclasses implement ``iter_session_query()``,
+    ``get_session_user_settings()`` and ``get_session_more_output()``,
+    which are called in the session's turn, ``abort_session_query()``,
+    and ``get_system_info()``, which gives Mathics3's information about
+    the system it evaluates on.
+    """
+
+    def __init__(self):
+        self.session_queues = SessionQueues(settings.SESSION_QUEUE_DEPTH)
+        # Keys of the sessions whose query has been aborted during their
+        # current turn.
+        self.aborted_sessions: Set[str] = set()
+
+    async def wait_for_turn(self, session_key: str) -> SessionTurn:
+        """
+        Wait for a turn of ``session_key`` in the running event loop,
+        without holding up a thread, and return it for passing to
+        ``iter_query()`` or ``iter_cells()``, which end it.
+        ``SessionBusy`` is raised if the session's queue is full.
+        """
+        turn = self.session_queues.enter(session_key)
+        await turn.wait_async()
+        return turn
+
+    @contextmanager
+    def session_turn(
+        self, session_key: str, turn: Optional[SessionTurn] = None
+    ) -> Iterator[None]:
+        """
+        Hold ``turn``, or else a turn of ``session_key`` waited for in this
+        thread, until the end of the ``with`` block.
+        """
+        if turn is None:
+            turn = self.session_queues.enter(session_key)
+        try:
+            turn.wait()
+            yield
+        finally:
+            turn.release()
+
+    def iter_query(
+        self,
+        session_key: str,
+        input: str,
+        on_out: Optional[Callable[[dict], None]] = None,
+        turn: Optional[SessionTurn] = None,
+    ) -> Iterator[dict]:
+        """
+        Evaluate ``input`` in the turn ``turn`` of the session, from
+        ``wait_for_turn()``, or else in a turn waited for in this thread.
+        """
+        try:
+            with self.session_turn(session_key, turn):
+                self.aborted_sessions.discard(session_key)
+                yield from self.iter_session_query(session_key, input, on_out)
+        except SessionBusy:
+            yield session_busy_result()
+
+    def iter_cells(
+        self,
+        session_key: str,
+        cells: Sequence[Tuple[Any, str]],
+        turn: Optional[SessionTurn] = None,
+    ) -> Iterator[Tuple[Any, dict]]:
+        """
+        Evaluate the input of each of ``cells``, ``(cell_id, input)``
+        pairs, in order and in a single turn of the session, yielding
+        ``(cell_id, data)`` for each result. ``turn`` is as for
+        ``iter_query()``.
+
+        Once one of the cells is aborted, the ones after it are skipped.
+        """
+        try:
+            with self.session_turn(session_key, turn):
+                self.aborted_sessions.discard(session_key)
+                for cell_id, input in cells:
+                    if session_key in self.aborted_sessions:
+                        break
+                    for data in self.iter_session_query(session_key, input):
+                        yield cell_id, data
+        except SessionBusy:
+            for cell_id, _ in cells:
+                yield cell_id, session_busy_result()
+
+    def query(self, session_key: str, input: str) -> List[dict]:
+        return list(self.iter_query(session_key, input))
+
+    def abort(self, session_key: str) -> bool:
+        """
+        Abort the query in progress for ``session_key``, and the cells
+        after it if it is part of ``iter_cells()``. Return whether there
+        was one.
+        """
+        aborted = self.abort_session_query(session_key)
+        if aborted:
+            self.aborted_sessions.add(session_key)
+        return aborted
+
+    def get_user_settings(self, session_key: str) -> dict:
+        try:
+            with self.session_queues.turn(session_key):
+                return self.get_session_user_settings(session_key)
+        except SessionBusy:
+            return {}
+
+    def more_output(self, session_key: str, handle: str, offset: int) -> Optional[dict]:
+        """
+        Return the next part of a result shown as a preview; see
+        ``mathics_django.web.evaluation.more_output()``. None is returned
+        if the preview is no longer kept or the session is busy.
+        """
+        try:
+            with self.session_queues.turn(session_key):
+                return self.get_session_more_output(session_key, handle, offset)
+        except SessionBusy:
+            return None
+
+
+class InlineEvaluationBackend(EvaluationBackend):
+    """
+    Evaluates in the calling thread of the web server process.
+    """
+
+    def __init__(self, max_sessions: int):
+        super().__init__()
+        self.pool = new_session_pool(max_sessions)
+        # session key -> Evaluation of each query being evaluated.
+        self.running: Dict[str, Any] = {}
+        self.running_lock = threading.Lock()
+
+    def has_session(self, session_key: str) -> bool:
+        return session_key in self.pool
+
+    def iter_session_query(
+        self,
+        session_key: str,
+        input: str,
+        on_out: Optional[Callable[[dict], None]] = None,
+    ) -> Iterator[dict]:
+        evaluation = self.pool.get(session_key)
+        with self.running_lock:
+            self.running[session_key] = evaluation
+        try:
+            yield from evaluate_query(evaluation, input, settings.QUERY_TIMEOUT, on_out)
+        finally:
+            with self.running_lock:
+                del self.running[session_key]
+                # In case it was aborted just as it ended.
+                evaluation.query_aborted = False
+
+    def abort_session_query(self, session_key: str) -> bool:
+        with self.running_lock:
+            evaluation = self.running.get(session_key)
+            if evaluation is None:
+                return False
+            abort_evaluation(evaluation)
+            return True
+
+    def get_session_user_settings(self, session_key: str) -> dict:
+        return get_user_settings(self.pool.get(session_key))
+
+    def get_system_info(self) -> dict:
+        return get_system_info()
+
+    def get_session_more_output(
+        self, session_key: str, handle: str, offset: int
+    ) -> Optional[dict]:
+        if session_key not in self.pool:
+            return None
+        return more_output(self.pool.get(session_key), handle, offset)
+
+    def end_session(self, session_key: str):
+        self.pool.discard(session_key)
+
+    def stats(self) -> Dict[str, int]:
+        return evaluation_stats(self.pool)
+
+
+def worker_main(connection, max_sessions: int):
+    """
+    The loop run by an evaluation worker process.
+
+    Requests are tuples ``(request_id, command, session_key, argument)``.
+    Each is handled in a thread of its own, so that a long query of one
+    session does not hold up the requests of the other sessions here;
+    those of one session come one at a time, in its turn. Messages sent
+    back are tuples ``(request_id, kind, data)``, with the id of the
+    request they answer.
+
+    A "query" is answered with one "result" message per evaluated
+    expression, preceded by an "out" message for each Print[] output and
+    message as it is produced; every request ends with a "done" message,
+    holding its value, or an "error" message holding a traceback. An
+    "abort" request aborts the query whose id it has, and is not answered.
+
+    ``(None, "ready", None)`` is sent once the builtin definitions have
+    been loaded, before any request is read, ``(None, "dropped",
+    session_key)`` when the session pool drops a session by itself, and
+    ``(None, "modules_loaded", module_names)``, with the names of all the
+    Mathics3 modules loaded here, when a query has loaded more of them.
+    """
+    send_lock = threading.Lock()
+
+    def send(*message):
+        # Connection.send() is not safe to call from several threads.
+        with send_lock:
+            connection.send(message)
+
+    get_template_definitions()
+    on_modules_loaded(
+        lambda: send(
+            None,
+            "modules_loaded",
+            sorted(module.__name__ for module in list(pymathics_modules)),
+        )
+    )
+    send(None, "ready", None)
+    pool = new_session_pool(
+        max_sessions, on_evict=lambda session_key: send(None, "dropped", session_key)
+    )
+    # Request id -> Evaluation of each query being handled, or None until
+    # it has one.
+    running: Dict[int, Any] = {}
+    # Ids of the queries aborted before they had an Evaluation.
+    aborted: Set[int] = set()
+    running_lock = threading.Lock()
+
+    def handle(request_id: int, command: str, session_key: str, argument):
+        try:
+            value = None
+            if command == "query":
+                evaluation = None
+                try:
+                    evaluation = pool.get(session_key)
+                    with running_lock:
+                        running[request_id] = evaluation
+                        if request_id in aborted:
+                            abort_evaluation(evaluation)
+                    for data in evaluate_query(
+                        evaluation,
+                        argument,
+                        settings.QUERY_TIMEOUT,
+                        lambda out: send(request_id, "out", out),
+                    ):
+                        send(request_id, "result", data)
+                finally:
+                    with running_lock:
+                        del running[request_id]
+                        aborted.discard(request_id)
+                        if evaluation is not None:
+                            evaluation.query_aborted = False
+            elif command == "user_settings":
+                value = get_user_settings(pool.get(session_key))
+            elif command == "system_info":
+                value = get_system_info()
+            elif command == "more":
+                if session_key in pool:
+                    value = more_output(pool.get(session_key), *argument)
+            elif command == "end_session":
+                pool.discard(session_key)
+            elif command == "stats":
+                value = evaluation_stats(pool)
+            else:
+                raise ValueError(f"Unknown evaluation worker command {command!r}")
+        except Exception:
+            send(request_id, "error", traceback.format_exc())
+        else:
+            send(request_id, "done", value)
+
+    while True:
+        try:
+            request_id, command, session_key, argument = connection.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        with running_lock:
+            if command == "abort":
+                if running.get(request_id) is not None:
+                    abort_evaluation(running[request_id])
+                elif request_id in running:
+                    aborted.add(request_id)
+                continue
+            if command == "query":
+                running[request_id] = None
+        threading.Thread(
+            target=handle,
+            args=(request_id, command, session_key, argument),
+            daemon=True,
+        ).start()
+
+
+class PendingRequest:
+    """
+    A request to an evaluation worker not yet answered in full, from the
+    time it waits for the worker to be ready.
+    """
+
+    def __init__(self, session_key: str, connection):
+        self.session_key = session_key
+        # The connection to the worker process it is for.
+        self.connection = connection
+        # Whether it has been sent, and whether it was aborted before.
+        self.sent = False
+        self.aborted = False
+        # Messages from the worker for this request, as (kind, data).
+        self.messages: queue.Queue = queue.Queue()
+        # The time by which it must have finished, if any.
+        self.kill_deadline: Optional[float] = None
+
+
+class EvaluationWorker:
+    """
+    The web server side of one evaluation worker process.
+
+    Requests are sent to the worker as they come, each with an id of its
+    own. A thread reads the messages sent back and passes each to the
+    request whose id it has, so threads waiting for different requests
+    to the same worker do not hold each other up.
+
+    ``on_dropped``, if given, is called with the worker and a session key
+    when the worker has dropped that session by itself. Mathics3 modules
+    loaded by a query in the worker are loaded here too, for their
+    documentation; see ``add_loaded_modules()``.
+    """
+
+    # How often, in seconds, a thread waiting on the worker checks
+    # whether it should give up on it.
+    poll_interval = 0.25
+
+    def __init__(
+        self,
+        context,
+        max_sessions: int,
+        on_dropped: Optional[Callable[["EvaluationWorker", str], None]] = None,
+    ):
+        self.context = context
+        self.max_sessions = max_sessions
+        self.on_dropped = on_dropped
+        # Guards the attributes below, and sending to the worker.
+        self.lock = threading.Lock()
+        self.process = None
+        self.connection = None
+        # Set once the worker has sent its "ready" message.
+        self.ready = threading.Event()
+        self.last_request_id = 0
+        # Request id -> PendingRequest
+        self.pending: Dict[int, PendingRequest] = {}
+
+    def start(self):
+        """
+        Start the worker process. Called with ``lock`` held.
+        """
+        parent_connection, child_connection = self.context.Pipe()
+        self.process = self.context.Process(
+            target=worker_main,
+            args=(child_connection, self.max_sessions),
+            daemon=True,
+            name="mathics3-evaluation-worker",
+        )
+        self.process.start()
+        child_connection.close()
+        self.connection = parent_connection
+        self.ready = threading.Event()
+        threading.Thread(
+            target=self.read_messages,
+            args=(parent_connection, self.ready),
+            daemon=True,
+            name="mathics3-evaluation-worker-reader",
+        ).start()
+
+    def stop(self):
+        """
+        Kill the worker process. Called with ``lock`` held. The requests
+        sent to it are told that it died.
+        """
+        if self.process is not None:
+            if self.process.is_alive():
+                self.process.kill()
+            self.process.join()
+            self.process = None
+        if self.connection is not None:
+            # The reader thread closes the connection once it has read
+            # to its end.
+            self.fail_requests(self.connection)
+            self.connection = None
+
+    def restart(self, connection):
+        """
+        Kill and start again the worker process, unless that has been
+        done since ``connection`` to it was made.
+        """
+        with self.lock:
+            if self.connection is connection:
+                self.stop()
+                self.start()
+
+    def fail_requests(self, connection):
+        """
+        Tell the requests sent over ``connection`` that the worker died.
+        Called with ``lock`` held.
+        """
+        for request_id, request in list(self.pending.items()):
+            if request.connection is connection:
+                del self.pending[request_id]
+                request.messages.put(("died", None))
+
+    def read_messages(self, connection, ready: threading.Event):
+        """
+        Pass the messages coming from the worker over ``connection`` to
+        the requests they answer, until the worker process ends.
+        """
+        while True:
+            try:
+                request_id, kind, data = connection.recv()
+            except (EOFError, OSError):
+                break
+            if kind == "ready":
+                ready.set()
+            elif kind == "dropped":
+                if self.on_dropped is not None:
+                    self.on_dropped(self, data)
+            elif kind == "modules_loaded":
+                add_loaded_modules(data)
+            else:
+                with self.lock:
+                    request = self.pending.get(request_id)
+                if request is not None:
+                    request.messages.put((kind, data))
+        with self.lock:
+            self.fail_requests(connection)
+        connection.close()
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def wait_until_ready(self, process, connection, ready: threading.Event):
+        """
+        Wait for the worker to finish loading, so that time spent
+        starting up does not count against a request's timeout.
+        """
+        while not ready.wait(self.poll_interval):
+            if not process.is_alive():
+                self.restart(connection)
+                raise WorkerDied([])
+
+    def abort_request(self, request_id: int, request: PendingRequest):
+        """
+        Abort a request. If it has not stopped ABORT_GRACE seconds later,
+        the worker is killed. Called with ``lock`` held.
+
+        A request not sent yet is aborted as soon as it is sent.
+        """
+        if not request.sent:
+            request.aborted = True
+            return
+        deadline = time.monotonic() + settings.ABORT_GRACE
+        if request.kill_deadline is None or deadline < request.kill_deadline:
+            request.kill_deadline = deadline
+        try:
+            request.connection.send((request_id, "abort", request.session_key, None))
+        except OSError:
+            # The worker is gone; the reader thread tells the request.
+            pass
+
+    def abort(self, session_key: str) -> bool:
+        """
+        Abort the request of ``session_key`` in progress, if there is one.
+        """
+        with self.lock:
+            for request_id, request in self.pending.items():
+                if request.session_key == session_key:
+                    self.abort_request(request_id, request)
+                    return True
+        return False
+
+    def next_message(self, request: PendingRequest, results: list):
+        """
+        Wait for and return the next message for ``request``, killing and
+        restarting the worker if the request is past its kill deadline.
+        """
+        while True:
+            try:
+                return request.messages.get(timeout=self.poll_interval)
+            except queue.Empty:
+                pass
+            if (
+                request.kill_deadline is not None
+                and time.monotonic() > request.kill_deadline
+            ):
+                self.restart(request.connection)
+                raise WorkerKilled(results)
+
+    def discard_rest(self, request_id: int, request: PendingRequest):
+        """
+        Abort a request whose remaining output nobody wants, and wait for
+        it to end so that the session's next request does not run
+        alongside it.
+        """
+        with self.lock:
+            self.abort_request(request_id, request)
+        try:
+            while self.next_message(request, [])[0] in ("result", "out"):
+                pass
+        except WorkerDied:
+            pass
+
+    def iter_request(
+        self,
+        command: str,
+        session_key: str,
+        argument=None,
+        timeout: float = 0,
+        on_out: Optional[Callable[[dict], None]] = None,
+    ) -> Iterator[dict]:
+        """
+        Send a request to the worker, yielding the "result" data sent back
+        as it arrives. The value of the request is the generator's return
+        value. ``on_out``, if given, is called with the "out" data.
+
+        If the worker process has died, ``WorkerDied`` is raised and the
+        worker is restarted. If ``timeout`` is given and the request is
+        still running ABORT_GRACE seconds after it, or after an abort,
+        the worker is killed and restarted, and ``WorkerKilled`` is raised.
+        """
+        with self.lock:
+            if self.process is None:
+                self.start()
+            elif not self.is_alive():
+                # It died while idle. Its sessions are gone, so say so
+                # rather than quietly starting them over.
+                self.stop()
+                self.start()
+                raise WorkerDied([])
+            process, connection, ready = self.process, self.connection, self.ready
+            self.last_request_id += 1
+            request_id = self.last_request_id
+            request = PendingRequest(session_key, connection)
+            self.pending[request_id] = request
+        try:
+            self.wait_until_ready(process, connection, ready)
+            with self.lock:
+                if self.connection is not connection:
+                    # Restarted meanwhile, for another request.
+                    raise WorkerDied([])
+                if timeout:
+                    request.kill_deadline = (
+                        time.monotonic() + timeout + settings.ABORT_GRACE
+                    )
+                try:
+                    connection.send((request_id, command, session_key, argument))
+                except OSError:
+                    pass
+                else:
+                    request.sent = True
+                    if request.aborted:
+                        self.abort_request(request_id, request)
+            if not request.sent:
+                self.restart(connection)
+                raise WorkerDied([])
+
+            results = []
+            try:
+                while True:
+                    kind, data = self.next_message(request, results)
+                    if kind == "result":
+                        results.append(data)
+                        yield data
+                    elif kind == "out":
+                        if on_out is not None:
+                            on_out(data)
+                    elif kind == "done":
+                        return data
+                    elif kind == "died":
+                        self.restart(connection)
+                        raise WorkerDied(results)
+                    else:
+                        raise EvaluationError(data)
+            except GeneratorExit:
+                self.discard_rest(request_id, request)
+                raise
+        finally:
+            with self.lock:
+                self.pending.pop(request_id, None)
+
+    def request(
+        self, command: str, session_key: str, argument=None, timeout: float = 0
+    ):
+        """
+        Like ``iter_request()``, but wait for the whole request and return
+        ``(results, value)`` where ``results`` is the list of "result"
+        data sent back.
+        """
+        requests = self.iter_request(command, session_key, argument, timeout)
+        results = []
+        while True:
+            try:
+                results.append(next(requests))
+            except StopIteration as stop:
+                return results, stop.value
+
+
+def worker_died_result(killed: bool = False) -> dict:
+    if killed:
+        # Killing the worker is how a query that won't stop is stopped.
+        message = Message(
+            "General",
+            tag="aborted",
+            text="The evaluation did not stop in time, so its evaluation "
+            "process was restarted; session definitions have been lost.",
+        )
+        return Result(out=[message], result="$Aborted", line_no=None).get_data()
+    message = Message(
+        "General",
+        tag="noserver",
+        text="The evaluation process for this session ended unexpectedly; "
+        "its definitions have been lost.",
+    )
+    return Result(out=[message], result=None, line_no=None).get_data()
+
+
+class ProcessEvaluationBackend(EvaluationBackend):
+    """
+    Evaluates in a bounded pool of worker processes, each holding the
+    Evaluation objects of the sessions assigned to it.
+
+    A new session is assigned to the worker that has the fewest sessions,
+    and stays with that worker for as long as the worker lives and keeps
+    it. Workers say when they drop a session, because it was idle or to
+    make room, so that it is forgotten here too.
+    """
+
+    def __init__(self, workers: int, max_sessions: int):
+        # "spawn" rather than "fork": the web server process may have
+        # threads running, and this is what Windows and macOS use anyway.
+        super().__init__()
+        context = multiprocessing.get_context("spawn")
+        sessions_per_worker = (
+            math.ceil(max_sessions / workers) if max_sessions else max_sessions
+        )
+        self.workers = [
+            EvaluationWorker(context, sessions_per_worker, self.forget_session)
+            for _ in range(workers)
+        ]
+        # session key -> EvaluationWorker
+        self.owners: Dict[str, EvaluationWorker] = {}
+        self.lock = threading.Lock()
+
+    def has_session(self, session_key: str) -> bool:
+        return session_key in self.owners
+
+    def get_worker(self, session_key: str) -> EvaluationWorker:
+        with self.lock:
+            worker = self.owners.get(session_key)
+            if worker is None:
+                load = {worker: 0 for worker in self.workers}
+                for owner in self.owners.values():
+                    load[owner] += 1
+                worker = min(self.workers, key=load.__getitem__)
+                self.owners[session_key] = worker
+            return worker
+
+    def forget_session(self, worker: EvaluationWorker, session_key: str):
+        with self.lock:
+            if self.owners.get(session_key) is worker:
+                del self.owners[session_key]
+
+    def forget_worker_sessions(self, worker: EvaluationWorker):
+        with self.lock:
+            for session_key, owner in list(self.owners.items()):
+                if owner is worker:
+                    del self.owners[session_key]
+
+    def iter_session_query(
+        self,
+        session_key: str,
+        input: str,
+        on_out: Optional[Callable[[dict], None]] = None,
+    ) -> Iterator[dict]:
+        worker = self.get_worker(session_key)
+        try:
+            yield from worker.iter_request(
+                "query",
+                session_key,
+                input,
+                timeout=settings.QUERY_TIMEOUT,
+                on_out=on_out,
+            )
+        except WorkerDied as exc:
+            self.forget_worker_sessions(worker)
+            yield worker_died_result(killed=isinstance(exc, WorkerKilled))
+
+    def abort_session_query(self, session_key: str) -> bool:
+        # Under the lock, so that the session is not dropped and given
+        # to another worker in between. The worker's lock is only ever
+        # taken inside this one, never the other way around.
+        with self.lock:
+            worker = self.owners.get(session_key)
+            return worker is not None and worker.abort(session_key)
+
+    def get_session_user_settings(self, session_key: str) -> dict:
+        worker = self.get_worker(session_key)
+        try:
+            _, user_settings = worker.request("user_settings", session_key)
+        except WorkerDied:
+            self.forget_worker_sessions(worker)
+            return {}
+        return user_settings
+
+    def get_system_info(self) -> dict:
+        # Asked of a worker, so that this process needs no Definitions.
+        worker = self.workers[0]
+        try:
+            _, system_info = worker.request("system_info", "")
+        except WorkerDied:
+            self.forget_worker_sessions(worker)
+            return get_system_info()
+        return system_info
+
+    def get_session_more_output(
+        self, session_key: str, handle: str, offset: int
+    ) -> Optional[dict]:
+        with self.lock:
+            worker = self.owners.get(session_key)
+        if worker is None:
+            return None
+        try:
+            _, data = worker.request("more", session_key, (handle, offset))
+        except WorkerDied:
+            self.forget_worker_sessions(worker)
+            return None
+        return data
+
+    def end_session(self, session_key: str):
+        with self.lock:
+            worker = self.owners.pop(session_key, None)
+        if worker is not None and worker.is_alive():
+            try:
+                worker.request("end_session", session_key)
+            except WorkerDied:
+                self.forget_worker_sessions(worker)
+
+    def stats(self) -> Dict[str, int]:
+        totals: Dict[str, int] = {}
+        for worker in self.workers:
+            if not worker.is_alive():
+                continue
+            try:
+                _, worker_stats = worker.request("stats", "")
+            except WorkerDied:
+                self.forget_worker_sessions(worker)
+                continue
+            for name, value in worker_stats.items():
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+    def shutdown(self):
+        for worker in self.workers:
+            with worker.lock:
+                worker.stop()
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_evaluation_backend():
+    """
+    Return the evaluation backend selected in settings, creating it on
+    first use.
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                if settings.EVALUATION_BACKEND == "process":
+                    _backend = ProcessEvaluationBackend(
+                        settings.EVALUATION_WORKERS, settings.MAX_SESSIONS
+                    )
+                elif settings.EVALUATION_BACKEND == "inline":
+                    _backend = InlineEvaluationBackend(settings.MAX_SESSIONS)
+                else:
+                    raise ValueError(
+                        "Unknown MATHICS3_DJANGO_EVALUATION_BACKEND "
+                        f"{settings.EVALUATION_BACKEND!r}; "
+                        'use "inline" or "process"'
+                    )
+    return _backend
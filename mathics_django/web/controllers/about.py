@@ -14,13 +14,16 @@ from django import __version__ as django_version
 from django.conf import settings
 from django.shortcuts import render
 from mathics import optional_software, version_info as mathics_version_info
-from mathics.core.evaluation import Evaluation
-from mathics.system_info import mathics_system_info
 
-from mathics_django.settings import DOCTEST_USER_HTML_DATA_PATH, MATHICS3_DJANGO_DB_PATH
+from mathics_django.settings import (
+    DOCTEST_USER_HTML_STORE_PATH,
+    MATHICS3_DJANGO_DB_PATH,
+)
 from mathics_django.version import __version__
-from mathics_django.web.models import get_session_evaluation
+from mathics_django.web.backends import get_evaluation_backend
+from mathics_django.web.models import get_session_evaluation_stats, get_session_key
 
+mathics_system_info_data = {}
 mathics_threejs_backend_data = {}
 
 
@@ -28,9 +31,8 @@ def about_page(request):
     """
     This view gives information about the version and software we have loaded.
     """
-    evaluation = get_session_evaluation(request.session)
-    definitions = evaluation.definitions
-    system_info = mathics_system_info(definitions)
+    session_key = get_session_key(request.session)
+    system_info = get_mathics_system_info()
 
     return render(
         request,
@@ -38,7 +40,7 @@ def about_page(request):
         {
             "BaseDirectory": system_info["$BaseDirectory"],
             "DB_PATH": MATHICS3_DJANGO_DB_PATH,
-            "DOCTEST_DATA_PATH": DOCTEST_USER_HTML_DATA_PATH,
+            "DOCTEST_DATA_PATH": DOCTEST_USER_HTML_STORE_PATH,
             "HTTP_USER_AGENT": request.META.get("HTTP_USER_AGENT", ""),
             "HomeDirectory": system_info["$HomeDirectory"],
             "InstallationDirectory": system_info["$InstallationDirectory"],
@@ -77,10 +79,11 @@ def about_page(request):
             "optional_software": optional_software,
             "PIL_version": mathics_version_info["PIL"],
             "python_version": mathics_version_info["python"],
+            "session_stats": get_session_evaluation_stats(),
             "settings": settings,
             "sympy_version": mathics_version_info["sympy"],
             "three_js_version": get_threejs_version(),
-            "user_settings": get_user_settings(evaluation),
+            "user_settings": get_evaluation_backend().get_user_settings(session_key),
         },
     )
 
@@ -105,6 +108,18 @@ def get_MathJax_version():
         return "?.?.?"
 
 
+def get_mathics_system_info() -> dict:
+    """
+    Get Mathics3's information about the system from the evaluation
+    backend, once: it takes Definitions to evaluate in. The memory
+    available is therefore that of the first visit.
+    """
+    global mathics_system_info_data
+    if not mathics_system_info_data:
+        mathics_system_info_data = get_evaluation_backend().get_system_info()
+    return mathics_system_info_data
+
+
 def get_mathics_threejs_backend_data():
     """Load mathics-three-package.json. It contains version information."""
     global mathics_threejs_backend_data
@@ -128,29 +143,3 @@ def get_threejs_version():
     Get the three.js via information from mathics_threejs_backend's package/version.json.
     """
     return get_mathics_threejs_backend_data().get("threejs_revision", "??")
-
-
-def get_user_settings(evaluation: Evaluation):
-    definitions = evaluation.definitions
-    setting_names = sorted(definitions.get_matching_names("Settings`*"))
-    user_settings = {}
-
-    evaluation.stopped = False
-
-    for setting_name in setting_names:
-        rule = evaluation.parse(setting_name)
-        value = rule.evaluate(evaluation).to_python()
-
-        setting_usage_expr = evaluation.parse(setting_name + "::usage")
-        setting_usage = setting_usage_expr.evaluate(evaluation).to_python(
-            string_quotes=False
-        )
-
-        user_settings[setting_name] = {
-            "value": value,
-            "usage": setting_usage,
-            "is_boolean": type(value) is bool,
-            "boolean_value": value,
-        }
-
-    return user_settings
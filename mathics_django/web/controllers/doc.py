@@ -2,39 +2,76 @@
 Controllers related to showing Mathics3 documentation inside Django
 """
 
+import hashlib
+import os.path as osp
+import threading
 from copy import copy
-from typing import Union
+from functools import wraps
+from typing import List, Optional, Tuple, Union
 
+from django.conf import settings
+from django.core.cache import caches
 from django.core.handlers.wsgi import WSGIRequest
 from django.http import Http404, HttpResponse
 from django.shortcuts import render
+from mathics import __version__ as mathics_version
 from mathics.doc.common_doc import MATHICS3_MODULES_TITLE
 from mathics.doc.gather import doc_chapter as gather_doc_chapter
 from mathics.doc.utils import slugify
 from mathics.eval.pymathics import pymathics_builtins_by_module, pymathics_modules
 
-from mathics_django.doc import documentation
+from mathics_django.doc import (
+    get_documentation,
+    get_documentation_if_ready,
+    start_documentation_warmup,
+)
 from mathics_django.doc.django_doc import (
     DjangoDocChapter,
     DjangoDocPart,
     DjangoDocSection,
+    doc_data_stamp,
+    doctest_html_store_path,
 )
-from mathics_django.web.views import JsonResponse
+from mathics_django.version import __version__
+from mathics_django.web.evaluation import on_modules_loaded
+from mathics_django.web.views import JSON_CONTENT_TYPE, JsonResponse
 
 DocResponse = Union[HttpResponse, JsonResponse]
 
-seen_pymathics_modules = copy(pymathics_modules)
+# Held while adding documentation; see add_loaded_modules_documentation().
+doc_refresh_lock = threading.Lock()
 
 MATHICS3_MODULES_SLUG = slugify(MATHICS3_MODULES_TITLE)
 
+# Rendered pages; see cache_rendered_doc().
+doc_cache = caches["doc"]
+
+# Changes whenever the rendered pages would; see get_doc_cache_version().
+doc_cache_version: Optional[str] = None
+
+# In the tree of pages built by docstatic.py: the value of
+# get_doc_cache_version() the pages were rendered for.
+STATIC_DOC_VERSION_FILE = "doc-version.txt"
 
-def check_for_new_load_modules():
+HTML_CONTENT_TYPE = "text/html; charset=utf-8"
+
+
+def add_loaded_modules_documentation():
     """
-    See if we have loaded any new Mathics3 modules since the last time
-    we checked. If so get an add the documentation for that.
+    Add the documentation of the Mathics3 modules loaded since the
+    documentation was built or last added to. The search index, the
+    previous and next links and the version of the rendered pages are
+    brought up to date along with it.
     """
-    global seen_pymathics_modules
-    if seen_pymathics_modules != pymathics_modules:
+    global doc_cache_version
+    documentation = get_documentation()
+    with doc_refresh_lock:
+        # Copying is atomic, unlike going over a set that may be growing.
+        loaded_modules = copy(pymathics_modules)
+        new_modules = loaded_modules - documentation.pymathics_modules
+        if not new_modules:
+            return
+
         mathics3_module_part = documentation.parts_by_slug.get(
             MATHICS3_MODULES_SLUG, None
         )
@@ -44,28 +81,158 @@ def check_for_new_load_modules():
             )
 
         # The "Mathics3 modules" part already exists; add the new chapters.
-        new_modules = pymathics_modules - seen_pymathics_modules
         for new_module in new_modules:
             gather_doc_chapter(
                 new_module, mathics3_module_part, pymathics_builtins_by_module
             )
-        seen_pymathics_modules = copy(pymathics_modules)
-    return
+        if mathics3_module_part is not None:
+            documentation.update_search_index(mathics3_module_part)
+            documentation.update_navigation(mathics3_module_part)
+        documentation.pymathics_modules = loaded_modules
+        # Last, so that pages of the new version are only rendered from
+        # the documentation with everything above done.
+        doc_cache_version = None
+
+
+def modules_loaded():
+    """
+    Called when a query has loaded Mathics3 modules. Their documentation
+    is added in a thread of its own, so that the query does not wait.
+    """
+    threading.Thread(
+        target=add_loaded_modules_documentation,
+        name="Mathics3 module documentation",
+        daemon=True,
+    ).start()
+
+
+on_modules_loaded(modules_loaded)
+
+if settings.DOC_WARMUP:
+    start_documentation_warmup()
+
+
+def get_doc_cache_version() -> str:
+    """
+    Return a string that changes whenever the documentation does: when
+    Mathics3 or Mathics3 Django are upgraded, other doctest data is read,
+    or Mathics3 modules are loaded. A cache kept in files may outlive
+    the process, so this does not depend on anything else.
+
+    This does not need the documentation to be built, so that pages that
+    have been rendered are served while it is being built.
+    """
+    global doc_cache_version
+    if doc_cache_version is not None:
+        return doc_cache_version[:16]
+
+    documentation = get_documentation_if_ready()
+    # Until it is built, the modules it will have are those loaded.
+    modules = (
+        copy(pymathics_modules)
+        if documentation is None
+        else documentation.pymathics_modules
+    )
+    state = (
+        mathics_version,
+        __version__,
+        doctest_html_store_path,
+        doc_data_stamp,
+        sorted(module.__name__ for module in modules),
+    )
+    version = hashlib.sha256(repr(state).encode("utf-8")).hexdigest()
+    if documentation is not None:
+        doc_cache_version = version
+    return version[:16]
+
 
+def cache_rendered_doc(view):
+    """
+    Keep the pages rendered by ``view``, both the standalone and the ajax
+    kind, in the "doc" cache, so that each is only rendered once for a
+    given documentation.
+    """
+
+    @wraps(view)
+    def cached_view(request: WSGIRequest, *args, ajax: bool = False, **kwargs):
+        names = [
+            kwargs[name]
+            for name in ("part", "chapter", "section", "subsection")
+            if name in kwargs
+        ]
+        key = ":".join(
+            [
+                get_doc_cache_version(),
+                view.__name__,
+                "ajax" if ajax else "html",
+                *args,
+                *names,
+            ]
+        )
+        cached = doc_cache.get(key)
+        if cached is None:
+            cached = read_static_doc([*args, *names], ajax)
+            if cached is not None:
+                doc_cache.set(key, cached)
+        if cached is not None:
+            content_type, content = cached
+            return HttpResponse(content, content_type=content_type)
+
+        response = view(request, *args, ajax=ajax, **kwargs)
+        if response.status_code == 200:
+            doc_cache.set(key, (response["Content-Type"], response.content))
+        return response
+
+    return cached_view
+
+
+def static_doc_path(path: List[str], ajax: bool) -> str:
+    """
+    Return the file that holds, in the tree built by docstatic.py, the
+    page for the slugs in ``path``.
+    """
+    return osp.join(
+        settings.DOC_STATIC_DIR,
+        settings.BASE_URL.strip("/"),
+        "ajax" if ajax else "",
+        "doc",
+        *path,
+        "index.html",
+    )
 
+
+def read_static_doc(path: List[str], ajax: bool) -> Optional[Tuple[str, bytes]]:
+    """
+    Return the content type and content of the page for the slugs in
+    ``path`` in the tree built by docstatic.py. None is returned if the
+    page is not there, or was built for other documentation.
+    """
+    try:
+        version_path = osp.join(settings.DOC_STATIC_DIR, STATIC_DOC_VERSION_FILE)
+        with open(version_path, "r") as version_file:
+            if version_file.read().strip() != get_doc_cache_version():
+                return None
+        with open(static_doc_path(path, ajax), "rb") as page_file:
+            content = page_file.read()
+    except OSError:
+        return None
+    return (JSON_CONTENT_TYPE if ajax else HTML_CONTENT_TYPE), content
+
+
+@cache_rendered_doc
 def doc(request: WSGIRequest, ajax: bool = False) -> DocResponse:
-    check_for_new_load_modules()
     return render_doc(
         request,
         "overview.html",
         {
             "title": "Documentation",
-            "doc": documentation,
+            "doc": get_documentation(),
         },
         ajax=ajax,
     )
 
 
+@cache_rendered_doc
 def doc_chapter(
     request: WSGIRequest, part: str, chapter: str, ajax: bool = False
 ) -> DocResponse:
@@ -76,8 +243,7 @@ def doc_chapter(
     * Introduction (in part Manual)
     * Procedural Programming (in part Reference of Built-in Symbols)
     """
-    check_for_new_load_modules()
-    chapter = documentation.get_chapter(part, chapter)
+    chapter = get_documentation().get_chapter(part, chapter)
     if not chapter:
         raise Http404
     return render_doc(
@@ -92,6 +258,7 @@ def doc_chapter(
     )
 
 
+@cache_rendered_doc
 def doc_part(request: WSGIRequest, part: str, ajax: bool = False) -> DocResponse:
     """
     Produces HTML via jinja templating for a Part - the top-most
@@ -99,8 +266,7 @@ def doc_part(request: WSGIRequest, part: str, ajax: bool = False) -> DocResponse
     * Manual
     * Reference of Built-in Symbols
     """
-    check_for_new_load_modules()
-    part = documentation.get_part(part)
+    part = get_documentation().get_part(part)
     if not part:
         raise Http404
     return render_doc(
@@ -116,9 +282,32 @@ def doc_part(request: WSGIRequest, part: str, ajax: bool = False) -> DocResponse
 
 
 def doc_search(request: WSGIRequest) -> DocResponse:
-    check_for_new_load_modules()
+    """
+    Searches the documentation for the "query" parameter. At most
+    "limit" results are given, if that is set. With "format=json", the
+    results are sent as a list of their titles, URIs and whether they
+    are exact matches; otherwise, the page of the single best result or
+    a page listing them is sent.
+    """
     query = request.GET.get("query", "")
-    result = documentation.search(query)
+    limit = request.GET.get("limit")
+    if limit is not None:
+        try:
+            limit = int(limit)
+            if limit < 1:
+                raise ValueError(limit)
+        except ValueError:
+            return JsonResponse({"error": "limit must be a positive integer"}, 400)
+    result = get_documentation().search(query, limit)
+    if request.GET.get("format") == "json":
+        return JsonResponse(
+            {
+                "results": [
+                    {"title": item.title, "uri": item.get_uri(), "exact": exact}
+                    for exact, item in result
+                ]
+            }
+        )
     if len([item for exact, item in result if exact]) <= 1:
         for exact, item in result:
             if exact and (len(item.slug) > 4) or len(result) == 1:
@@ -158,6 +347,7 @@ def doc_search(request: WSGIRequest) -> DocResponse:
     )
 
 
+@cache_rendered_doc
 def doc_section(
     request: WSGIRequest,
     part: str,
@@ -173,8 +363,7 @@ def doc_section(
     * A list of builtin-functions under a Guide Section. For example: Color Directives.
       The guide section here would be Colors.
     """
-    check_for_new_load_modules()
-    section_obj = documentation.get_section(part, chapter, section)
+    section_obj = get_documentation().get_section(part, chapter, section)
     if not section_obj:
         raise Http404
     data = section_obj.html_data()
@@ -193,6 +382,7 @@ def doc_section(
     )
 
 
+@cache_rendered_doc
 def doc_subsection(
     request: WSGIRequest,
     part: str,
@@ -207,8 +397,9 @@ def doc_subsection(
     organized in a guide section are tagged as a section rather than a
     subsection.)
     """
-    check_for_new_load_modules()
-    subsection_obj = documentation.get_subsection(part, chapter, section, subsection)
+    subsection_obj = get_documentation().get_subsection(
+        part, chapter, section, subsection
+    )
     if not subsection_obj:
         raise Http404
     data = subsection_obj.html_data()
@@ -243,7 +434,6 @@ def render_doc(
     If ``ajax`` is True the should the ajax URI prefix, e.g. " it we pass the result
 
     """
-    check_for_new_load_modules()
     object = context.get("object")
     context.update(
         {
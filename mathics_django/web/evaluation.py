@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""
+Evaluation of worksheet cells.
+
+Nothing in here depends on Django being set up, so that this can also be
+used in evaluation worker processes; see mathics_django.web.backends.
+"""
+
+import threading
+import traceback
+from typing import Callable, Iterator, List, Optional
+
+from mathics.core.definitions import Definitions
+from mathics.core.evaluation import Evaluation, Message, Output, Result
+from mathics.core.parser import MathicsMultiLineFeeder
+from mathics.eval.pymathics import load_pymathics_module, pymathics_modules
+from mathics.system_info import mathics_system_info
+from pygments import highlight
+from pygments.formatters import HtmlFormatter
+from pygments.lexers import PythonTracebackLexer
+
+from mathics_django import settings
+from mathics_django.web.format import OutputPreviews, format_output, format_preview
+from mathics_django.web.session_definitions import new_session_definitions
+from mathics_django.web.settings_snapshot import get_settings_snapshot
+
+html_formatter = HtmlFormatter(noclasses=True)
+
+# Called when a query has loaded Mathics3 modules; see on_modules_loaded().
+modules_loaded_listeners: List[Callable[[], None]] = []
+loaded_module_count = len(pymathics_modules)
+
+
+class WebOutput(Output):
+    """
+    Passes the data of each Print[] output and message to ``listener``,
+    if set, as soon as it is produced.
+    """
+
+    listener: Optional[Callable[[dict], None]] = None
+
+    def out(self, out):
+        if self.listener is not None:
+            self.listener(out.get_data())
+
+
+def on_modules_loaded(listener: Callable[[], None]):
+    """
+    Have ``listener`` called after each query that loads Mathics3 modules,
+    with LoadModule[].
+    """
+    modules_loaded_listeners.append(listener)
+
+
+def check_modules_loaded():
+    """
+    Call the ``on_modules_loaded()`` listeners if Mathics3 modules have
+    been loaded since the last time this was called.
+    """
+    global loaded_module_count
+    count = len(pymathics_modules)
+    if count != loaded_module_count:
+        loaded_module_count = count
+        for listener in modules_loaded_listeners:
+            listener()
+
+
+def add_loaded_modules(module_names: List[str]):
+    """
+    Load in this process the Mathics3 modules ``module_names`` loaded by
+    a query in an evaluation worker process, so that they are documented
+    here as well, and call the ``on_modules_loaded()`` listeners.
+    """
+    loaded_names = {module.__name__ for module in list(pymathics_modules)}
+    for module_name in module_names:
+        if module_name in loaded_names:
+            continue
+        try:
+            # Sessions live in the workers, so the definitions of the
+            # module are not needed here.
+            load_pymathics_module(Definitions(), module_name)
+        except Exception:
+            print(f"Trouble loading Mathics3 module {module_name}:")
+            traceback.print_exc()
+    check_modules_loaded()
+
+
+def new_session_evaluation(session_key: str) -> Evaluation:
+    """
+    Create the Evaluation object used by a new session.
+    """
+    definitions = new_session_definitions()
+    # We set the formatter to "unformatted" so that we can use
+    # our own custom formatter that understand better how to format
+    # in the context of mathics-django.
+    # Previously, one specific format, like "xml" had to fit all.
+    evaluation = Evaluation(definitions, format="xml", output=WebOutput())
+    evaluation.format_output = lambda expr, format: format_output(
+        evaluation, expr, format
+    )
+    evaluation.output_previews = OutputPreviews()
+    evaluation.query_aborted = False
+    return evaluation
+
+
+def html_format_traceback_line(tb_line: str) -> str:
+    tb = highlight(tb_line, PythonTracebackLexer(), html_formatter)
+    return f'<p style="white-space: pre-wrap; word-wrap: break-word;">{tb}</p>'
+
+
+def python_exception_result(exc: Exception) -> Result:
+    """
+    Return a Result showing the Python exception ``exc`` and its traceback.
+    """
+    call_stack = traceback.format_exception(exc)
+    # TODO: we may want to do other processing on the traceback
+    #       like splitting up lines. Encapsulate the below and put
+    #       in a function.
+    # FIXME: allow the the stack limit to be user settable
+
+    html_formatted_callstack = []
+    if len(call_stack) > 18:
+        html_formatted_callstack = [html_format_traceback_line(call_stack[0])]
+        html_formatted_callstack += [
+            html_format_traceback_line(tb_line) for tb_line in call_stack[1:9]
+        ]
+        html_formatted_callstack.append("<p>...</p>")
+        html_formatted_callstack += [
+            html_format_traceback_line(tb_line) for tb_line in call_stack[-9:]
+        ]
+    else:
+        html_formatted_callstack = [
+            html_format_traceback_line(tb_line) for tb_line in call_stack
+        ]
+
+    except_head = f"Exception raised: {exc}"
+    message = Message(
+        "Python Exception",
+        tag="exception",
+        text=[except_head] + html_formatted_callstack,
+    )
+    return Result(
+        out=[message],
+        result=None,
+        line_no=None,
+        last_eval=None,
+        form="Python Exception",
+    )
+
+
+def abort_evaluation(evaluation: Evaluation, timed_out: bool = False):
+    """
+    Ask an ``evaluate_query()`` running on ``evaluation``, possibly in
+    another thread, to stop. The expression being evaluated gives
+    $Aborted and the rest of the cell is skipped.
+
+    This is cooperative: it takes effect the next time the evaluator
+    checks whether it has been stopped, which it does often but not
+    inside long-running Python code.
+    """
+    evaluation.query_aborted = True
+    if not timed_out:
+        # Evaluation.evaluate() issues General::timeout when stopped,
+        # unless it thinks it has already done so.
+        evaluation.timeout = True
+    evaluation.stopped = True
+
+
+def aborted_result() -> dict:
+    return Result(out=[], result="$Aborted", line_no=None).get_data()
+
+
+def busy_result() -> dict:
+    message = Message(
+        "General",
+        tag="busy",
+        text="The server is busy with other evaluations; try again shortly.",
+    )
+    return Result(out=[message], result=None, line_no=None).get_data()
+
+
+def session_busy_result() -> dict:
+    message = Message(
+        "General",
+        tag="busy",
+        text="This session is still busy with earlier evaluations; "
+        "try again when they have finished.",
+    )
+    return Result(out=[message], result=None, line_no=None).get_data()
+
+
+def evaluate_query(
+    evaluation: Evaluation,
+    input: str,
+    timeout: Optional[float] = None,
+    on_out: Optional[Callable[[dict], None]] = None,
+) -> Iterator[dict]:
+    """
+    Evaluate the Mathics3 code in a worksheet cell, ``input``, yielding the
+    ``Result.get_data()`` dictionary of each expression as it is evaluated.
+
+    If ``timeout`` is given, the evaluation is aborted after that many
+    seconds. If ``on_out`` is given, it is called with the data of each
+    Print[] output and message as it is produced, ahead of the result
+    that it is part of.
+
+    If ``abort_evaluation()`` was called before this started, nothing is
+    evaluated and the result is $Aborted. Once this is done, the
+    evaluation is no longer marked as aborted.
+    """
+    feeder = MathicsMultiLineFeeder(input, "Django-cell-input")
+    evaluation.output.listener = on_out
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, abort_evaluation, (evaluation, True))
+        timer.daemon = True
+        timer.start()
+    try:
+        while not feeder.empty():
+            if evaluation.query_aborted:
+                # Aborted between two expressions.
+                yield aborted_result()
+                break
+            (
+                expr,
+                source_code,
+                messages,
+            ) = evaluation.parse_feeder_returning_code_and_messages(feeder)
+            if len(messages) > 0 and messages[0].tag in ("sntxf", "sntxb", "sntxi"):
+                # Syntax or Parse errors.
+
+                # For simplicity, when there is an error there will be just one
+                # error shown and we will use a dictionary for that rather than
+                # an array of dictionaries. This simplifies Javascript, formatting
+                # because at the top level we don't need a list element.
+
+                # Strip quotes from messages.
+                message = evaluation.out[0]
+
+                if message.text.startswith('"') and message.text.endswith('"'):
+                    message.text = message.text[1:-1]
+                yield Result(
+                    out=evaluation.out,
+                    result=None,
+                    line_no=None,
+                    last_eval=None,
+                    form="Syntax Error",
+                ).get_data()
+
+                if settings.LOG_ON_CONSOLE:
+                    print(source_code)
+                    print(message.text)
+
+                evaluation.out = []
+                expr = None
+
+            if expr is None:
+                # comment or an error.
+                # TODO: source_code should have '(* ... *)' and
+                # better would be to create tagged result.
+                continue
+
+            result = evaluation.evaluate(expr)
+            data = result.get_data()
+            more = evaluation.output_previews.take_more(data["result"])
+            if more is not None:
+                data["more"] = more
+            yield data
+            if evaluation.query_aborted:
+                break
+
+    except SystemExit:
+        # Quit[] or Exit[]: start over with fresh definitions.
+        evaluation.definitions = new_session_definitions()
+
+    except Exception as exc:
+        # Should we show the Python exception details back to the user?
+        if settings.DEBUG and settings.DISPLAY_EXCEPTIONS:
+            yield python_exception_result(exc).get_data()
+        else:
+            raise
+
+    finally:
+        evaluation.output.listener = None
+        if timer is not None:
+            timer.cancel()
+        evaluation.query_aborted = False
+        check_modules_loaded()
+
+
+def more_output(evaluation: Evaluation, handle: str, offset: int) -> Optional[dict]:
+    """
+    Return the next part of a result that was shown as a preview, from
+    element ``offset`` on: ``{"result": formatted, "more": more}`` where
+    ``more`` says how to ask for the part after it, as in the data of the
+    result, or is None if there is nothing left. Return None if the
+    preview ``handle`` is no longer kept.
+    """
+    preview = evaluation.output_previews.get(handle)
+    if preview is None:
+        return None
+    expr, html_tag_format, budget = preview
+
+    evaluation.stopped = False
+    result, end, total = format_preview(
+        evaluation, expr, html_tag_format, budget, offset
+    )
+    more = None
+    if end < total:
+        more = {"handle": handle, "offset": end, "remaining": total - end}
+    return {"result": result, "more": more}
+
+
+def get_user_settings(evaluation: Evaluation) -> dict:
+    """
+    Return the value and usage of each ``Settings`*`` symbol, keyed by
+    symbol name.
+    """
+    evaluation.stopped = False
+    return get_settings_snapshot(evaluation)
+
+
+def get_system_info() -> dict:
+    """
+    Return Mathics3's information about the system it runs on. Getting
+    it evaluates, so it takes Definitions of a session of its own.
+    """
+    return mathics_system_info(new_session_definitions())
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+A bounded pool of per-session Mathics3 Evaluation objects.
+
+Each browser session gets its own ``Evaluation`` (and with that its own
+``Definitions``), which is fairly large. Without a bound, a long-lived
+public server accumulates one of these for every visitor it has ever
+seen. The pool below keeps at most a fixed number of them, drops the
+least-recently-used one when full, expires sessions that have been idle
+for too long, and sheds sessions when the process grows past a memory
+high-water mark.
+"""
+
+import gc
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def get_process_memory() -> Optional[int]:
+    """
+    Return the resident set size of this process in bytes, or None if
+    we have no way of finding that out on this platform.
+    """
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as statm:
+            resident_pages = int(statm.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE")
+
+
+class SessionEvaluationPool:
+    """
+    Maps a session key to an object created by ``factory``, keeping
+    entries in least-recently-used order.
+
+    ``max_size`` is the largest number of sessions kept; 0 means no limit.
+    ``idle_timeout`` is the number of seconds a session can go unused
+    before it is dropped; 0 means sessions never expire.
+    ``memory_high_water`` is a resident-memory size in bytes; while the
+    process is above it, one least-recently-used session is dropped on
+    each lookup. 0 disables this check.
+    ``on_evict``, if given, is called with the key of each session that
+    the pool drops by itself, for any of the reasons above; sessions
+    removed with ``discard()`` or ``clear()`` are not passed to it.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[str], object],
+        max_size: int = 0,
+        idle_timeout: float = 0,
+        memory_high_water: int = 0,
+        on_evict: Optional[Callable[[str], None]] = None,
+    ):
+        self.factory = factory
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.memory_high_water = memory_high_water
+        self.on_evict = on_evict
+
+        # session key -> (evaluation, time of last use)
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.memory_evictions = 0
+
+    def __contains__(self, session_key: str) -> bool:
+        return session_key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, session_key: str, create: bool = True):
+        """
+        Return the object for ``session_key``, creating it with ``factory``
+        if it is not in the pool and ``create`` is True. If ``create`` is
+        False and there is no entry, None is returned.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._expire_idle(now)
+            entry = self._entries.get(session_key)
+            if entry is not None:
+                self.hits += 1
+                self._entries[session_key] = (entry[0], now)
+                self._entries.move_to_end(session_key)
+                return entry[0]
+            if not create:
+                return None
+            self.misses += 1
+
+        # Creating an evaluation can take a while; don't hold up lookups
+        # of other sessions meanwhile.
+        value = self.factory(session_key)
+
+        with self._lock:
+            entry = self._entries.get(session_key)
+            if entry is not None:
+                # Another thread created this session while we were busy.
+                value = entry[0]
+            self._entries[session_key] = (value, now)
+            self._entries.move_to_end(session_key)
+            self._evict_over_size()
+            self._evict_over_memory(session_key)
+        return value
+
+    def discard(self, session_key: str) -> bool:
+        """
+        Remove ``session_key`` from the pool. Return True if it was there.
+        """
+        with self._lock:
+            return self._entries.pop(session_key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def expire_idle(self) -> int:
+        """
+        Drop all sessions that have been idle longer than ``idle_timeout``.
+        Return the number of sessions dropped.
+        """
+        with self._lock:
+            return self._expire_idle(time.monotonic())
+
+    def stats(self) -> Dict[str, int]:
+        """Return usage counters for the pool."""
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "memory_evictions": self.memory_evictions,
+            }
+
+    def _expire_idle(self, now: float) -> int:
+        if not self.idle_timeout:
+            return 0
+        expired = 0
+        # Entries are kept in order of last use, so the idle ones are
+        # all at the front.
+        while self._entries:
+            session_key, (_, last_used) = next(iter(self._entries.items()))
+            if now - last_used <= self.idle_timeout:
+                break
+            del self._entries[session_key]
+            self._evicted(session_key)
+            expired += 1
+        self.expirations += expired
+        return expired
+
+    def _evict_over_size(self):
+        if not self.max_size:
+            return
+        while len(self._entries) > self.max_size:
+            session_key, _ = self._entries.popitem(last=False)
+            self._evicted(session_key)
+            self.evictions += 1
+
+    def _evict_over_memory(self, current_key: str):
+        if not self.memory_high_water or len(self._entries) <= 1:
+            return
+        memory = get_process_memory()
+        if memory is None or memory <= self.memory_high_water:
+            return
+        oldest_key = next(iter(self._entries))
+        if oldest_key == current_key:
+            return
+        del self._entries[oldest_key]
+        self._evicted(oldest_key)
+        self.memory_evictions += 1
+        gc.collect()
+
+    def _evicted(self, session_key: str):
+        if self.on_evict is not None:
+            self.on_evict(session_key)
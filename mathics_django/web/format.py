@@ -2,7 +2,13 @@
 Format Mathics3 objects
 """
 
+import itertools
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+
 from mathics.core.atoms import String
+from mathics.core.expression import Expression
 from mathics.core.systemsymbols import (
     SymbolAborted,
     SymbolFailed,
@@ -13,6 +19,13 @@ from mathics.core.systemsymbols import (
 )
 from mathics.format.box import format_element
 
+from mathics_django import settings
+from mathics_django.web.graphics_cache import (
+    graphics_files_present,
+    move_graphics_out_of_band,
+)
+from mathics_django.web.settings_snapshot import get_setting
+
 # Maps a Form to a kind of html format.
 # text is the usual text-kind of output.
 # LaTeX is handled by MathJaX display mode $$ $$
@@ -36,6 +49,344 @@ def safe_html_string(value):
     return value  # mark_safe(escape_html(value))
 
 
+class _ExpressionKey:
+    """
+    Wraps an expression so that it can be used in a dictionary key.
+    Expressions hash by their structure but compare by identity, so
+    equality here is SameQ.
+    """
+
+    __slots__ = ("expr", "hash")
+
+    def __init__(self, expr):
+        self.expr = expr
+        self.hash = hash(expr)
+
+    def __hash__(self):
+        return self.hash
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, _ExpressionKey)
+            and self.hash == other.hash
+            and self.expr.sameQ(other.expr)
+        )
+
+
+class FormattedOutputCache:
+    """
+    A least-recently-used cache of formatted output, holding at most
+    ``max_size`` entries, 0 disabling caching, of at most ``max_length``
+    characters in all.
+
+    Formatting an expression as MathML, TeX or text can take far longer
+    than evaluating it, and the same results come up over and over:
+    ``%`` and ``Out[n]``, re-evaluated worksheet cells, documentation
+    examples shared by every session.
+    """
+
+    def __init__(self, max_size: int, max_length: int = 64 * 1024 * 1024):
+        self.max_size = max_size
+        self.max_length = max_length
+        self.length = 0
+        self.entries: "OrderedDict[Hashable, str]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Optional[str]:
+        with self.lock:
+            result = self.entries.get(key)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return result
+
+    def put(self, key: Hashable, result: str):
+        if not self.max_size or len(result) > self.max_length:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.length -= len(previous)
+            self.entries[key] = result
+            self.length += len(result)
+            while len(self.entries) > self.max_size or self.length > self.max_length:
+                _, evicted = self.entries.popitem(last=False)
+                self.length -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.length = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+format_cache = FormattedOutputCache(settings.FORMAT_CACHE_SIZE)
+
+# Tells apart the Definitions objects that have formatting of their own.
+_definitions_serials = itertools.count()
+
+# Symbols whose rules, besides Format[] rules, change how things are formatted.
+FORMATTING_SYMBOLS = frozenset(("System`MakeBoxes", "System`Format"))
+
+
+def formatting_state(definitions) -> Tuple:
+    """
+    Return a key for what, in ``definitions``, formatting depends on:
+    the current context and context path, the user and Mathics3 module
+    definitions that can change how things are formatted, and the
+    options of forms such as NumberForm. These definitions are Format[]
+    and MakeBoxes rules, upvalues, and the Settings` variables.
+
+    Sessions that have not changed any of those share the formatting of
+    the builtin definitions, and so get the same key. Otherwise the key
+    is particular to ``definitions``, and changes with these definitions.
+    """
+    # Working this out means going over the user definitions, so it is
+    # kept until some definition changes.
+    cached = getattr(definitions, "formatting_state", None)
+    if cached is None or cached[0] != definitions.now:
+        cached = (definitions.now,) + _definitions_state(definitions)
+        definitions.formatting_state = cached
+    _, state, option_names = cached
+    return state + (form_options_state(definitions, option_names),)
+
+
+def _definitions_state(definitions) -> Tuple[Tuple, Tuple[str, ...]]:
+    """
+    Return the part of ``formatting_state()`` that only changes along
+    with ``definitions.now``, and the names of the symbols whose options
+    formatting depends on.
+    """
+    formatting = [
+        (name, definition)
+        for layer in (definitions.pymathics, definitions.user)
+        for name, definition in layer.items()
+        if definition.formatvalues
+        or definition.upvalues
+        or name in FORMATTING_SYMBOLS
+        or name.startswith("Settings`")
+    ]
+    changed = tuple((name, definition.changed) for name, definition in formatting)
+    if changed:
+        serial = getattr(definitions, "formatting_serial", None)
+        if serial is None:
+            serial = definitions.formatting_serial = next(_definitions_serials)
+        changed = (serial,) + changed
+    state = (
+        definitions.get_current_context(),
+        definitions.get_context_path(),
+        changed,
+    )
+    option_names = _builtin_form_names(definitions) + tuple(
+        name for name, definition in formatting if definition.options
+    )
+    return state, option_names
+
+
+def _builtin_form_names(definitions) -> Tuple[str, ...]:
+    """
+    Return the names of the builtin forms, such as NumberForm, that have
+    options.
+    """
+    names = getattr(definitions, "builtin_form_names", None)
+    if names is None:
+        names = definitions.builtin_form_names = tuple(
+            name
+            for name, definition in definitions.builtin.items()
+            if name.endswith("Form") and definition.options
+        )
+    return names
+
+
+def form_options_state(definitions, names) -> Tuple:
+    """
+    Return the options of the symbols ``names`` in ``definitions``.
+
+    SetOptions[] changes options in place, without marking the definition
+    as changed, so these are read each time rather than kept.
+    """
+    return tuple((name, tuple(definitions.get_options(name).items())) for name in names)
+
+
+# Expressions with these heads are shown whole or not at all: cutting
+# elements out of them would not give a smaller picture of the same thing.
+UNCUT_HEADS = frozenset(("System`Graphics", "System`Graphics3D", "System`Sound"))
+
+
+def can_be_cut(expr) -> bool:
+    """
+    Return whether a preview of ``expr`` may leave out some of its elements.
+    """
+    if not isinstance(expr, Expression):
+        return False
+    head_name = expr.get_head_name()
+    return head_name not in UNCUT_HEADS and not head_name.endswith("Box")
+
+
+def count_leaves(expr, limit: Optional[int] = None) -> int:
+    """
+    Return the number of leaves of ``expr``, the parts of it that a
+    preview shows whole, counting no further than just past ``limit``.
+    """
+    count = 0
+    stack = [expr]
+    while stack:
+        part = stack.pop()
+        if can_be_cut(part):
+            stack.extend(part.elements)
+        else:
+            count += 1
+            if limit is not None and count > limit:
+                break
+    return count
+
+
+def skeleton(count: int) -> String:
+    """Stands for ``count`` elements left out of a preview."""
+    return String(f"<<{count}>>")
+
+
+def cut_to_budget(expr, budget: int) -> Tuple[object, int]:
+    """
+    Return a preview of ``expr`` showing at most about ``budget`` leaves,
+    the first ones, and the number of leaves shown. Each run of elements
+    left out is replaced by a skeleton, ``<<n>>``, as ``Short`` does.
+    """
+    if not can_be_cut(expr):
+        return expr, 1
+    elements = expr.elements
+    shown = []
+    used = 0
+    for index, element in enumerate(elements):
+        if used >= budget:
+            shown.append(skeleton(len(elements) - index))
+            break
+        part, count = cut_to_budget(element, budget - used)
+        shown.append(part)
+        used += count
+    return Expression(expr.head, *shown), used
+
+
+def preview_window(expr, offset: int, budget: int) -> Tuple[object, int, int]:
+    """
+    Return a preview of ``expr`` that shows about ``budget`` leaves
+    starting with element ``offset`` of its paged level, the outermost
+    level with more than one element. Return as well the offset of the
+    first element not shown and the number of elements of that level.
+    """
+    heads = []
+    while can_be_cut(expr) and len(expr.elements) == 1:
+        heads.append(expr.head)
+        expr = expr.elements[0]
+    elements = expr.elements if can_be_cut(expr) else ()
+    shown = [skeleton(offset)] if offset else []
+    used = 0
+    end = offset
+    while end < len(elements) and used < budget:
+        part, count = cut_to_budget(elements[end], budget - used)
+        shown.append(part)
+        used += count
+        end += 1
+    if end < len(elements):
+        shown.append(skeleton(len(elements) - end))
+    window = Expression(expr.head, *shown) if elements else expr
+    for head in reversed(heads):
+        window = Expression(head, window)
+    return window, end, len(elements)
+
+
+class OutputPreviews:
+    """
+    The results of an evaluation that were too big to be shown whole,
+    kept so that the rest of them can be shown on demand. Only the
+    ``max_size`` latest ones are kept.
+
+    Each is known by a handle; its expression is kept, rather than its
+    formatted output, which is what is big.
+    """
+
+    def __init__(self, max_size: int = 16):
+        self.max_size = max_size
+        self.entries: "OrderedDict[str, Tuple[object, str, int]]" = OrderedDict()
+        self.handles = itertools.count(1)
+        # The formatted preview last made, and what to show more of it.
+        self.last: Optional[Tuple[str, dict]] = None
+
+    def add(self, expr, html_tag_format: str, budget: int) -> str:
+        handle = str(next(self.handles))
+        self.entries[handle] = (expr, html_tag_format, budget)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return handle
+
+    def get(self, handle: str) -> Optional[Tuple[object, str, int]]:
+        return self.entries.get(handle)
+
+    def take_more(self, result) -> Optional[dict]:
+        """
+        If ``result`` is the formatted preview made last, return what to
+        send for showing more of it: the preview's handle, the offset
+        the rest starts at and the number of elements left.
+        """
+        last, self.last = self.last, None
+        if last is not None and last[0] is result:
+            return last[1]
+        return None
+
+
+def format_preview(
+    evaluation, expr, html_tag_format: str, budget: int, offset: int = 0
+) -> Tuple[str, int, int]:
+    """
+    Format a preview of ``expr`` showing about ``budget`` leaves from
+    element ``offset`` of its paged level on; see ``preview_window()``.
+    The number of leaves shown is halved until the output fits in
+    OUTPUT_PREVIEW_BYTES.
+
+    Return the formatted preview, the offset of the first element not
+    shown and the number of elements of the paged level.
+    """
+    while True:
+        window, end, total = preview_window(expr, offset, budget)
+        result = format_cached_output(evaluation, window, html_tag_format)
+        max_bytes = settings.OUTPUT_PREVIEW_BYTES
+        if not max_bytes or len(result) <= max_bytes or budget <= 1:
+            return result, end, total
+        budget //= 2
+
+
+def format_output_preview(evaluation, expr, html_tag_format: str, budget: int):
+    """
+    Format a preview of ``expr``, whose output is too big to be shown
+    whole. If the evaluation keeps output previews, the rest of it can
+    be asked for; see ``OutputPreviews.take_more()``.
+    """
+    result, end, total = format_preview(evaluation, expr, html_tag_format, budget)
+    previews = getattr(evaluation, "output_previews", None)
+    if previews is not None and end < total:
+        handle = previews.add(expr, html_tag_format, budget)
+        previews.last = (
+            result,
+            {"handle": handle, "offset": end, "remaining": total - end},
+        )
+    return result
+
+
 def format_output(evaluation, expr, html_tag_format=None):
     """
     Handle unformatted output using the *specific* capabilities \
@@ -72,6 +423,48 @@ def format_output(evaluation, expr, html_tag_format=None):
         # For these forms, we strip off the outer "Form" part
         html_tag_format = FORM_TO_HTML_TAG_FORMAT[expr_type]
 
+    # Big results are shown as a preview. What is left out of it can be
+    # asked for later; see mathics_django.web.evaluation.more_output().
+    max_leaves = settings.OUTPUT_PREVIEW_LEAVES
+    if max_leaves and can_be_cut(expr) and count_leaves(expr, max_leaves) > max_leaves:
+        return format_output_preview(evaluation, expr, html_tag_format, max_leaves)
+
+    result = format_cached_output(evaluation, expr, html_tag_format)
+    max_bytes = settings.OUTPUT_PREVIEW_BYTES
+    if max_bytes and len(result) > max_bytes and can_be_cut(expr):
+        return format_output_preview(
+            evaluation, expr, html_tag_format, max(count_leaves(expr) // 2, 1)
+        )
+    return result
+
+
+def format_cached_output(evaluation, expr, html_tag_format: str) -> str:
+    """
+    Like ``format_uncached_output()``, going through ``format_cache``.
+    """
+    key = (
+        _ExpressionKey(expr),
+        html_tag_format,
+        formatting_state(evaluation.definitions),
+    )
+    result = format_cache.get(key)
+    if result is not None and not graphics_files_present(result):
+        # Its graphics files were pruned; they are written again.
+        result = None
+    if result is None:
+        out_count = len(evaluation.out)
+        result = format_uncached_output(evaluation, expr, html_tag_format)
+        # Messages and Print[] output from Format[] rules would be lost
+        # on a cache hit, so such results are formatted again each time.
+        if len(evaluation.out) == out_count:
+            format_cache.put(key, result)
+    return result
+
+
+def format_uncached_output(evaluation, expr, html_tag_format: str) -> str:
+    """
+    Format ``expr`` as ``html_tag_format``, "text", "xml" or "LaTeX".
+    """
     # This part is similar to mathics.core.evaluation.format_output().
     if html_tag_format == "text":
         boxed = format_element(expr, evaluation, SymbolOutputForm)
@@ -96,7 +489,7 @@ def format_output(evaluation, expr, html_tag_format=None):
             f"{boxed.to_mathml(evaluation=evaluation)}"
             "</math>"
         )
-        return safe_html_string(result)
+        return safe_html_string(move_graphics_out_of_band(result))
     elif html_tag_format == "LaTeX":
         boxed = format_element(expr, evaluation, SymbolTeXForm)
         if hasattr(boxed, "head") and boxed.head is SymbolInterpretationBox:
@@ -104,9 +497,7 @@ def format_output(evaluation, expr, html_tag_format=None):
             # We should probably address a long-standing mistake where strings
             # have quotes in them.
             box_str_sans_quotes = boxed.elements[0].value[1:-1]
-            render_TeXForm_expr = evaluation.parse("Settings`$RenderTeXForm")
-            render_TeXForm = render_TeXForm_expr.evaluate(evaluation).to_python()
-            if render_TeXForm:
+            if get_setting(evaluation, "Settings`$RenderTeXForm"):
                 box_str_sans_quotes = f"$${box_str_sans_quotes}$$"
             return box_str_sans_quotes
 
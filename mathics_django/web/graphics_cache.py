@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+Out-of-band delivery of big graphics.
+
+The formatted output of a Graphics result has its SVG picture in it, and
+that of a Graphics3D result the JSON scene drawn by
+mathics-threejs-backend. These can be megabytes. Rather than sending them
+inside the query response, each one bigger than GRAPHICS_INLINE_BYTES is
+written to a file named after the SHA-256 hash of its content, in
+``MEDIA_ROOT/graphics``, and the output refers to it by URL.
+
+The browser fetches these files alongside the rest of the output and can
+cache them for good, since a name always stands for the same content. The
+same picture, from any session, is written and sent only once. Scenes
+can also be fetched in a compact encoding; see pack_graphics3d().
+
+Nothing in here depends on Django being set up, so that this can also be
+used in evaluation worker processes.
+"""
+
+import base64
+import binascii
+import hashlib
+import html
+import json
+import os
+import os.path as osp
+import re
+import sys
+import tempfile
+import threading
+from array import array
+from typing import Optional
+
+from mathics_django import settings
+
+GRAPHICS_DIRECTORY = osp.join(settings.MEDIA_ROOT, "graphics")
+
+# File name suffixes and the content type each is served with.
+GRAPHICS_CONTENT_TYPES = {
+    ".svg": "image/svg+xml",
+    ".json": "application/json",
+}
+
+# The suffix of a Graphics3D scene with packed coordinates, which the
+# browser asks for with "?encoding=packed"; see pack_graphics3d().
+PACKED_SUFFIX = ".packed.json"
+
+# How the payloads appear in MathML output; see mathics.format.render.mathml.
+SVG_GLYPH_SOURCE = re.compile(r'src="data:image/svg\+xml;base64,([A-Za-z0-9+/=]*)"')
+GRAPHICS3D_DATA = re.compile(r"<graphics3d data='([^']*)'/>")
+
+# The names of the files that output refers to; see graphics_url().
+GRAPHICS_FILE_URL = re.compile(r'src="[^"]*/graphics/([0-9a-f]{64}\.(?:svg|json))"')
+
+# The directory is only pruned every so many files written.
+PRUNE_EVERY = 100
+
+_written = 0
+_written_lock = threading.Lock()
+
+
+def graphics_url(name: str) -> str:
+    return f"{settings.BASE_URL}/graphics/{name}"
+
+
+def graphics_path(name: str) -> str:
+    return osp.join(GRAPHICS_DIRECTORY, name)
+
+
+def store_graphics(content: bytes, suffix: str) -> Optional[str]:
+    """
+    Save ``content`` in the graphics directory, unless it is there
+    already, and return its file name. None is returned if it can't be
+    written.
+    """
+    name = hashlib.sha256(content).hexdigest() + suffix
+    path = graphics_path(name)
+    try:
+        if osp.exists(path):
+            # Keep it from being pruned as one of the oldest files.
+            os.utime(path)
+        else:
+            write_graphics_file(path, content)
+    except OSError:
+        return None
+    return name
+
+
+def write_graphics_file(path: str, content: bytes):
+    global _written
+    os.makedirs(GRAPHICS_DIRECTORY, exist_ok=True)
+    # Write under a temporary name, so that the file is never seen half
+    # written, and processes writing the same file don't clash.
+    fd, temporary_path = tempfile.mkstemp(suffix=".tmp", dir=GRAPHICS_DIRECTORY)
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(content)
+        os.chmod(temporary_path, 0o644)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+    with _written_lock:
+        _written += 1
+        prune = _written % PRUNE_EVERY == 0
+    if prune:
+        prune_graphics()
+
+
+def prune_graphics():
+    """
+    Remove the least recently used graphics files while the directory
+    holds more than GRAPHICS_CACHE_MB megabytes of them.
+    """
+    max_bytes = settings.GRAPHICS_CACHE_MB * 1024 * 1024
+    if not max_bytes:
+        return
+    try:
+        entries = [entry for entry in os.scandir(GRAPHICS_DIRECTORY) if entry.is_file()]
+        files = [
+            (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+            for entry in entries
+        ]
+    except OSError:
+        return
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            continue
+        total -= size
+
+
+def move_graphics_out_of_band(output: str) -> str:
+    """
+    Return the MathML ``output`` with each SVG picture and Graphics3D
+    scene bigger than GRAPHICS_INLINE_BYTES replaced by the URL of a file
+    holding it. A payload that can't be saved is left where it is.
+    """
+    max_inline = settings.GRAPHICS_INLINE_BYTES
+    if not max_inline or len(output) <= max_inline:
+        return output
+
+    def replace_svg(match: re.Match) -> str:
+        if len(match.group(1)) <= max_inline:
+            return match.group(0)
+        try:
+            svg = base64.b64decode(match.group(1), validate=True)
+        except binascii.Error:
+            return match.group(0)
+        name = store_graphics(svg, ".svg")
+        if name is None:
+            return match.group(0)
+        return f'src="{graphics_url(name)}"'
+
+    def replace_graphics3d(match: re.Match) -> str:
+        if len(match.group(1)) <= max_inline:
+            return match.group(0)
+        # The scene is the attribute's value, as the browser reads it.
+        scene = html.unescape(match.group(1))
+        name = store_graphics(scene.encode("utf-8"), ".json")
+        if name is None:
+            return match.group(0)
+        return f'<graphics3d src="{graphics_url(name)}"/>'
+
+    output = SVG_GLYPH_SOURCE.sub(replace_svg, output)
+    return GRAPHICS3D_DATA.sub(replace_graphics3d, output)
+
+
+def graphics_files_present(output: str) -> bool:
+    """
+    Return whether the files holding the graphics moved out of ``output``
+    by ``move_graphics_out_of_band()`` are all still there, as they may
+    have been pruned since. Those that are there are kept from being
+    pruned as some of the oldest files.
+    """
+    if "/graphics/" not in output:
+        return True
+    for name in GRAPHICS_FILE_URL.findall(output):
+        try:
+            os.utime(graphics_path(name))
+        except OSError:
+            return False
+    return True
+
+
+def pack_graphics3d(scene: dict) -> dict:
+    """
+    Return the Graphics3D ``scene`` with the coordinates of its elements
+    packed: all of them go, as little-endian 32-bit floats, in one
+    base64-encoded buffer, ``scene["packed"]["floats"]``, and the
+    "coords" of each element become the number of its points, which
+    follow those of the elements before it. Consecutive elements that
+    differ only in their points, like the polygons of a surface, are
+    merged into one whose "coords" is the list of their numbers of
+    points.
+
+    A coordinate written out in text takes about four times the room it
+    takes packed, and is much slower to parse; 32 bits are as much
+    precision as WebGL draws with anyway.
+
+    Elements with coordinates other than plain ``[[x, y, z], None]``
+    points, which are scaled, are left as they are.
+    """
+    floats = array("f")
+    elements = []
+    # The attributes, other than "coords", of the last packed element.
+    last_attributes = None
+    for element in scene.get("elements", []):
+        coords = element.get("coords")
+        offset = len(floats)
+        try:
+            for point, scaled in coords:
+                if scaled is not None or len(point) != 3:
+                    raise ValueError(point)
+                floats.extend(point)
+        except (TypeError, ValueError):
+            del floats[offset:]
+            elements.append(element)
+            last_attributes = None
+            continue
+
+        attributes = {key: value for key, value in element.items() if key != "coords"}
+        if attributes == last_attributes:
+            merged = elements[-1]
+            if not isinstance(merged["coords"], list):
+                merged["coords"] = [merged["coords"]]
+            merged["coords"].append(len(coords))
+        else:
+            elements.append(dict(attributes, coords=len(coords)))
+            last_attributes = attributes
+
+    if sys.byteorder == "big":
+        floats.byteswap()
+    packed = {
+        "version": 1,
+        "floats": base64.b64encode(floats.tobytes()).decode("ascii"),
+    }
+    return dict(scene, elements=elements, packed=packed)
+
+
+def packed_graphics3d_name(name: str) -> Optional[str]:
+    """
+    Return the name of the file holding the Graphics3D scene in file
+    ``name`` with its coordinates packed by ``pack_graphics3d()``, making
+    it if needed. None is returned if there is no scene ``name``.
+    """
+    packed_name = name[: -len(".json")] + PACKED_SUFFIX
+    packed_path = graphics_path(packed_name)
+    if osp.exists(packed_path):
+        return packed_name
+    try:
+        with open(graphics_path(name), "rb") as file:
+            scene = json.load(file)
+    except (OSError, ValueError):
+        return None
+    packed = json.dumps(pack_graphics3d(scene), separators=(",", ":"))
+    try:
+        write_graphics_file(packed_path, packed.encode("utf-8"))
+    except OSError:
+        return None
+    return packed_name
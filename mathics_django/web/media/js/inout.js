@@ -215,20 +215,15 @@ function setQueries(queries) {
 
     refreshInputSizes();
 
-    function load(index) {
-        if (index < queryList.length) {
-            submitQuery(queryList[index].li.textarea, () => load(index + 1));
-        } else {
-            createSortable();
-            lastFocus = null;
-
-            if (queriesElement.lastChild) {
-                queriesElement.lastChild.textarea.focus();
-            }
-        }
-    }
+    // All the cells are evaluated with one request.
+    submitQueries(queryList.map(({ li }) => li.textarea), () => {
+        createSortable();
+        lastFocus = null;
 
-    load(0);
+        if (queriesElement.lastChild) {
+            queriesElement.lastChild.textarea.focus();
+        }
+    });
 }
 
 function loadLink() {
@@ -97,6 +97,67 @@ function createMathNode(nodeName) {
 
 let objectsPrefix = 'math_object_', objectsCount = 0, objects = {};
 
+// Calls "draw" with the scene of a <graphics3d> element: the JSON in its
+// "data" attribute or, for a big scene, that of the file its "src" refers
+// to; see mathics_django/web/graphics_cache.py. Such a file is asked for
+// with its coordinates packed, which is smaller and faster to read.
+function withGraphics3dData(element, draw) {
+    const src = element.getAttribute('src');
+
+    if (src) {
+        fetch(src + '?encoding=packed', { credentials: 'same-origin' })
+            .then((response) => response.json())
+            .then((data) => draw(unpackGraphics3d(data)));
+    } else {
+        draw(JSON.parse(element.getAttribute('data')));
+    }
+}
+
+// Turns the packed coordinates of a Graphics3D scene back into the
+// [[x, y, z], null] points mathics-threejs-backend draws; see
+// pack_graphics3d() in mathics_django/web/graphics_cache.py.
+function unpackGraphics3d(data) {
+    if (!data.packed) {
+        return data;
+    }
+
+    const bytes = Uint8Array.from(atob(data.packed.floats), (c) => c.charCodeAt(0));
+    const view = new DataView(bytes.buffer);
+    const float = (index) => view.getFloat32(4 * index, true);
+
+    // The points of the packed elements follow one another.
+    let index = 0;
+    const points = (count) => {
+        const coords = [];
+
+        for (let i = 0; i < count; i++, index += 3) {
+            coords.push([[float(index), float(index + 1), float(index + 2)], null]);
+        }
+
+        return coords;
+    };
+
+    const elements = [];
+
+    data.elements.forEach((element) => {
+        const coords = element.coords;
+
+        if (typeof coords === 'number') {
+            elements.push({ ...element, coords: points(coords) });
+        } else if (Array.isArray(coords) && typeof coords[0] === 'number') {
+            // Elements merged as they differ only in their points.
+            coords.forEach((count) => elements.push({ ...element, coords: points(count) }));
+        } else {
+            elements.push(element);
+        }
+    });
+
+    data.elements = elements;
+    delete data.packed;
+
+    return data;
+}
+
 // This function is a mess and boneheaded.
 // We should use libraries to do formatting instead of hacking DOM elements.
 // As a result, this code makes it a pain to upgrade existing libraries like MathJax.
@@ -146,10 +207,9 @@ function translateDOMElement(element, svg) {
     let object = null;
 
     if (nodeName === 'graphics3d') {
-        const data = JSON.parse(element.getAttribute('data')),
-              div = document.createElement('div');
+        const div = document.createElement('div');
 
-        drawGraphics3d(div, data);
+        withGraphics3dData(element, (data) => drawGraphics3d(div, data));
 
         dom = div;
     }
@@ -272,12 +332,13 @@ function createLine(value) {
     }
     if (container?.firstElementChild?.tagName === 'GRAPHICS3D') {
         const div = document.createElement('div');
-	var json_data_value = JSON.parse(container.firstElementChild.attributes.data.value);
-	div.style.backgroundColor = json_data_value["background_color"];
-	if ("tooltip_text" in json_data_value){
-	    div.title = json_data_value["tooltip_text"];
-	}
-        drawGraphics3d(div, json_data_value);
+        withGraphics3dData(container.firstElementChild, (json_data_value) => {
+	    div.style.backgroundColor = json_data_value["background_color"];
+	    if ("tooltip_text" in json_data_value){
+		div.title = json_data_value["tooltip_text"];
+	    }
+            drawGraphics3d(div, json_data_value);
+        });
 
         div.style.overflow = 'hidden';
         div.style.position = 'relative';
@@ -427,25 +488,7 @@ function setResult(list, results) {
         li.appendChild(resultList);
         list.appendChild(li);
     } else {
-        results.forEach((result) => {
-
-            result.out.forEach((out) => {
-                resultList.appendChild(show_out(out));
-            });
-
-            if (result.result) {
-                const li = document.createElement('li');
-                li.className = 'result';
-                li.appendChild(createLine(result.result));
-
-                resultList.appendChild(li);
-                resultList.style.display = 'block';
-            }
-
-            if (result.out.length) {
-                resultList.style.display = 'block';
-            }
-        });
+        results.forEach((result) => addResult(resultList, result));
 
         // Add this to a list element in a block (which is CSS styled with a nice
         // frame around it.
@@ -458,6 +501,138 @@ function setResult(list, results) {
 }
 
 
+// Adds the printed output, messages and value of one evaluated
+// expression onto "resultList".
+function addResult(resultList, result) {
+    result.out.forEach((out) => {
+        resultList.appendChild(show_out(out));
+    });
+
+    if (result.result) {
+        const li = document.createElement('li');
+        li.className = 'result';
+        li.appendChild(createLine(result.result));
+
+        resultList.appendChild(li);
+
+        if (result.more) {
+            resultList.appendChild(createMoreLink(result.more));
+        }
+    }
+
+    if (result.result || result.out.length) {
+        resultList.style.display = 'block';
+    }
+}
+
+// Returns a "show more" item for a result that was too big to be shown
+// whole. Each click fetches the next part of it from ajax/more/ and shows
+// it above the item; "more" says where that part starts.
+function createMoreLink(more) {
+    const li = document.createElement('li');
+    li.className = 'more';
+
+    const link = document.createElement('a');
+    li.appendChild(link);
+
+    const update = () => {
+        link.innerText = `Show more (${more.remaining} elements left)`;
+    };
+    update();
+
+    link.addEventListener('click', (event) => {
+        event.preventDefault();
+        event.stopPropagation();
+
+        if (li.classList.contains('loading')) {
+            return;
+        }
+        li.classList.add('loading');
+
+        fetch('ajax/more/', {
+            method: 'post',
+            credentials: 'same-origin',
+            body: new URLSearchParams({ handle: more.handle, offset: more.offset })
+        })
+            .then((response) => response.json())
+            .then((data) => {
+                if (data.error) {
+                    li.innerText = data.error;
+                    return;
+                }
+
+                const part = document.createElement('li');
+                part.className = 'result';
+                part.appendChild(createLine(data.result));
+                li.parentNode.insertBefore(part, li);
+                afterProcessResult(part);
+
+                if (data.more) {
+                    more = data.more;
+                    update();
+                } else {
+                    li.remove();
+                }
+            }, () => {
+                li.innerText = 'Sorry, an error occurred while processing your request!';
+            })
+            .finally(() => li.classList.remove('loading'));
+    });
+
+    return li;
+}
+
+// Returns the output block that streamed results of the cell "list" are
+// added to, creating it if needed.
+function getStreamedResultList(list) {
+    let resultList = list.streamedResultList;
+
+    if (!resultList || !resultList.isConnected) {
+        resultList = document.createElement('ul');
+        resultList.className = 'out';
+        resultList.style.display = 'none';
+
+        const li = document.createElement('li');
+        li.className = 'out';
+        li.appendChild(resultList);
+        list.appendChild(li);
+
+        list.streamedResultList = resultList;
+    }
+
+    return resultList;
+}
+
+// Adds one streamed Django cell "result" onto "list", in the same output
+// block as the results of the cell that came before it.
+function appendResult(list, result) {
+    if (result.form == "Python Exception") {
+        setResult(list, [result]);
+
+        return;
+    }
+
+    const resultList = getStreamedResultList(list);
+    const start = resultList.childElementCount;
+
+    addResult(resultList, result);
+
+    // Only typeset what is new: what was there already has been.
+    Array.from(resultList.children).slice(start)
+        .forEach((li) => afterProcessResult(li));
+}
+
+// Adds a Print[] output or message "out" onto "list" ahead of the result
+// it belongs to, as it is produced.
+function appendOut(list, out) {
+    const resultList = getStreamedResultList(list);
+    const li = show_out(out);
+
+    resultList.appendChild(li);
+    resultList.style.display = 'block';
+    afterProcessResult(li);
+}
+
 function show_out(out){
     const li = document.createElement("li");
     text = out.text;
@@ -476,14 +651,106 @@ function show_out(out){
 // Make sure we handle queries one at a time.
 var queryInProgress = false;
 
-function submitQuery(element, onfinish, query) {
+// The WebSocket that queries are sent over, once it is open; see
+// mathics_django/web/websocket.py. Without it, ajax/query/ is used.
+let querySocket = null;
+// Callbacks for the queries sent over querySocket, by query id.
+let querySocketQueries = {};
+let lastQuerySocketId = 0;
 
-    // Check if we are already waiting for a Query response...
-    if (queryInProgress) {
-        console.warn("Query already in progress, ignoring duplicate request.");
+function openQuerySocket() {
+    if (!window.WebSocket) {
+        return;
+    }
+
+    const url = new URL('ws/query/', document.baseURI);
+    url.protocol = url.protocol === 'https:' ? 'wss:' : 'ws:';
+
+    const socket = new WebSocket(url);
+
+    socket.onopen = () => {
+        querySocket = socket;
+    };
+
+    socket.onmessage = (event) => {
+        const message = JSON.parse(event.data);
+        const callbacks = querySocketQueries[message.id];
+
+        if (!callbacks) {
+            return;
+        }
+
+        if (message.type === 'out') {
+            callbacks.onOut(message.out);
+        } else if (message.type === 'result') {
+            callbacks.onResult(message.result);
+        } else if (message.type === 'error' || message.type === 'busy') {
+            callbacks.failed = true;
+        }
+
+        if (message.type === 'done' || message.type === 'busy') {
+            delete querySocketQueries[message.id];
+
+            if (callbacks.failed) {
+                callbacks.reject(new Error(message.type));
+            } else {
+                callbacks.resolve();
+            }
+        }
+    };
+
+    socket.onclose = () => {
+        if (querySocket !== socket) {
+            // It never opened: the server does not take WebSockets.
+            return;
+        }
+
+        querySocket = null;
+        Object.values(querySocketQueries)
+            .forEach((callbacks) => callbacks.reject(new Error('closed')));
+        querySocketQueries = {};
+
+        window.setTimeout(openQuerySocket, 1000);
+    };
+}
+
+// Sends "query" over querySocket, calling onResult with each result and
+// onOut with each Print[] output and message as they come back.
+function sendSocketQuery(query, onResult, onOut) {
+    return new Promise((resolve, reject) => {
+        const id = ++lastQuerySocketId;
+
+        querySocketQueries[id] = { onResult, onOut, resolve, reject };
+        querySocket.send(JSON.stringify({ type: 'query', id, query }));
+    });
+}
+
+// Ask the server to stop the evaluation in progress for this session.
+function abortQuery() {
+    if (!queryInProgress) {
         return;
     }
 
+    if (querySocket) {
+        querySocket.send(JSON.stringify({ type: 'abort' }));
+    } else {
+        new Ajax.Request('ajax/abort/', { method: 'post' });
+    }
+}
+
+// While a query is evaluating, its "=" button becomes an abort button.
+function setSubmitButtonAborts(element, aborts) {
+    const button = element.submitButton;
+
+    if (!button) {
+        return;
+    }
+
+    button.innerText = aborts ? '\u25A0' : '=';
+    button.parentNode.title = aborts ? 'Abort [Alt+.]' : 'Evaluate [Shift+Return]';
+}
+
+function hideWelcome() {
     if (welcome) {
 	const welcomeContainer = document.getElementById('welcomeContainer');
 	if (welcomeContainer) {
@@ -499,70 +766,227 @@ function submitQuery(element, onfinish, query) {
         welcome = false;
         document.getElementById('logo').classList.remove('load');
     }
+}
 
-    element.li?.classList.add('loading');
+// Calls onLine with each line of the streamed (NDJSON) "response" to a
+// query, as it arrives.
+async function readResultLines(response, onLine) {
+    // 503 comes with a result saying that the server is busy.
+    if (!response.ok && response.status !== 503) {
+        throw new Error(response.statusText);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    for (;;) {
+        const { done, value } = await reader.read();
+
+        if (done) {
+            break;
+        }
+
+        buffer += decoder.decode(value, { stream: true });
+
+        const lines = buffer.split('\n');
+        buffer = lines.pop();
+        lines.forEach(onLine);
+    }
+
+    onLine(buffer + decoder.decode());
+}
+
+// Evaluates the cells of the textareas "elements" in order, with a single
+// request, showing each result as it arrives.
+function submitQueries(elements, onfinish) {
+    if (queryInProgress) {
+        console.warn("Query already in progress, ignoring duplicate request.");
+        return;
+    }
+
+    hideWelcome();
+
+    elements.forEach((element) => {
+        element.li.classList.add('loading');
+        setSubmitButtonAborts(element, true);
+    });
     document.getElementById('logo')?.classList.add('working');
 
-    // Note that we are handling a query.
     queryInProgress = true;
 
-    new Ajax.Request('ajax/query/', {
-        method: 'post',
-        parameters: { query: query || element.value },
-        onSuccess: (transport) => {
-            if (element.ul) {
-                element.ul.select('li[class!=request][class!=submitbutton]')
-                    .forEach((element) => element.remove());
-
-                if (!transport.responseText) {
-                    // a fatal Python error has occurred, e.g. on 4.4329408320439^43214234345
-                    // ("Fatal Python error: mp_reallocate failure")
-                    // -> print overflow message
-                    transport.responseText = '{"results": [{"out": [{"prefix": "General::noserver", "message": true, "tag": "noserver", "symbol": "General", "text": "No server running."}]}]}';
-                }
+    const results = elements.map(() => []);
 
-                const response = JSON.parse(transport.responseText);
+    const onLine = (line) => {
+        if (!line.trim()) {
+            return;
+        }
 
-                setResult(element.ul, response.results);
-                element.submitted = true;
-                element.results = response.results;
+        const { id, result } = JSON.parse(line);
 
-                const next = element.li.nextSibling;
+        if (elements[id]) {
+            results[id].push(result);
+            appendResult(elements[id].ul, result);
+        }
+    };
 
-                if (next) {
-                    next.textarea.focus();
-                } else {
-                    createQuery();
-                }
-            };
-        },
-        onFailure: () => {
-	    queryInProgress = false;
-            element?.ul.select('li[class!=request]')
-                .forEach((element) => element.remove());
+    const cells = elements.map((element, id) => ({ id, query: element.value }));
 
+    fetch('ajax/query/batch/', {
+        method: 'post',
+        credentials: 'same-origin',
+        body: new URLSearchParams({ cells: JSON.stringify(cells), stream: '1' })
+    })
+        .then((response) => readResultLines(response, onLine))
+        .then(() => {
+            elements.forEach((element, id) => {
+                element.submitted = true;
+                element.results = results[id];
+            });
+        }, () => {
             const li = document.createElement('li');
             li.className = 'serverError';
             li.innerText = 'Sorry, an error occurred while processing your request!';
 
-            element?.ul.appendChild(li);
-            element.submitted = true;
-        },
-        onComplete: () => {
-	    queryInProgress = false;
-            element?.li.classList.remove('loading');
+            elements[0]?.ul.appendChild(li);
+        })
+        .finally(() => {
+            queryInProgress = false;
+            elements.forEach((element) => {
+                element.li.classList.remove('loading');
+                setSubmitButtonAborts(element, false);
+            });
             document.getElementById('logo')?.classList.remove('working');
 
             if (onfinish) {
                 onfinish();
             }
+        });
+}
+
+function submitQuery(element, onfinish, query) {
+
+    // Check if we are already waiting for a Query response...
+    if (queryInProgress) {
+        console.warn("Query already in progress, ignoring duplicate request.");
+        return;
+    }
+
+    hideWelcome();
+
+    element.li?.classList.add('loading');
+    setSubmitButtonAborts(element, true);
+    document.getElementById('logo')?.classList.add('working');
+
+    // Note that we are handling a query.
+    queryInProgress = true;
+
+    const results = [];
+    let cleared = false;
+
+    // Remove the output of the previous evaluation of this cell.
+    const clearResults = () => {
+        if (!cleared && element.ul) {
+            element.ul.select('li[class!=request][class!=submitbutton]')
+                .forEach((element) => element.remove());
+            element.ul.streamedResultList = null;
         }
-    });
+        cleared = true;
+    };
+
+    // Each result is shown as soon as it arrives.
+    const onResult = (result) => {
+        clearResults();
+        results.push(result);
+
+        if (element.ul) {
+            appendResult(element.ul, result);
+        }
+    };
+
+    const onOut = (out) => {
+        clearResults();
+
+        if (element.ul) {
+            appendOut(element.ul, out);
+        }
+    };
+
+    // Over HTTP, results come back as one line of JSON per evaluated
+    // expression.
+    const onLine = (line) => {
+        if (line.trim()) {
+            onResult(JSON.parse(line));
+        }
+    };
+
+    const onSuccess = () => {
+        clearResults();
+        element.submitted = true;
+        element.results = results;
+
+        if (element.ul) {
+            const next = element.li.nextSibling;
+
+            if (next) {
+                next.textarea.focus();
+            } else {
+                createQuery();
+            }
+        }
+    };
+
+    const onFailure = () => {
+        queryInProgress = false;
+        element?.ul.select('li[class!=request]')
+            .forEach((element) => element.remove());
+
+        const li = document.createElement('li');
+        li.className = 'serverError';
+        li.innerText = 'Sorry, an error occurred while processing your request!';
+
+        element?.ul.appendChild(li);
+        element.submitted = true;
+    };
+
+    const onComplete = () => {
+        queryInProgress = false;
+        element?.li.classList.remove('loading');
+        setSubmitButtonAborts(element, false);
+        document.getElementById('logo')?.classList.remove('working');
+
+        if (onfinish) {
+            onfinish();
+        }
+    };
+
+    let evaluated;
+
+    if (querySocket) {
+        evaluated = sendSocketQuery(query || element.value, onResult, onOut);
+    } else {
+        evaluated = fetch('ajax/query/', {
+            method: 'post',
+            credentials: 'same-origin',
+            body: new URLSearchParams({ query: query || element.value, stream: '1' })
+        }).then((response) => readResultLines(response, onLine));
+    }
+
+    evaluated
+        .then(onSuccess, onFailure)
+        .finally(onComplete);
 }
 
 function keyDown(event) {
     const textArea = lastFocus;
 
+    if (event.altKey && event.key === '.') {
+        event.stop();
+        abortQuery();
+
+        return;
+    }
+
     if (!textArea) {
         return;
     }
@@ -714,6 +1138,7 @@ function createQuery(beforeElement, noFocus, updatingAll) {
 
     textarea.ul = ul;
     textarea.li = li;
+    textarea.submitButton = submitButton;
     textarea.submitted = false;
     moveHandle.li = li;
     deleteHandle.li = li;
@@ -741,7 +1166,9 @@ function createQuery(beforeElement, noFocus, updatingAll) {
     moveHandle.addEventListener('mousedown', moveMouseDown);
     document.addEventListener('mouseup', moveMouseUp);
     submitButton.addEventListener('mousedown', () => {
-        if (textarea.value.trim()) {
+        if (li.classList.contains('loading')) {
+            abortQuery();
+        } else if (textarea.value.trim()) {
             submitQuery(textarea);
         } else {
             textarea.focus();
@@ -913,6 +1340,8 @@ function domLoaded() {
         if (!loadLink()) {
             createQuery();
         }
+
+        openQuerySocket();
     }
 }
 
@@ -5,44 +5,34 @@ from django.contrib.auth.models import User
 from django.contrib.sessions.models import Session
 from django.db import models
 from django.db.models.signals import pre_delete
-from mathics.core.definitions import Definitions
-from mathics.core.evaluation import Evaluation, Output
-from mathics.core.load_builtin import import_and_load_builtins
-from mathics.session import autoload_files
 
-from mathics_django.settings import ROOT_DIR
-from mathics_django.web.format import format_output
+from mathics_django.web.backends import get_evaluation_backend
 
 
-class WebOutput(Output):
-    pass
+def get_session_key(session) -> str:
+    """
+    Return the key of ``session``, for passing to the evaluation backend.
 
-
-_evaluations = {}
+    If the backend has no evaluation for the session yet, the session is
+    (re)created, which gives it a new key.
+    """
+    backend = get_evaluation_backend()
+    if session.session_key is None or not backend.has_session(session.session_key):
+        session.create()
+    return session.session_key
 
 
-def get_session_evaluation(session):
-    evaluation = _evaluations.get(session.session_key)
-    if evaluation is None:
-        import_and_load_builtins()
-        session.create()
-        definitions = Definitions(add_builtin=True)
-        # We set the formatter to "unformatted" so that we can use
-        # our own custom formatter that understand better how to format
-        # in the context of mathics-django.
-        # Previously, one specific format, like "xml" had to fit all.
-        evaluation = Evaluation(definitions, format="xml", output=WebOutput())
-        _evaluations[session.session_key] = evaluation
-        evaluation.format_output = lambda expr, format: format_output(
-            evaluation, expr, format
-        )
-        autoload_files(definitions, ROOT_DIR, "autoload")
-    return evaluation
+def get_session_evaluation_stats() -> dict:
+    """
+    Return hit, miss and eviction counts of the session evaluation pool and
+    of the formatted output cache.
+    """
+    return get_evaluation_backend().stats()
 
 
 def end_session_evaluation(sender, **kwargs):
     session_key = kwargs.get("instance").session_key
-    del _evaluations[session_key]
+    get_evaluation_backend().end_session(session_key)
 
 
 pre_delete.connect(end_session_evaluation, sender=Session)
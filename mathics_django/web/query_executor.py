@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+The pool of threads that queries are evaluated in when they are handled
+asynchronously: by the ``query`` view and by the WebSocket channel
+under ASGI.
+
+Evaluating blocks, either computing or waiting for an evaluation worker
+process. Doing that in a pool of its own keeps it off the event loop
+and out of the one thread that Django runs thread-sensitive synchronous
+code in, so other requests are not held up behind long evaluations.
+
+Results streamed by a WSGI server are evaluated in the server's thread
+instead, but count against MAX_PENDING_QUERIES all the same; see
+``QueryExecutor.admit()``.
+"""
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Iterable, Iterator
+
+from mathics_django import settings
+
+
+class QueryExecutorBusy(Exception):
+    """
+    Raised when MAX_PENDING_QUERIES queries are already running or
+    waiting for a thread.
+    """
+
+
+class _Raised:
+    """An exception raised while iterating, passed on to the consumer."""
+
+    def __init__(self, exception: BaseException):
+        self.exception = exception
+
+
+_finished = object()
+
+
+class _Admitted:
+    """
+    An iterator counted as pending in a QueryExecutor until it is
+    exhausted or closed.
+    """
+
+    def __init__(self, executor: "QueryExecutor", iterable: Iterable):
+        self.executor = executor
+        self.iterator = iter(iterable)
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.iterator)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if hasattr(self.iterator, "close"):
+                self.iterator.close()
+            self.executor.release()
+
+
+class QueryExecutor:
+    """
+    Runs evaluation in at most ``threads`` threads at a time. At most
+    ``max_pending`` calls, running or waiting, are accepted; 0 means no
+    limit.
+    """
+
+    def __init__(self, threads: int, max_pending: int = 0):
+        self.executor = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="mathics3-query"
+        )
+        self.max_pending = max_pending
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        with self.lock:
+            if self.max_pending and self.pending >= self.max_pending:
+                raise QueryExecutorBusy()
+            self.pending += 1
+
+    def release(self, _future=None):
+        with self.lock:
+            self.pending -= 1
+
+    def submit(self, function: Callable, *args) -> asyncio.Future:
+        """
+        Start ``function(*args)`` in the pool and return a future for its
+        result. ``QueryExecutorBusy`` is raised right away if too many
+        calls are pending.
+
+        This must be called from a running event loop.
+        """
+        self.reserve()
+        try:
+            future = asyncio.get_running_loop().run_in_executor(
+                self.executor, function, *args
+            )
+        except BaseException:
+            self.release()
+            raise
+        future.add_done_callback(self.release)
+        return future
+
+    def admit(self, iterable: Iterable) -> Iterator:
+        """
+        Return an iterator over ``iterable``, which the caller iterates
+        over in a thread of its own rather than in the pool, counted as
+        pending until it is exhausted or closed. ``QueryExecutorBusy``
+        is raised right away if too many calls are pending.
+        """
+        self.reserve()
+        return _Admitted(self, iterable)
+
+    async def run(self, function: Callable, *args):
+        """Run ``function(*args)`` in the pool and return its result."""
+        return await self.submit(function, *args)
+
+    def iterate(self, function: Callable[..., Iterable], *args) -> AsyncIterator:
+        """
+        Iterate over ``function(*args)`` in one thread of the pool,
+        starting right away, and return an asynchronous iterator over
+        the items as they are produced.
+
+        If the asynchronous iterator is closed early, the iteration stops
+        after the item it is working on.
+        """
+        loop = asyncio.get_running_loop()
+        items: asyncio.Queue = asyncio.Queue()
+        stop = threading.Event()
+
+        def put(item):
+            loop.call_soon_threadsafe(items.put_nowait, item)
+
+        def run():
+            try:
+                iterator = iter(function(*args))
+                for item in iterator:
+                    put(item)
+                    if stop.is_set():
+                        if hasattr(iterator, "close"):
+                            iterator.close()
+                        break
+            except BaseException as exception:
+                put(_Raised(exception))
+            finally:
+                put(_finished)
+
+        self.submit(run)
+
+        async def items_as_produced():
+            try:
+                while True:
+                    item = await items.get()
+                    if item is _finished:
+                        break
+                    if isinstance(item, _Raised):
+                        raise item.exception
+                    yield item
+            finally:
+                stop.set()
+
+        return items_as_produced()
+
+
+_query_executor = None
+_query_executor_lock = threading.Lock()
+
+
+def get_query_executor() -> QueryExecutor:
+    """
+    Return the query executor sized by the settings, creating it on
+    first use.
+    """
+    global _query_executor
+    if _query_executor is None:
+        with _query_executor_lock:
+            if _query_executor is None:
+                _query_executor = QueryExecutor(
+                    settings.QUERY_THREADS, settings.MAX_PENDING_QUERIES
+                )
+    return _query_executor
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Fast creation of the Definitions used by a session.
+
+Building ``Definitions(add_builtin=True)`` and running the autoload
+files takes seconds. Since that result is the same for every session,
+we build it once per process as a "template" and give each new
+session a clone of it.
+
+A ``Definitions`` object already keeps builtin and user definitions in
+separate layers: assignments, attribute changes and so on go into the
+user layer, and lookups consult the user layer before the builtin one.
+A clone therefore shares the template's builtin ``Definition`` objects,
+which are not changed after the template has been built, and gets its
+own copies of the user and Mathics3-module layers.
+"""
+
+import copy
+import threading
+from collections import defaultdict
+from typing import Optional
+
+from mathics.core.definitions import Definition, Definitions
+from mathics.session import autoload_files
+
+from mathics_django.load_builtins import ensure_builtins_loaded
+from mathics_django.settings import ROOT_DIR
+
+_template_definitions: Optional[Definitions] = None
+_template_lock = threading.Lock()
+
+
+def get_template_definitions() -> Definitions:
+    """
+    Return the process-wide template Definitions, building it on first use.
+
+    The template must not be used for evaluation; use
+    ``new_session_definitions()`` to get a copy that can be.
+    """
+    global _template_definitions
+    if _template_definitions is None:
+        with _template_lock:
+            if _template_definitions is None:
+                ensure_builtins_loaded()
+                definitions = Definitions(add_builtin=True)
+                autoload_files(definitions, ROOT_DIR, "autoload")
+                _template_definitions = definitions
+    return _template_definitions
+
+
+def copy_definition(definition: Definition) -> Definition:
+    """
+    Copy a Definition so that adding or removing rules in the copy does not
+    affect the original. Rules themselves are shared.
+    """
+    result = copy.copy(definition)
+    for values in (
+        "ownvalues",
+        "downvalues",
+        "subvalues",
+        "upvalues",
+        "nvalues",
+        "defaultvalues",
+        "messages",
+    ):
+        setattr(result, values, list(getattr(definition, values)))
+    result.formatvalues = {
+        form: list(rules) for form, rules in definition.formatvalues.items()
+    }
+    result.options = dict(definition.options)
+    return result
+
+
+def clone_definitions(template: Definitions) -> Definitions:
+    """
+    Return a Definitions object that shares the builtin definitions of
+    ``template`` but has its own user and Mathics3-module layers.
+    """
+    definitions = copy.copy(template)
+    # Builtin Definition objects are shared with the template. The
+    # dictionary holding them is not: loading a Mathics3 module can add
+    # option symbols to it.
+    definitions.builtin = dict(template.builtin)
+    definitions.pymathics = dict(template.pymathics)
+    definitions.user = {
+        name: copy_definition(definition) for name, definition in template.user.items()
+    }
+    # Caches hold merged definitions, so they can't be shared.
+    definitions.definitions_cache = {}
+    definitions.lookup_cache = {}
+    definitions.proxy = defaultdict(set)
+    definitions._packages = list(template._packages)
+    definitions.boxforms = list(template.boxforms)
+    definitions.printforms = list(template.printforms)
+    definitions.outputforms = list(template.outputforms)
+    return definitions
+
+
+def new_session_definitions() -> Definitions:
+    """Return fresh Definitions for a session, cloned from the template."""
+    return clone_definitions(get_template_definitions())
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Serialization of the requests made on one session's evaluation.
+
+An Evaluation object can only be used by one thread at a time: two
+queries running on it at once mix up their output. Requests for a
+session therefore take turns, in the order they arrived.
+
+A request can wait for its turn in a thread, or in an event loop without
+holding up a thread, so that requests waiting behind a long evaluation
+of their session do not use up the threads that evaluate.
+"""
+
+import asyncio
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Set
+
+
+class SessionBusy(Exception):
+    """
+    Raised when a session already has as many requests running or
+    waiting as its queue allows.
+    """
+
+
+class _SessionQueue:
+    def __init__(self):
+        # Tickets are handed out in arrival order and served in that order.
+        self.issued = 0
+        self.served = 0
+        # Ticket -> function waking up the request waiting asynchronously
+        # for the turn of that ticket.
+        self.wake_ups: Dict[int, Callable[[], None]] = {}
+        # Tickets given up before their turn came; they are skipped.
+        self.abandoned: Set[int] = set()
+
+    def depth(self) -> int:
+        return self.issued - self.served - len(self.abandoned)
+
+
+class SessionTurn:
+    """
+    The place of a request in the queue of a session, as given by
+    ``SessionQueues.enter()``. Wait for its turn with ``wait()`` or
+    ``wait_async()``, and end it with ``release()``.
+    """
+
+    def __init__(self, queues: "SessionQueues", session_key: str, queue: _SessionQueue):
+        self.queues = queues
+        self.session_key = session_key
+        self.queue = queue
+        self.ticket = queue.issued
+        self.released = False
+
+    def wait(self):
+        """Wait in this thread for the turn to come."""
+        with self.queues.condition:
+            while self.queue.served != self.ticket:
+                self.queues.condition.wait()
+
+    async def wait_async(self):
+        """
+        Wait in the running event loop for the turn to come. If this is
+        cancelled, the place in the queue is given up.
+        """
+        loop = asyncio.get_running_loop()
+        turn_came = loop.create_future()
+
+        def set_turn_came():
+            if not turn_came.done():
+                turn_came.set_result(None)
+
+        with self.queues.condition:
+            if self.queue.served == self.ticket:
+                return
+            self.queue.wake_ups[self.ticket] = lambda: loop.call_soon_threadsafe(
+                set_turn_came
+            )
+        try:
+            await turn_came
+        except asyncio.CancelledError:
+            self.release()
+            raise
+
+    def release(self):
+        """
+        End the turn, letting the next request have its turn, or give up
+        the place in the queue if the turn has not come yet. Calling this
+        again does nothing.
+        """
+        with self.queues.condition:
+            if self.released:
+                return
+            self.released = True
+            queue = self.queue
+            queue.wake_ups.pop(self.ticket, None)
+            if queue.served != self.ticket:
+                queue.abandoned.add(self.ticket)
+                return
+            queue.served += 1
+            while queue.served in queue.abandoned:
+                queue.abandoned.remove(queue.served)
+                queue.served += 1
+            if queue.served == queue.issued:
+                del self.queues.queues[self.session_key]
+            elif queue.served in queue.wake_ups:
+                queue.wake_ups.pop(queue.served)()
+            self.queues.condition.notify_all()
+
+
+class SessionQueues:
+    """
+    A first-come, first-served queue per session key. At most
+    ``max_depth`` requests for a session, including the one being
+    served, may be in its queue; 0 means no limit.
+    """
+
+    def __init__(self, max_depth: int = 0):
+        self.max_depth = max_depth
+        self.condition = threading.Condition()
+        self.queues: Dict[str, _SessionQueue] = {}
+
+    def depth(self, session_key: str) -> int:
+        """Return the number of requests running or waiting for ``session_key``."""
+        with self.condition:
+            queue = self.queues.get(session_key)
+            return 0 if queue is None else queue.depth()
+
+    def enter(self, session_key: str) -> SessionTurn:
+        """
+        Put a request at the end of the queue of ``session_key``, and
+        return its place there. ``SessionBusy`` is raised if the queue
+        is full.
+        """
+        with self.condition:
+            queue = self.queues.get(session_key)
+            if queue is None:
+                queue = self.queues[session_key] = _SessionQueue()
+            if self.max_depth and queue.depth() >= self.max_depth:
+                raise SessionBusy(session_key)
+            turn = SessionTurn(self, session_key, queue)
+            queue.issued += 1
+            return turn
+
+    @contextmanager
+    def turn(self, session_key: str) -> Iterator[None]:
+        """
+        Wait for the turn of this request on ``session_key``, and hold it
+        until the end of the ``with`` block. ``SessionBusy`` is raised
+        straight away if the session's queue is full.
+        """
+        turn = self.enter(session_key)
+        try:
+            turn.wait()
+            yield
+        finally:
+            turn.release()
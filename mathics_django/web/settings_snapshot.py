@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+The values of a session's ``Settings`*`` variables, such as
+``Settings`$RenderTeXForm``.
+
+Reading them means parsing and evaluating Mathics3 code, which is too
+slow to do for every formatted output. They are read once into a
+snapshot, kept with the session's definitions, and read again only when
+one of them has been assigned or a new one defined.
+
+Nothing in here depends on Django being set up.
+"""
+
+from typing import Any, Dict, Tuple
+
+from mathics.core.evaluation import Evaluation
+
+
+def settings_state(definitions) -> Tuple:
+    """
+    Return a key that changes whenever a ``Settings`*`` variable is
+    assigned, or one is defined, in ``definitions``.
+    """
+    # Going over the definitions is only needed once some definition
+    # has changed.
+    cached = getattr(definitions, "settings_state", None)
+    if cached is not None and cached[0] == definitions.now:
+        return cached[1]
+    state = tuple(
+        (name, definition.changed)
+        for layer in (definitions.pymathics, definitions.user)
+        for name, definition in layer.items()
+        if name.startswith("Settings`")
+    )
+    definitions.settings_state = (definitions.now, state)
+    return state
+
+
+def read_settings(evaluation: Evaluation) -> Dict[str, dict]:
+    """
+    Evaluate each ``Settings`*`` variable and its usage, returning them
+    keyed by symbol name.
+    """
+    definitions = evaluation.definitions
+    setting_names = sorted(definitions.get_matching_names("Settings`*"))
+    settings = {}
+
+    for setting_name in setting_names:
+        rule = evaluation.parse(setting_name)
+        value = rule.evaluate(evaluation).to_python()
+
+        setting_usage_expr = evaluation.parse(setting_name + "::usage")
+        setting_usage = setting_usage_expr.evaluate(evaluation).to_python(
+            string_quotes=False
+        )
+
+        settings[setting_name] = {
+            "value": value,
+            "usage": setting_usage,
+            "is_boolean": type(value) is bool,
+            "boolean_value": value,
+        }
+
+    return settings
+
+
+def get_settings_snapshot(evaluation: Evaluation) -> Dict[str, dict]:
+    """
+    Return the value and usage of each ``Settings`*`` variable of
+    ``evaluation``, keyed by symbol name, as ``read_settings()`` does but
+    reading them again only when they may have changed.
+
+    The result is shared: it must not be modified.
+    """
+    definitions = evaluation.definitions
+    state = settings_state(definitions)
+    snapshot = getattr(definitions, "settings_snapshot", None)
+    if snapshot is None or snapshot[0] != state:
+        settings = read_settings(evaluation)
+        # Reading may itself have changed something; take the state after.
+        snapshot = (settings_state(definitions), settings)
+        definitions.settings_snapshot = snapshot
+    return snapshot[1]
+
+
+def get_setting(evaluation: Evaluation, name: str, default: Any = None) -> Any:
+    """
+    Return the value of the ``Settings`*`` variable ``name``, or
+    ``default`` if there is no such variable.
+    """
+    setting = get_settings_snapshot(evaluation).get(name)
+    return default if setting is None else setting["value"]
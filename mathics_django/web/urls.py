@@ -19,13 +19,18 @@ from mathics_django.web.controllers.doc import (
 
 # These are the callback functions.
 from mathics_django.web.views import (
+    abort,
     delete,
     get_worksheets,
+    graphics,
     login,
     logout,
     main_view,
+    more,
     open,
     query,
+    query_batch,
+    run_in_any_thread,
     save,
 )
 
@@ -36,26 +41,37 @@ urlpatterns = [
     re_path(r"^$", main_view),
     re_path(r"^about(?:\.htm(?:l)?)?$", about_page),
     re_path(r"^ajax/query/$", query),
+    re_path(r"^ajax/query/batch/$", query_batch),
+    re_path(r"^ajax/abort/$", abort),
+    re_path(r"^ajax/more/$", run_in_any_thread(more)),
     re_path(r"^ajax/login/$", login),
     re_path(r"^ajax/logout/$", logout),
     re_path(r"^ajax/save/$", save),
     re_path(r"^ajax/open/$", open),
     re_path(r"^ajax/delete/$", delete),
     re_path(r"^ajax/getworksheets/$", get_worksheets),
-    re_path(r"^(?P<ajax>(?:ajax/)?)doc/$", doc),
-    re_path(r"^ajax/doc/search/$", doc_search),
-    re_path(r"^(?P<ajax>(?:ajax/)?)doc/(?P<part>[\w-]+)/$", doc_part),
     re_path(
-        r"^(?P<ajax>(?:ajax/)?)doc/(?P<part>[\w-]+)/(?P<chapter>[\w-]+)/$", doc_chapter
+        r"^graphics/(?P<name>[0-9a-f]{64}\.(?:svg|json))$",
+        run_in_any_thread(graphics),
+    ),
+    # Documentation pages don't wait behind other requests under ASGI.
+    re_path(r"^(?P<ajax>(?:ajax/)?)doc/$", run_in_any_thread(doc)),
+    re_path(r"^ajax/doc/search/$", run_in_any_thread(doc_search)),
+    re_path(
+        r"^(?P<ajax>(?:ajax/)?)doc/(?P<part>[\w-]+)/$", run_in_any_thread(doc_part)
+    ),
+    re_path(
+        r"^(?P<ajax>(?:ajax/)?)doc/(?P<part>[\w-]+)/(?P<chapter>[\w-]+)/$",
+        run_in_any_thread(doc_chapter),
     ),
     re_path(
         r"^(?P<ajax>(?:ajax/)?)doc/(?P<part>[\w-]+)/(?P<chapter>[\w-]+)/"
         r"(?P<section>[$\w-]+)/$",
-        doc_section,
+        run_in_any_thread(doc_section),
     ),
     re_path(
         r"^(?P<ajax>(?:ajax/)?)doc/(?P<part>[\w-]+)/(?P<chapter>[\w-]+)/"
         r"(?P<section>[$\w-]+)/(?P<subsection>[$\w-]+)/$",
-        doc_subsection,
+        run_in_any_thread(doc_subsection),
     ),
 ]
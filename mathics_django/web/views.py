@@ -1,19 +1,32 @@
 # -*- coding: utf-8 -*-
 
-import traceback
+import io
+from functools import wraps
+from typing import (
+    AsyncIterator,
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
 from django.core.handlers.wsgi import WSGIRequest
 from django.http import (
+    FileResponse,
     Http404,
+    HttpRequest,
     HttpResponse,
     HttpResponseNotFound,
     HttpResponseServerError,
+    StreamingHttpResponse,
 )
 from django.shortcuts import render
 from django.template import loader
-from pygments import highlight
-from pygments.formatters import HtmlFormatter
-from pygments.lexers import PythonTracebackLexer
 
 try:
     import ujson as json
@@ -24,25 +37,46 @@ from django.conf import settings
 from django.contrib import auth
 from django.contrib.auth.models import User
 from django.core.mail import send_mail
-from mathics.core.definitions import Definitions
-from mathics.core.evaluation import Message, Result
-from mathics.settings import TIMEOUT, default_pymathics_modules
 
+from mathics_django.web.backends import get_evaluation_backend
+from mathics_django.web.evaluation import busy_result, session_busy_result
 from mathics_django.web.forms import LoginForm, SaveForm
-from mathics_django.web.models import Query, Worksheet, get_session_evaluation
-
-html_formatter = HtmlFormatter(noclasses=True)
+from mathics_django.web.graphics_cache import (
+    GRAPHICS_CONTENT_TYPES,
+    graphics_path,
+    packed_graphics3d_name,
+)
+from mathics_django.web.models import Query, Worksheet, get_session_key
+from mathics_django.web.query_executor import QueryExecutorBusy, get_query_executor
+from mathics_django.web.session_queue import SessionBusy, SessionTurn
 
 if settings.DEBUG:
     JSON_CONTENT_TYPE = "text/html"
 else:
     JSON_CONTENT_TYPE = "application/json"
 
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+
 
 class JsonResponse(HttpResponse):
-    def __init__(self, result={}):
+    def __init__(self, result={}, status: int = 200):
         response = json.dumps(result)
-        super(JsonResponse, self).__init__(response, content_type=JSON_CONTENT_TYPE)
+        super(JsonResponse, self).__init__(
+            response, content_type=JSON_CONTENT_TYPE, status=status
+        )
+
+
+def abort(request: WSGIRequest) -> JsonResponse:
+    """
+    Aborts the evaluation in progress for this session, if there is one.
+    """
+    session_key = request.session.session_key
+    aborted = session_key is not None and get_evaluation_backend().abort(session_key)
+    return JsonResponse(
+        {
+            "result": "ok" if aborted else "",
+        }
+    )
 
 
 def delete(request):
@@ -101,6 +135,34 @@ def get_worksheets(request):
     )
 
 
+def graphics(request: WSGIRequest, name: str) -> FileResponse:
+    """
+    Serves a picture or 3D scene saved by
+    mathics_django.web.graphics_cache. Its name is the hash of its
+    content, so it can be cached for good. With "?encoding=packed", a
+    scene is sent with its coordinates packed.
+    """
+    content_type = GRAPHICS_CONTENT_TYPES[name[name.rindex(".") :]]
+    if name.endswith(".json") and request.GET.get("encoding") == "packed":
+        name = packed_graphics3d_name(name)
+        if name is None:
+            raise Http404
+    try:
+        # "open" here is the worksheet view.
+        file = io.open(graphics_path(name), "rb")
+    except FileNotFoundError:
+        raise Http404
+    response = FileResponse(file, content_type=content_type)
+    response["Cache-Control"] = "public, max-age=31536000, immutable"
+    # Pictures come from user input: opened on their own, they must not
+    # run scripts or load anything.
+    response["Content-Security-Policy"] = (
+        "default-src 'none'; style-src 'unsafe-inline'; img-src data:"
+    )
+    response["X-Content-Type-Options"] = "nosniff"
+    return response
+
+
 def is_authenticated(user) -> bool:
     if callable(user.is_authenticated):
         return user.is_authenticated()
@@ -177,6 +239,31 @@ def main_view(request: WSGIRequest):
     return render(request, "main.html", context)
 
 
+def more(request: WSGIRequest) -> JsonResponse:
+    """
+    Sends the next part of a result that was too big to be shown whole;
+    the "handle" and "offset" parameters come from the "more" entry of
+    the result, or of the previous part.
+    """
+    session_key = request.session.session_key
+    try:
+        offset = int(request.POST.get("offset", ""))
+        if offset < 0:
+            raise ValueError(offset)
+    except ValueError:
+        return JsonResponse(
+            {"error": "offset must be a non-negative integer"}, status=400
+        )
+    data = None
+    if session_key is not None:
+        data = get_evaluation_backend().more_output(
+            session_key, request.POST.get("handle", ""), offset
+        )
+    if data is None:
+        return JsonResponse({"error": "This output is no longer available."}, 404)
+    return JsonResponse(data)
+
+
 # nicepass is taken from http://code.activestate.com/recipes/410076/
 def nicepass(alpha=6, numeric=2):
     """
@@ -242,13 +329,18 @@ def open(request: WSGIRequest):
     )
 
 
-def query(request: WSGIRequest) -> JsonResponse:
+async def query(request: HttpRequest) -> HttpResponse:
     """
     Handles Mathics3 input expressions.
-    """
-    global definitions
-    from mathics.core.parser import MathicsMultiLineFeeder
 
+    If the "stream" parameter is set, the result of each expression is
+    sent as soon as it has been evaluated, as one line of JSON
+    (NDJSON); otherwise all results are sent together when the whole
+    input has been evaluated.
+
+    Under ASGI, evaluation is done in the query executor's threads, which
+    leaves the server free to handle other requests meanwhile.
+    """
     input = request.POST.get("query", "")
     if settings.DEBUG and not input:
         input = request.GET.get("query", "")
@@ -264,118 +356,139 @@ def query(request: WSGIRequest) -> JsonResponse:
             meta=str(request.META),
             log="",
         )
-        query_log.save()
+        await sync_to_async(query_log.save)()
+
+    session_key = await sync_to_async(get_session_key)(request.session)
+    backend = get_evaluation_backend()
+    return await evaluation_response(
+        request,
+        session_key,
+        lambda turn: backend.iter_query(session_key, input, turn=turn),
+        lambda results: {"results": results},
+        lambda data: [data],
+    )
 
-    evaluation = get_session_evaluation(request.session)
-    feeder = MathicsMultiLineFeeder(input, "Django-cell-input")
-    results = []
-    try:
-        while not feeder.empty():
-            (
-                expr,
-                source_code,
-                messages,
-            ) = evaluation.parse_feeder_returning_code_and_messages(feeder)
-            if len(messages) > 0 and messages[0].tag in ("sntxf", "sntxb", "sntxi"):
-                # Syntax or Parse errors.
-
-                # For simplicity, when there is an error there will be just one
-                # error shown and we will use a dictionary for that rather than
-                # an array of dictionaries. This simplifies Javascript, formatting
-                # because at the top level we don't need a list element.
-
-                # Strip quotes from messages.
-                message = evaluation.out[0]
-
-                if message.text.startswith('"') and message.text.endswith('"'):
-                    message.text = message.text[1:-1]
-                results.append(
-                    Result(
-                        out=evaluation.out,
-                        result=None,
-                        line_no=None,
-                        last_eval=None,
-                        form="Syntax Error",
-                    )
-                )
 
-                if settings.LOG_ON_CONSOLE:
-                    print(source_code)
-                    print(message.text)
+def parse_cells(cells_json: str) -> List[Tuple[Union[int, str], str]]:
+    """
+    Return the ``(cell_id, input)`` pairs of the JSON list of cells
+    ``cells_json``, each an object with an "id" and a "query".
+    """
+    try:
+        cells = json.loads(cells_json)
+    except ValueError:
+        raise ValueError("cells is not valid JSON")
+    if not isinstance(cells, list):
+        raise ValueError("cells should be a list")
+    pairs = []
+    for cell in cells:
+        if not isinstance(cell, dict):
+            raise ValueError("each cell should be an object")
+        cell_id, input = cell.get("id"), cell.get("query", "")
+        if not isinstance(cell_id, (int, str)) or not isinstance(input, str):
+            raise ValueError('each cell needs an "id" and a "query" string')
+        pairs.append((cell_id, input))
+    if len({cell_id for cell_id, _ in pairs}) != len(pairs):
+        raise ValueError("cell ids should be unique")
+    return pairs
+
+
+async def query_batch(request: HttpRequest) -> HttpResponse:
+    """
+    Evaluates the input of several worksheet cells, in order, in one
+    request: for example all the cells of a worksheet. The "cells"
+    parameter is a JSON list of objects with an "id" and a "query".
+
+    With the "stream" parameter, each result is sent as soon as it has
+    been evaluated as a line of JSON ``{"id": cell_id, "result": data}``;
+    otherwise the response is ``{"results": [{"id": cell_id, "results":
+    [data, ...]}, ...]}``, in the order of the cells.
+    """
+    try:
+        cells = parse_cells(request.POST.get("cells", "[]"))
+    except ValueError as exc:
+        return JsonResponse({"error": str(exc)}, status=400)
+
+    session_key = await sync_to_async(get_session_key)(request.session)
+    backend = get_evaluation_backend()
+
+    def iter_cell_results(turn: Optional[SessionTurn]):
+        for cell_id, data in backend.iter_cells(session_key, cells, turn):
+            yield {"id": cell_id, "result": data}
+
+    def summarize(items: List[dict]) -> dict:
+        results_by_cell = {cell_id: [] for cell_id, _ in cells}
+        for item in items:
+            results_by_cell[item["id"]].append(item["result"])
+        return {
+            "results": [
+                {"id": cell_id, "results": results}
+                for cell_id, results in results_by_cell.items()
+            ]
+        }
 
-                evaluation.out = []
-                expr = None
+    return await evaluation_response(
+        request,
+        session_key,
+        iter_cell_results,
+        summarize,
+        lambda data: [{"id": cell_id, "result": data} for cell_id, _ in cells],
+    )
 
-            if expr is None:
-                # comment or an error.
-                # TODO: source_code should have '(* ... *)' and
-                # better would be to create tagged result.
-                continue
 
-            result = evaluation.evaluate(expr, timeout=TIMEOUT)
-            results.append(result)
+async def evaluation_response(
+    request: HttpRequest,
+    session_key: str,
+    iterate: Callable[[Optional[SessionTurn]], Iterable[dict]],
+    summarize: Callable[[List[dict]], dict],
+    busy_items: Callable[[dict], List[dict]],
+) -> HttpResponse:
+    """
+    Respond with the items of ``iterate(turn)``, which evaluates something
+    in the session ``session_key``, in its turn ``turn``.
+
+    If the "stream" parameter is set, each item is sent as soon as it
+    is produced, as one line of JSON (NDJSON); otherwise the response is
+    the JSON of ``summarize()`` of the list of all items.
+
+    Evaluation is done in the query executor's threads, once the turn of
+    the session has come, except for results streamed by a WSGI server,
+    which are evaluated in the server's thread but count as pending in
+    the executor. If the session's queue is full, or too many queries
+    are pending in the executor, the response is made of
+    ``busy_items(data)``, where ``data`` is a "busy" result; in the
+    second case, with status 503.
+    """
+    query_executor = get_query_executor()
+    stream = bool(request.POST.get("stream"))
+    if stream and not isinstance(request, ASGIRequest):
+        # A WSGI server iterates over the response in a thread of its
+        # own, and would have to read an asynchronous one all at once.
+        try:
+            results = query_executor.admit(stream_query_results(iterate(None)))
+        except QueryExecutorBusy:
+            return busy_response(stream, summarize, busy_items(busy_result()), 503)
+        return StreamingHttpResponse(results, content_type=NDJSON_CONTENT_TYPE)
 
-    except SystemExit:
-        results = []
-        result = None
-        definitions = Definitions(
-            add_builtin=True, extension_modules=default_pymathics_modules
-        )
-        evaluation.definitions = definitions
-
-    except Exception as exc:
-
-        def html_format_traceback_line(tb_line: str) -> str:
-            tb = highlight(tb_line, PythonTracebackLexer(), html_formatter)
-            return f'<p style="white-space: pre-wrap; word-wrap: break-word;">{tb}</p>'
-
-        # Should we show the Python exception details back to the user?
-        if settings.DEBUG and settings.DISPLAY_EXCEPTIONS:
-            call_stack = traceback.format_exception(exc)
-            # TODO: we may want to do other processing on the traceback
-            #       like splitting up lines. Encapsulate the below and put
-            #       in a function.
-            # FIXME: allow the the stack limit to be user settable
-
-            html_formatted_callstack = []
-            if len(call_stack) > 18:
-                html_formatted_callstack = [html_format_traceback_line(call_stack[0])]
-                html_formatted_callstack += [
-                    html_format_traceback_line(tb_line) for tb_line in call_stack[1:9]
-                ]
-                html_formatted_callstack.append("<p>...</p>")
-                html_formatted_callstack += [
-                    html_format_traceback_line(tb_line) for tb_line in call_stack[-9:]
-                ]
-            else:
-                html_formatted_callstack = [
-                    html_format_traceback_line(tb_line) for tb_line in call_stack
-                ]
-
-            except_head = f"Exception raised: {exc}"
-            message = Message(
-                "Python Exception",
-                tag="exception",
-                text=[except_head] + html_formatted_callstack,
-            )
-            results.append(
-                Result(
-                    out=[message],
-                    result=None,
-                    line_no=None,
-                    last_eval=None,
-                    form="Python Exception",
-                )
+    try:
+        turn = await get_evaluation_backend().wait_for_turn(session_key)
+    except SessionBusy:
+        return busy_response(stream, summarize, busy_items(session_busy_result()), 200)
+    try:
+        if stream:
+            return StreamingHttpResponse(
+                stream_query_results_async(query_executor.iterate(iterate, turn)),
+                content_type=NDJSON_CONTENT_TYPE,
             )
-        else:
-            raise
-    result = {
-        "results": [result.get_data() for result in results],
-    }
+        items = await query_executor.run(lambda: list(iterate(turn)))
+    except QueryExecutorBusy:
+        turn.release()
+        return busy_response(stream, summarize, busy_items(busy_result()), 503)
+
+    result = summarize(items)
     if settings.LOG_ON_CONSOLE:
         from pprint import pprint as pp
 
-        print(evaluation.timeout)
         pp(result)
         # query_log.timeout = evaluation.timeout
         # query_log.result = str(result)  # evaluation.results
@@ -384,6 +497,58 @@ def query(request: WSGIRequest) -> JsonResponse:
     return JsonResponse(result)
 
 
+def busy_response(
+    stream: bool,
+    summarize: Callable[[List[dict]], dict],
+    items: List[dict],
+    status: int,
+) -> HttpResponse:
+    if stream:
+        return StreamingHttpResponse(
+            stream_query_results(items),
+            content_type=NDJSON_CONTENT_TYPE,
+            status=status,
+        )
+    return JsonResponse(summarize(items), status=status)
+
+
+def format_streamed_result(data: dict) -> str:
+    if settings.LOG_ON_CONSOLE:
+        from pprint import pprint as pp
+
+        pp(data)
+    return json.dumps(data) + "\n"
+
+
+def stream_query_results(results: Iterable[dict]) -> Iterator[str]:
+    for data in results:
+        yield format_streamed_result(data)
+
+
+async def stream_query_results_async(
+    results: AsyncIterator[dict],
+) -> AsyncIterator[str]:
+    async for data in results:
+        yield format_streamed_result(data)
+
+
+def run_in_any_thread(view):
+    """
+    Turn the synchronous ``view`` into an asynchronous one that runs in a
+    thread of its own. Otherwise, under ASGI, Django runs it in the one
+    thread shared by all thread-sensitive synchronous code, where it can
+    wait behind unrelated requests.
+    """
+
+    @wraps(view)
+    async def asynchronous_view(request, *args, **kwargs):
+        return await sync_to_async(view, thread_sensitive=False)(
+            request, *args, **kwargs
+        )
+
+    return asynchronous_view
+
+
 def require_ajax_login(f):
     return f
 
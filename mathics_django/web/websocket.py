@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+A WebSocket channel for worksheet queries, served next to the Django
+ASGI application; see mathics_django.asgi.
+
+A worksheet page keeps one connection open, instead of making an HTTP
+request per cell. Messages are JSON text. From the browser:
+
+* ``{"type": "query", "id": id, "query": input}`` evaluates ``input``;
+* ``{"type": "abort"}`` aborts the query in progress.
+
+To the browser:
+
+* ``{"type": "out", "id": id, "out": data}`` for each Print[] output and
+  message, as soon as it is produced;
+* ``{"type": "result", "id": id, "result": data}`` for each evaluated
+  expression; its "out" list leaves out what was already sent. If the
+  server has too many queries pending, or the session has too many
+  requests waiting, the one result is a "busy" message;
+* ``{"type": "error", "id": id, "text": text}`` if evaluation failed;
+* ``{"type": "done", "id": id}`` at the end of a query;
+* ``{"type": "busy", "id": id}`` if a query was sent while another one
+  is in progress;
+* ``{"type": "abort", "result": "ok" or ""}`` in reply to an abort.
+
+The session, and so the evaluation, is picked with the Django session
+cookie sent with the handshake, as for ``ajax/query/``. Handshakes from
+pages of other sites than this one are rejected; see
+``is_allowed_origin()``.
+"""
+
+import asyncio
+import json
+from http.cookies import SimpleCookie
+from importlib import import_module
+from typing import List, Tuple
+from urllib.parse import urlsplit
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse
+from django.http.request import split_domain_port, validate_host
+from django.utils.http import is_same_domain
+
+from mathics_django.web.backends import get_evaluation_backend
+from mathics_django.web.evaluation import busy_result, session_busy_result
+from mathics_django.web.models import get_session_key
+from mathics_django.web.query_executor import QueryExecutorBusy, get_query_executor
+from mathics_django.web.session_queue import SessionBusy, SessionTurn
+
+WEBSOCKET_QUERY_PATH = "ws/query/"
+
+
+def is_websocket_query_path(path: str) -> bool:
+    return path.endswith("/" + WEBSOCKET_QUERY_PATH)
+
+
+def get_header(scope, name: bytes) -> str:
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return ""
+
+
+def is_host_allowed(host: str) -> bool:
+    """
+    Check ``host``, a host name with an optional port, against
+    ALLOWED_HOSTS the way Django checks the Host header of HTTP requests.
+    """
+    domain, _ = split_domain_port(host)
+    allowed_hosts = settings.ALLOWED_HOSTS
+    if settings.DEBUG and not allowed_hosts:
+        allowed_hosts = [".localhost", "127.0.0.1", "[::1]"]
+    return bool(domain) and validate_host(domain, allowed_hosts)
+
+
+def is_allowed_host(scope) -> bool:
+    """
+    Check the handshake's Host header the way Django checks that of
+    HTTP requests.
+    """
+    return is_host_allowed(get_header(scope, b"host"))
+
+
+def is_allowed_origin(scope) -> bool:
+    """
+    Check the handshake's Origin header, so that a page of another site
+    cannot open a connection with the session cookie of someone visiting
+    it. The host of the origin must be in ALLOWED_HOSTS, or the origin
+    must be in CSRF_TRUSTED_ORIGINS, where, as for Django's CSRF checks,
+    "https://*.example.com" stands for all subdomains of example.com.
+
+    Browsers always send the header; other clients may leave it out, but
+    they do not have anyone else's cookies.
+    """
+    origin = get_header(scope, b"origin")
+    if not origin:
+        return True
+    if origin in settings.CSRF_TRUSTED_ORIGINS:
+        return True
+    try:
+        parsed_origin = urlsplit(origin)
+    except ValueError:
+        return False
+    if parsed_origin.scheme not in ("http", "https") or not parsed_origin.netloc:
+        return False
+    if is_host_allowed(parsed_origin.netloc):
+        return True
+    for trusted_origin in settings.CSRF_TRUSTED_ORIGINS:
+        trusted = urlsplit(trusted_origin)
+        if (
+            "*" in trusted.netloc
+            and trusted.scheme == parsed_origin.scheme
+            and is_same_domain(parsed_origin.netloc, trusted.netloc.lstrip("*"))
+        ):
+            return True
+    return False
+
+
+def open_session(scope) -> Tuple[str, List[Tuple[bytes, bytes]]]:
+    """
+    Return the session key for the handshake's session cookie, and the
+    headers to accept the connection with. If a new session had to be
+    created, these set its cookie.
+    """
+    cookie = SimpleCookie(get_header(scope, b"cookie")).get(
+        settings.SESSION_COOKIE_NAME
+    )
+    old_session_key = cookie.value if cookie is not None else None
+    session = import_module(settings.SESSION_ENGINE).SessionStore(old_session_key)
+    session_key = get_session_key(session)
+    if session_key == old_session_key:
+        return session_key, []
+
+    response = HttpResponse()
+    response.set_cookie(
+        settings.SESSION_COOKIE_NAME,
+        session_key,
+        max_age=session.get_expiry_age(),
+        domain=settings.SESSION_COOKIE_DOMAIN,
+        path=settings.SESSION_COOKIE_PATH,
+        secure=settings.SESSION_COOKIE_SECURE or None,
+        httponly=settings.SESSION_COOKIE_HTTPONLY or None,
+        samesite=settings.SESSION_COOKIE_SAMESITE,
+    )
+    set_cookie = response.cookies[settings.SESSION_COOKIE_NAME].output(header="")
+    return session_key, [(b"set-cookie", set_cookie.strip().encode("latin-1"))]
+
+
+def remove_sent_out(out: List[dict], sent: List[dict]) -> List[dict]:
+    """
+    Return the items of ``out`` that are not in ``sent``, the output that
+    has already been sent on its own.
+    """
+    sent = list(sent)
+    unsent = []
+    for item in out:
+        if item in sent:
+            sent.remove(item)
+        else:
+            unsent.append(item)
+    return unsent
+
+
+async def websocket_query_application(scope, receive, send):
+    """
+    The ASGI application for WebSocket connections.
+    """
+    if (await receive())["type"] != "websocket.connect":
+        return
+    if not (
+        is_websocket_query_path(scope["path"])
+        and is_allowed_host(scope)
+        and is_allowed_origin(scope)
+    ):
+        # Closing before accepting rejects the handshake.
+        await send({"type": "websocket.close", "code": 4403})
+        return
+
+    session_key, headers = await sync_to_async(open_session)(scope)
+    await send({"type": "websocket.accept", "headers": headers})
+
+    backend = get_evaluation_backend()
+    query_executor = get_query_executor()
+    loop = asyncio.get_running_loop()
+    outgoing: asyncio.Queue = asyncio.Queue()
+    # Whether a query is in progress, and the task starting it. Only
+    # changed in the event loop.
+    running = {"busy": False, "starting": None}
+
+    def finish_query(query_id):
+        running["busy"] = False
+        outgoing.put_nowait({"type": "done", "id": query_id})
+
+    async def start_query(query_id, input: str):
+        # The query waits for the session's turn here, rather than in a
+        # thread of the query executor.
+        try:
+            turn = await backend.wait_for_turn(session_key)
+        except SessionBusy:
+            result = session_busy_result()
+        else:
+            try:
+                query_executor.submit(run_query, query_id, input, turn)
+                return
+            except QueryExecutorBusy:
+                turn.release()
+                result = busy_result()
+        outgoing.put_nowait({"type": "result", "id": query_id, "result": result})
+        finish_query(query_id)
+
+    def run_query(query_id, input: str, turn: SessionTurn):
+        # This runs in a thread of its own; messages are handed to the
+        # event loop through the "outgoing" queue.
+        def emit(message: dict):
+            loop.call_soon_threadsafe(outgoing.put_nowait, message)
+
+        sent_out = []
+
+        def on_out(out: dict):
+            sent_out.append(out)
+            emit({"type": "out", "id": query_id, "out": out})
+
+        try:
+            for data in backend.iter_query(session_key, input, on_out, turn):
+                data = dict(data, out=remove_sent_out(data["out"], sent_out))
+                sent_out.clear()
+                emit({"type": "result", "id": query_id, "result": data})
+        except Exception as exc:
+            emit({"type": "error", "id": query_id, "text": str(exc)})
+        finally:
+            loop.call_soon_threadsafe(finish_query, query_id)
+
+    async def send_outgoing():
+        while True:
+            message = await outgoing.get()
+            await send({"type": "websocket.send", "text": json.dumps(message)})
+
+    sender = asyncio.ensure_future(send_outgoing())
+    try:
+        while True:
+            event = await receive()
+            if event["type"] == "websocket.disconnect":
+                break
+            if event["type"] != "websocket.receive":
+                continue
+            try:
+                message = json.loads(event.get("text") or event.get("bytes") or "")
+            except ValueError:
+                continue
+            if not isinstance(message, dict):
+                continue
+
+            kind = message.get("type")
+            if kind == "query":
+                query_id = message.get("id")
+                if running["busy"]:
+                    outgoing.put_nowait({"type": "busy", "id": query_id})
+                    continue
+                running["busy"] = True
+                running["starting"] = asyncio.ensure_future(
+                    start_query(query_id, str(message.get("query", "")))
+                )
+            elif kind == "abort":
+                aborted = await sync_to_async(backend.abort, thread_sensitive=False)(
+                    session_key
+                )
+                outgoing.put_nowait(
+                    {"type": "abort", "result": "ok" if aborted else ""}
+                )
+    finally:
+        if running["starting"] is not None:
+            # Gives up the session's turn if it is still waiting for it.
+            running["starting"].cancel()
+        if running["busy"]:
+            # Nobody is left to see the rest of it.
+            await sync_to_async(backend.abort, thread_sensitive=False)(session_key)
+        sender.cancel()